@@ -0,0 +1 @@
+'''Performance benchmarks for TagViewer. Run them from the repository root, e.g. `python -m benchmarks.run --sizes 1000 100000`.'''
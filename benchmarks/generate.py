@@ -0,0 +1,117 @@
+'''Generate synthetic TagSpaces for benchmarking.
+
+The media are real (tiny) PNG files, so anything that decodes or hashes them does real work. Only `distinct_images` different images are encoded; every
+other file is a hard link to one of them (or a copy where hard links aren't supported), which keeps generating a million-file TagSpace quick and gives the
+duplicate finder something to find. Tags are assigned with a Zipf-like distribution, as in real TagSpaces where a few tags are on most files.'''
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import zlib
+from os import path
+from typing import Optional
+
+from tagspace import save_tagspace
+
+WORDS = ('cat', 'dog', 'beach', 'sunset', 'mountain', 'city', 'night', 'party', 'family', 'snow', 'forest', 'river', 'car', 'train', 'food', 'portrait')
+
+
+def png_bytes(width: int, height: int, rng: random.Random) -> bytes:
+	'''Encode a random gradient as an RGB PNG.'''
+	r0, g0, b0, r1, g1, b1 = (rng.randrange(256) for _ in range(6))
+	rows = []
+	for y in range(height):
+		row = bytearray([0])  # filter type: none
+		for x in range(width):
+			t = (x + y) / max(width + height - 2, 1)
+			row += bytes((int(r0 + (r1 - r0) * t), int(g0 + (g1 - g0) * t), int(b0 + (b1 - b0) * t)))
+		rows.append(bytes(row))
+
+	def chunk(kind: bytes, data: bytes) -> bytes:
+		return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+	return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+	        + chunk(b'IDAT', zlib.compress(b''.join(rows))) + chunk(b'IEND', b''))
+
+
+def generate(dirname: str, files: int=1000, tags: int=20, props: int=5, zipf: float=1.1, max_tags_per_file: int=5, images: bool=True,
+             distinct_images: int=256, image_size: int=16, seed: Optional[int]=0) -> dict:
+	'''Create a TagSpace with `files` files in `dirname`, which must be empty or not exist, and return its metadata.'''
+	rng = random.Random(seed)
+	os.makedirs(dirname, exist_ok=True)
+	tag_list = [[f'tag{i}', f'#{rng.randrange(1 << 24):06x}'] for i in range(tags)]
+	tag_weights = [1 / (rank ** zipf) for rank in range(1, tags + 1)]
+	prop_types = ['Number', 'Text', 'True/False']
+	prop_list = [[f'prop{i}', prop_types[i % 3]] for i in range(props)]
+
+	sources, sizes = [], []
+	if images:
+		pool = path.join(dirname, '.bench-images')
+		os.makedirs(pool, exist_ok=True)
+		for i in range(min(distinct_images, files)):
+			source = path.join(pool, f'{i}.png')
+			data = png_bytes(image_size, image_size, rng)
+			with open(source, 'wb') as image:
+				image.write(data)
+			sources.append(source)
+			sizes.append(len(data))
+
+	entries = []
+	link = os.link
+	for i in range(files):
+		relpath = f'{i // 1000:04d}/{i:07d}.png' if files > 10000 else f'{i:07d}.png'  # keep directories to a reasonable size
+		if images:
+			target = path.join(dirname, relpath)
+			if i % 1000 == 0: os.makedirs(path.dirname(target), exist_ok=True)
+			source = sources[i % len(sources)]
+			try:
+				link(source, target)
+			except OSError:
+				link = shutil.copyfile
+				link(source, target)
+		entry_tags = sorted(set(rng.choices(range(tags), tag_weights, k=rng.randint(0, max_tags_per_file)))) if tags else []
+		entry_props = {}
+		for name, kind in prop_list:
+			if rng.random() < 0.6:
+				if kind == 'Number': entry_props[name] = rng.randint(0, 100)
+				elif kind == 'Text': entry_props[name] = ' '.join(rng.choices(WORDS, k=rng.randint(1, 4)))
+				else: entry_props[name] = rng.random() < 0.5
+		entry = {'_path': relpath, 'title': f'{rng.choice(WORDS)} {i}', 'tags': entry_tags, 'props': entry_props}
+		if images: entry.update(_size=sizes[i % len(sizes)], _resolution=[image_size, image_size])
+		entries.append(entry)
+	if images:
+		shutil.rmtree(path.join(dirname, '.bench-images'))
+	meta = {
+		'title': f'Synthetic TagSpace ({files} files)',
+		'description': json.dumps({'files': files, 'tags': tags, 'props': props, 'zipf': zipf, 'seed': seed}),
+		'tagList': tag_list,
+		'deletedTags': [],
+		'propList': prop_list,
+		'files': entries,
+		'currentIndex': 0
+	}
+	save_tagspace(dirname, meta)
+	return meta
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Generate a synthetic TagSpace for benchmarking.')
+	parser.add_argument('dirname')
+	parser.add_argument('--files', type=int, default=1000)
+	parser.add_argument('--tags', type=int, default=20)
+	parser.add_argument('--props', type=int, default=5)
+	parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the tag popularity distribution')
+	parser.add_argument('--max-tags-per-file', type=int, default=5)
+	parser.add_argument('--no-images', action='store_true', help='only write tagviewer.json')
+	parser.add_argument('--distinct-images', type=int, default=256)
+	parser.add_argument('--image-size', type=int, default=16)
+	parser.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+	generate(args.dirname, args.files, args.tags, args.props, args.zipf, args.max_tags_per_file, not args.no_images, args.distinct_images,
+	         args.image_size, args.seed)
+
+
+if __name__ == '__main__':
+	main()
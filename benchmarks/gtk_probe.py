@@ -0,0 +1,61 @@
+'''Time the GUI: start TagViewer, open a TagSpace and step through media, waiting each time until GTK has nothing left to do.
+
+Run from the repository root (TagViewer loads its CSS and icons from the working directory) with a display, e.g. under `xvfb-run`. The configuration and
+cache directories are pointed at a temporary directory so the user's settings and history are left alone. Prints the results as JSON.'''
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from benchmarks.run import measure, peak_rss, summarize
+
+
+def settle(Gtk, timeout: float=10.0):
+	'''Run the main loop until nothing is pending: every idle callback (like decoded media arriving) has run and the frame has been laid out.'''
+	deadline = time.monotonic() + timeout
+	while Gtk.events_pending() and time.monotonic() < deadline: Gtk.main_iteration_do(False)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('dirname')
+	parser.add_argument('--repeat', type=int, default=10)
+	parser.add_argument('--steps', type=int, default=200)
+	args = parser.parse_args(argv)
+
+	home = tempfile.mkdtemp(prefix='tagviewer-bench-home-')
+	os.environ['XDG_CONFIG_HOME'] = os.path.join(home, 'config')
+	os.environ['XDG_CACHE_HOME'] = os.path.join(home, 'cache')
+	os.makedirs(os.environ['XDG_CONFIG_HOME'])
+	os.makedirs(os.environ['XDG_CACHE_HOME'])
+
+	start = time.perf_counter()
+	import main as tagviewer
+	from gi.repository import Gtk
+	win = tagviewer.MainWindow()
+	win.show_all()
+	settle(Gtk)
+	results = {'startup': summarize([time.perf_counter() - start])}
+
+	def open_tagspace():
+		win._open_tagspace(args.dirname)
+		settle(Gtk)
+	results['open'] = summarize(measure(open_tagspace, args.repeat))
+
+	count = win.state['num_of_files']
+	samples = []
+	for i in range(min(args.steps, count)):
+		step_start = time.perf_counter()
+		win.state['media_number'] = i + 1
+		settle(Gtk)
+		samples.append(time.perf_counter() - step_start)
+	if samples: results['navigate'] = summarize(samples)
+	results['peak_rss_bytes'] = peak_rss()
+	json.dump(results, sys.stdout)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,78 @@
+'''Check that transient StateMan bindings don't leak: make and drop 10k bindings per round (weak bindings to short-lived widgets, bindings that are
+unbound again, and per-item dynamic properties that are untracked again), changing the state as they come and go, and compare the memory in use after each
+round.
+
+Run from the repository root with `python -m benchmarks.leak_bindings`. Prints the results as JSON and exits with a non-zero status if the memory in use kept
+growing or any binding or property was left behind.'''
+
+import argparse
+import gc
+import json
+import sys
+import tracemalloc
+
+from stateman import StateMan
+
+TOLERANCE_BYTES = 64 * 1024  # allocator and interning noise
+
+
+class Widget:
+	'''Stands in for a short-lived piece of UI bound to the state, holding on to something sizeable like a GTK widget would.'''
+
+	def __init__(self):
+		self.payload = bytearray(1024)
+		self.updates = 0
+
+	def on_change(self, model, prop):
+		self.updates += 1
+
+
+def churn(model: StateMan, count: int):
+	for i in range(count):
+		widget = Widget()
+		model.bind(['current_item', 'filters'], widget.on_change, weak=True)
+
+		handler = lambda model, prop, payload=bytearray(1024): None  # noqa: E731
+		model.bind('current_item', handler)
+
+		item = ('item_tags', i)
+		model.track_dynamic(item, lambda model: len(model['current_item']), ('current_item',))
+		model[item]
+		model['current_item'] = {'_path': f'{i}.jpg', 'tags': [i % 7]}
+
+		model.unbind('current_item', handler)
+		model.untrack(item)
+		del widget, handler
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--bindings', type=int, default=10_000, help='transient bindings per round')
+	parser.add_argument('--rounds', type=int, default=5)
+	args = parser.parse_args(argv)
+
+	model = StateMan({'current_item': {}, 'filters': []})
+	model.bind('current_item', lambda model, prop: None)
+	baseline = {'bindings': {prop: len(handlers) for (prop, handlers) in model.bindings.items()}, 'props': len(model), 'dependents': len(model.dependents)}
+
+	tracemalloc.start()
+	churn(model, args.bindings)  # warm up: let the dicts and free lists reach their working size
+	gc.collect()
+	start = tracemalloc.get_traced_memory()[0]
+	usage = []
+	for _ in range(args.rounds):
+		churn(model, args.bindings)
+		gc.collect()
+		usage.append(tracemalloc.get_traced_memory()[0] - start)
+	tracemalloc.stop()
+
+	left = {'bindings': {prop: len(handlers) for (prop, handlers) in model.bindings.items()}, 'props': len(model), 'dependents': len(model.dependents)}
+	growth = usage[-1] - min(usage)
+	results = {'bindings_per_round': args.bindings, 'memory_growth_bytes': usage, 'growth_bytes': growth, 'left_behind': left != baseline}
+	json.dump(results, sys.stdout)
+	print()
+	if growth > TOLERANCE_BYTES or left != baseline: sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
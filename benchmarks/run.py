@@ -0,0 +1,238 @@
+'''End-to-end performance benchmarks.
+
+For each TagSpace size, a synthetic TagSpace is generated (once; they're kept in the work directory) and a fresh Python process runs the headless
+scenarios against it: opening (from `tagviewer.json` and from a resume snapshot), navigating, filtering (by a scan and through the query planner), sorting,
+saving and the CLI. A fresh process per size keeps the peak RSS of one size from hiding another's. With `--gtk`, the GUI is also started, under Xvfb when
+there is no display, to time opening and stepping through media with real rendering. Every run also checks that StateMan bindings don't leak (see
+``benchmarks.leak_bindings``).
+
+Results are written as JSON: latency percentiles and throughput per scenario, and peak RSS per size. Given `--baseline`, the results are compared with an
+earlier run and any scenario whose median got more than `--threshold` slower (or whose peak RSS grew by more than that) is reported as a regression. A
+regression or a leak gives a non-zero exit status.'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from os import path
+from typing import Callable, Dict, List
+
+ROOT = path.dirname(path.dirname(path.abspath(__file__)))
+NOISE_FLOOR_MS = 0.5  # differences smaller than this are never regressions
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+	return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(samples: List[float], operations: int=1) -> dict:
+	'''Summarize latency samples (in seconds), each covering `operations` operations.'''
+	values = sorted(samples)
+	return {
+		'n': len(values),
+		'mean_ms': sum(values) / len(values) * 1000,
+		'p50_ms': percentile(values, 0.5) * 1000,
+		'p90_ms': percentile(values, 0.9) * 1000,
+		'p99_ms': percentile(values, 0.99) * 1000,
+		'max_ms': values[-1] * 1000,
+		'throughput_per_s': operations * len(values) / sum(values) if sum(values) else None,
+	}
+
+
+def measure(fn: Callable[[], object], repeat: int, warmup: int=1) -> List[float]:
+	for _ in range(warmup): fn()
+	samples = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fn()
+		samples.append(time.perf_counter() - start)
+	return samples
+
+
+def peak_rss() -> int:
+	maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def run_scenarios(dirname: str, repeat: int) -> dict:
+	'''Run the headless scenarios against the TagSpace in `dirname`. This runs in the worker process.'''
+	from filters import filter_files, parse_term
+	from model import BuiltinSortProps, SortMethods, create_model, sort_order
+	from query import QueryEngine, normalize, parse
+	import snapshot
+	from tagspace import load_tagspace, save_tagspace
+
+	results = {}
+	state = create_model()
+
+	def open_tagspace():
+		state['tagviewer_meta'] = load_tagspace(dirname)
+		state['open_directory'] = dirname
+		state['media_number'] = 1
+		state['num_of_files'], state['file_paths'], state['current_item']
+	results['open'] = summarize(measure(open_tagspace, repeat))
+
+	snapshot_path = path.join(tempfile.mkdtemp(prefix='tagviewer-bench-snapshot-'), snapshot.SNAPSHOT_FILENAME)
+	state.refs['query_engine'].evaluate(state['files'], state['tagviewer_meta'], normalize(parse('tag:tag0')))  # so the filter indexes are saved too
+	written = snapshot.source_stat(dirname)
+	results['snapshot_save'] = summarize(measure(lambda: snapshot.save(snapshot_path, state, written), max(1, repeat // 2)))
+
+	def resume_tagspace():
+		meta = snapshot.resume(snapshot_path, dirname, state)
+		assert meta is not None, 'the snapshot was not used'
+		state['tagviewer_meta'] = meta
+		state['open_directory'] = dirname
+		state['media_number'] = 1
+		state['num_of_files'], state['file_paths'], state['current_item']
+	results['resume'] = summarize(measure(resume_tagspace, repeat))
+	shutil.rmtree(path.dirname(snapshot_path))
+
+	count = state['num_of_files']
+	steps = min(count, 2000)
+	stride = max(1, count // steps)
+	samples = []
+	for i in range(steps):
+		start = time.perf_counter()
+		state['media_number'] = i * stride + 1
+		state['current_path'], state['current_tags'], state['can_go_next']
+		samples.append(time.perf_counter() - start)
+	results['navigate'] = summarize(samples)
+
+	meta = state['tagviewer_meta']
+	files = state['files']
+	for name, terms in (('filter_tag', ['tag:tag0']), ('filter_tag_prop', ['tag:tag3', 'prop:prop0>=50']), ('filter_path', ['path:*5.png']),
+	                    ('filter_negated_text', ['!tag:tag1', 'prop:prop1~cat'])):
+		filters = [parse_term(term) for term in terms]
+		results[name] = summarize(measure(lambda: sum(1 for _ in filter_files(files, filters, meta)), repeat), len(files))
+
+	entry = files[0]
+	for name, text in (('query_tag_prop', 'tag:tag3 prop:prop0>=50'), ('query_or_not', '(tag:tag2 or tag:tag5) and not prop:prop3<20')):
+		expression = normalize(parse(text))
+		results[f'{name}_cold'] = summarize(measure(lambda: QueryEngine().evaluate(files, meta, expression), repeat), len(files))
+		engine = QueryEngine()
+		results[f'{name}_cached'] = summarize(measure(lambda: engine.evaluate(files, meta, expression), repeat))
+		def edit_and_evaluate():
+			entry['tags'] = sorted(set(entry['tags']) ^ {2, 3})
+			engine.note_changed([entry])
+			engine.evaluate(files, meta, expression)
+		results[f'{name}_after_edit'] = summarize(measure(edit_and_evaluate, repeat))
+
+	for name, options in (('sort_title', (BuiltinSortProps.TITLE, SortMethods.SORT_AZ)), ('sort_size', (BuiltinSortProps.SIZE, SortMethods.SORT_91)),
+	                      ('sort_prop', ('prop0', SortMethods.SORT_19))):
+		results[name] = summarize(measure(lambda: sort_order(files, options), repeat), len(files))
+
+	scratch = tempfile.mkdtemp(prefix='tagviewer-bench-save-')  # not over the generated TagSpace, which the edits above changed in memory
+	results['save'] = summarize(measure(lambda: save_tagspace(scratch, meta), max(1, repeat // 2)))
+	shutil.rmtree(scratch)
+
+	cli = [sys.executable, path.join(ROOT, 'tagviewer'), '-t', dirname]
+	results['cli_stats'] = summarize(measure(lambda: subprocess.run(cli + ['stats'], stdout=subprocess.DEVNULL, check=True), repeat))
+	results['cli_query'] = summarize(measure(lambda: subprocess.run(cli + ['query', 'tag:tag0'], stdout=subprocess.DEVNULL, check=True), repeat))
+	return results
+
+
+def tagspace_for(size: int, args) -> str:
+	from benchmarks.generate import generate
+	dirname = path.join(args.workdir, f'{size}-{args.seed}{"-noimages" if args.no_images else ""}')
+	if not path.exists(path.join(dirname, 'tagviewer.json')):
+		shutil.rmtree(dirname, ignore_errors=True)
+		print(f'Generating a TagSpace with {size} files…', file=sys.stderr)
+		generate(dirname, size, images=not args.no_images, seed=args.seed)
+	return dirname
+
+
+def run_gtk(dirname: str, repeat: int) -> dict:
+	command = [sys.executable, '-m', 'benchmarks.gtk_probe', dirname, '--repeat', str(repeat)]
+	if not os.environ.get('DISPLAY') and not os.environ.get('WAYLAND_DISPLAY'):
+		if shutil.which('xvfb-run') is None: return {'error': 'no display and xvfb-run is not installed'}
+		command = ['xvfb-run', '-a'] + command
+	process = subprocess.run(command, cwd=ROOT, stdout=subprocess.PIPE, text=True)
+	if process.returncode != 0: return {'error': f'exited with status {process.returncode}'}
+	return json.loads(process.stdout)
+
+
+def run_leak_check() -> dict:
+	process = subprocess.run([sys.executable, '-m', 'benchmarks.leak_bindings', '--bindings', '2000', '--rounds', '3'], cwd=ROOT, stdout=subprocess.PIPE,
+	                         text=True)
+	results = json.loads(process.stdout) if process.stdout.strip() else {'error': f'exited with status {process.returncode}'}
+	results['passed'] = process.returncode == 0
+	return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> List[str]:
+	'''Return a description of every regression of `results` relative to `baseline`.'''
+	regressions = []
+	for size, run in results['runs'].items():
+		base_run = baseline.get('runs', {}).get(size)
+		if base_run is None: continue
+		for scenario, stats in run.get('scenarios', {}).items():
+			base = base_run.get('scenarios', {}).get(scenario)
+			if base is None or 'p50_ms' not in stats or 'p50_ms' not in base: continue
+			if stats['p50_ms'] > base['p50_ms'] * (1 + threshold) and stats['p50_ms'] - base['p50_ms'] > NOISE_FLOOR_MS:
+				regressions.append(f'{size} files, {scenario}: median {base["p50_ms"]:.2f} ms → {stats["p50_ms"]:.2f} ms '
+				                   f'({stats["p50_ms"] / base["p50_ms"] - 1:+.0%})')
+		if 'peak_rss_bytes' in run and 'peak_rss_bytes' in base_run and run['peak_rss_bytes'] > base_run['peak_rss_bytes'] * (1 + threshold):
+			regressions.append(f'{size} files, peak RSS: {base_run["peak_rss_bytes"] >> 20} MiB → {run["peak_rss_bytes"] >> 20} MiB')
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description='Run the TagViewer performance benchmarks.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='TagSpace sizes (numbers of files) to run')
+	parser.add_argument('--repeat', type=int, default=10)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--no-images', action='store_true', help='generate tagviewer.json only, without media files')
+	parser.add_argument('--workdir', default=path.join(tempfile.gettempdir(), 'tagviewer-bench'), help='where generated TagSpaces are kept')
+	parser.add_argument('--gtk', action='store_true', help='also benchmark the GUI (under Xvfb if there is no display)')
+	parser.add_argument('-o', '--output', help='write the results here instead of stdout')
+	parser.add_argument('--baseline', help='compare with the results of an earlier run')
+	parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown counted as a regression (default 0.1, i.e. 10%%)')
+	parser.add_argument('--worker', help=argparse.SUPPRESS)
+	args = parser.parse_args(argv)
+
+	if args.worker is not None:  # running one size in its own process
+		scenarios = run_scenarios(args.worker, args.repeat)
+		json.dump({'scenarios': scenarios, 'peak_rss_bytes': peak_rss()}, sys.stdout)
+		return
+
+	results = {
+		'meta': {'python': platform.python_version(), 'platform': platform.platform(), 'machine': platform.machine(), 'time': time.time(),
+		         'repeat': args.repeat, 'seed': args.seed, 'images': not args.no_images},
+		'runs': {},
+	}
+	for size in args.sizes:
+		dirname = tagspace_for(size, args)
+		print(f'Running {size} files…', file=sys.stderr)
+		worker = subprocess.run([sys.executable, '-m', 'benchmarks.run', '--worker', dirname, '--repeat', str(args.repeat)], cwd=ROOT,
+		                        stdout=subprocess.PIPE, text=True, check=True)
+		run: Dict[str, object] = json.loads(worker.stdout)
+		if args.gtk: run['gtk'] = run_gtk(dirname, args.repeat)
+		results['runs'][str(size)] = run
+	print('Checking StateMan bindings for leaks…', file=sys.stderr)
+	results['bindings'] = run_leak_check()
+
+	output = json.dumps(results, indent=2)
+	if args.output:
+		with open(args.output, 'w') as output_file: output_file.write(output)
+	else:
+		print(output)
+
+	if not results['bindings']['passed']:
+		print('LEAK: StateMan bindings or memory were left behind by transient bindings', file=sys.stderr)
+		sys.exit(1)
+	if args.baseline:
+		with open(args.baseline) as baseline_file:
+			regressions = compare(results, json.load(baseline_file), args.threshold)
+		for regression in regressions: print(f'REGRESSION: {regression}', file=sys.stderr)
+		if regressions: sys.exit(1)
+		print('No regressions.', file=sys.stderr)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,262 @@
+'''The `tagviewer` command line interface, for querying and editing TagSpaces from scripts and pipelines without a display.
+
+Only GTK-free modules are imported, and only the ones a command needs, so that starting up costs little more than starting Python and reading
+`tagviewer.json`. Results are written one line at a time as they're produced.'''
+
+import argparse
+import json
+import os
+import sys
+from os import path
+from typing import Iterable, List
+
+from tagspace import is_tagspace, load_tagspace, save_tagspace
+
+
+class CLIError(Exception):
+	pass
+
+
+def _emit(lines: Iterable[str]):
+	write = sys.stdout.write
+	for line in lines:
+		write(line)
+		write('\n')
+
+
+def _find_tagspace(dirname: str) -> str:
+	dirname = path.abspath(dirname)
+	if not is_tagspace(dirname): raise CLIError(f'{dirname} is not a TagSpace')
+	return dirname
+
+
+def _load(dirname: str) -> dict:
+	try:
+		return load_tagspace(dirname)
+	except ValueError as e:
+		raise CLIError(f'The metadata of {dirname} could not be read: {e}')
+
+
+def _relative_paths(dirname: str, given: List[str]) -> List[str]:
+	'''Turn the paths given on the command line (or read from stdin for `-`) into `_path`s. Paths are taken relative to the current directory when they
+	exist and are inside the TagSpace, and relative to the TagSpace otherwise.'''
+	if given == ['-']: given = [line.rstrip('\n') for line in sys.stdin if line.strip()]
+	result = []
+	for filepath in given:
+		absolute = path.abspath(filepath)
+		if path.exists(absolute) and path.commonpath([absolute, dirname]) == dirname: result.append(path.relpath(absolute, dirname).replace(os.sep, '/'))
+		else: result.append(filepath)
+	return result
+
+
+def _query(meta: dict, terms: List[str], sort: str=None, reverse: bool=False) -> Iterable[dict]:
+	from filters import filter_files
+	filters = [{'type': 'expr', 'expr': term} for term in terms]
+	files = meta.get('files', [])
+	if sort is not None or reverse:
+		from model import BuiltinSortProps, SortMethods, sort_order
+		sort_prop = BuiltinSortProps[sort.upper()] if sort is not None and sort.upper() in BuiltinSortProps.__members__ else (sort or BuiltinSortProps.INTRINSIC)
+		order = sort_order(files, (sort_prop, SortMethods.SORT_91 if reverse else SortMethods.SORT_19))
+		if sort_prop == BuiltinSortProps.INTRINSIC and reverse: order.reverse()
+		files = map(files.__getitem__, order)
+	try:
+		return filter_files(files, filters, meta)
+	except ValueError as e:
+		raise CLIError(str(e))
+
+
+def _tag_names(meta: dict, entry: dict) -> List[str]:
+	tag_list = meta.get('tagList', [])
+	return [tag_list[i][0] for i in entry.get('tags', ())]
+
+
+def cmd_query(args):
+	dirname = _find_tagspace(args.tagspace)
+	meta = _load(dirname)
+	results = _query(meta, args.terms, args.sort, args.reverse)
+	if args.format == 'json':
+		_emit(json.dumps({'path': entry['_path'], 'title': entry.get('title'), 'tags': _tag_names(meta, entry), 'props': entry.get('props', {})})
+		      for entry in results)
+	elif args.absolute:
+		_emit(path.join(dirname, entry['_path']) for entry in results)
+	else:
+		_emit(entry['_path'] for entry in results)
+
+
+def _edit_tags(args, add: bool):
+	from model import tag_index
+	dirname = _find_tagspace(args.tagspace)
+	meta = _load(dirname)
+	index = tag_index(meta, args.tag)
+	if index is None:
+		if not (add and args.create): raise CLIError(f'No tag called “{args.tag}”' + (' (use --create to make it)' if add else ''))
+		meta.setdefault('tagList', []).append([args.tag, args.color])
+		index = len(meta['tagList']) - 1
+	entries = {entry['_path']: entry for entry in meta.get('files', [])}
+	changed = 0
+	for relpath in _relative_paths(dirname, args.paths):
+		entry = entries.get(relpath)
+		if entry is None:
+			print(f'tagviewer: {relpath}: not in the TagSpace', file=sys.stderr)
+			continue
+		tags = entry.setdefault('tags', [])
+		if add and index not in tags:
+			tags.append(index)
+			changed += 1
+		elif not add and index in tags:
+			tags.remove(index)
+			changed += 1
+	if changed: save_tagspace(dirname, meta)
+	if not args.quiet: print(f'{"Tagged" if add else "Untagged"} {changed} file{"s" if changed != 1 else ""}', file=sys.stderr)
+
+
+def cmd_tag(args):
+	_edit_tags(args, True)
+
+
+def cmd_untag(args):
+	_edit_tags(args, False)
+
+
+def cmd_vacuum(args):
+	import vacuum
+	dirname = _find_tagspace(args.tagspace)
+	meta = _load(dirname)
+	removed = len(set(meta.get('deletedTags', ())))
+	result = vacuum.compute(None, meta)
+	if result is not None:
+		vacuum.apply(meta, result)
+		save_tagspace(dirname, meta)
+	if not args.quiet: print(f'Removed {removed} deleted tag{"s" if removed != 1 else ""}', file=sys.stderr)
+
+
+def cmd_stats(args):
+	dirname = _find_tagspace(args.tagspace)
+	meta = _load(dirname)
+	files = meta.get('files', [])
+	tag_list = meta.get('tagList', [])
+	deleted = set(meta.get('deletedTags', ()))
+	tag_counts = [0] * len(tag_list)
+	prop_counts = {}
+	total_size = 0
+	for entry in files:
+		for i in entry.get('tags', ()): tag_counts[i] += 1
+		for prop in entry.get('props', {}): prop_counts[prop] = prop_counts.get(prop, 0) + 1
+		total_size += entry.get('_size', 0)
+	stats = {
+		'title': meta.get('title'),
+		'files': len(files),
+		'total_size': total_size,
+		'untagged': sum(1 for entry in files if not entry.get('tags')),
+		'tags': {tag_list[i][0]: tag_counts[i] for i in range(len(tag_list)) if i not in deleted},
+		'deleted_tags': len(deleted),
+		'props': prop_counts,
+	}
+	if args.format == 'json':
+		_emit([json.dumps(stats)])
+		return
+	_emit([f'{stats["title"]}: {stats["files"]} files, {stats["total_size"]} bytes, {stats["untagged"]} untagged'])
+	_emit(f'tag\t{name}\t{count}' for (name, count) in stats['tags'].items())
+	_emit(f'prop\t{name}\t{count}' for (name, count) in prop_counts.items())
+
+
+def cmd_export(args):
+	dirname = _find_tagspace(args.tagspace)
+	meta = _load(dirname)
+	results = _query(meta, args.terms)
+	if args.format == 'jsonl':
+		_emit(json.dumps({'path': entry['_path'], 'title': entry.get('title'), 'tags': _tag_names(meta, entry), 'props': entry.get('props', {})})
+		      for entry in results)
+	else:
+		import csv
+		writer = csv.writer(sys.stdout)
+		writer.writerow(['path', 'title', 'tags', 'props'])
+		for entry in results:
+			writer.writerow([entry['_path'], entry.get('title', ''), ';'.join(_tag_names(meta, entry)), json.dumps(entry.get('props', {}))])
+
+
+def cmd_search(args):
+	from search_index import SearchIndex
+	index = SearchIndex()
+	if not args.no_sync:
+		import appdirs
+		try:
+			with open(path.join(appdirs.user_cache_dir('tagviewer'), 'cache.json'), 'r') as cache_file:
+				index.sync(json.load(cache_file).get('open_history', []))
+		except (OSError, ValueError):
+			pass  # no history yet; search whatever was indexed before
+	props = []
+	for prop in args.prop:
+		name, sep, value = prop.partition('=')
+		if not sep: raise CLIError(f'--prop needs NAME=VALUE, not “{prop}”')
+		from filters import coerce_value
+		props.append((name, coerce_value(value)))
+	hits = index.search(' '.join(args.text), args.tag, props, limit=args.limit or None)
+	if args.format == 'json': _emit(json.dumps(hit._asdict()) for hit in hits)
+	else: _emit(path.join(hit.tagspace, hit.path) for hit in hits)
+
+
+def build_parser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(prog='tagviewer', description='Query and edit TagViewer TagSpaces.')
+	parser.add_argument('-t', '--tagspace', default='.', help='the TagSpace directory (default: the current directory)')
+	commands = parser.add_subparsers(dest='command', required=True)
+
+	query = commands.add_parser('query', help='list the files matching all the given filter expressions')
+	query.add_argument('terms', nargs='*', help='tag:NAME, prop:NAME<op>VALUE (op is one of = != < <= > >= ~) or path:GLOB, prefixed with ! to negate, '
+	                   'and combined with and, or, not and parentheses')
+	query.add_argument('--sort', help='title, size, resolution or the name of a prop')
+	query.add_argument('--reverse', action='store_true')
+	query.add_argument('--absolute', action='store_true', help='print absolute paths')
+	query.add_argument('--format', choices=('path', 'json'), default='path')
+	query.set_defaults(func=cmd_query)
+
+	for name, func, verb in (('tag', cmd_tag, 'add'), ('untag', cmd_untag, 'remove')):
+		edit = commands.add_parser(name, help=f'{verb} a tag to/from files')
+		edit.add_argument('tag')
+		edit.add_argument('paths', nargs='+', help='the files, or - to read paths from stdin')
+		edit.add_argument('-q', '--quiet', action='store_true')
+		if name == 'tag':
+			edit.add_argument('--create', action='store_true', help='create the tag if it does not exist')
+			edit.add_argument('--color', default='#a5b1c2', help='the color for a created tag')
+		edit.set_defaults(func=func)
+
+	vacuum = commands.add_parser('vacuum', help='remove deleted tags from the tag list for good')
+	vacuum.add_argument('-q', '--quiet', action='store_true')
+	vacuum.set_defaults(func=cmd_vacuum)
+
+	stats = commands.add_parser('stats', help='summarize the TagSpace')
+	stats.add_argument('--format', choices=('text', 'json'), default='text')
+	stats.set_defaults(func=cmd_stats)
+
+	export = commands.add_parser('export', help='export the metadata of the files matching the filter terms')
+	export.add_argument('terms', nargs='*')
+	export.add_argument('--format', choices=('jsonl', 'csv'), default='jsonl')
+	export.set_defaults(func=cmd_export)
+
+	search = commands.add_parser('search', help='search every TagSpace in the open history')
+	search.add_argument('text', nargs='*', help='words to look for in paths, titles, tags and prop values')
+	search.add_argument('--tag', action='append', default=[], help='only items with this tag (repeatable)')
+	search.add_argument('--prop', action='append', default=[], metavar='NAME=VALUE', help='only items with this prop value (repeatable)')
+	search.add_argument('--limit', type=int, default=0)
+	search.add_argument('--no-sync', action='store_true', help='do not check the TagSpaces for changes first')
+	search.add_argument('--format', choices=('path', 'json'), default='path')
+	search.set_defaults(func=cmd_search)
+	return parser
+
+
+def main(argv=None):
+	args = build_parser().parse_args(argv)
+	try:
+		args.func(args)
+		sys.stdout.flush()
+	except CLIError as e:
+		print(f'tagviewer: {e}', file=sys.stderr)
+		sys.exit(1)
+	except BrokenPipeError:  # e.g. piped into `head`
+		devnull = os.open(os.devnull, os.O_WRONLY)
+		os.dup2(devnull, sys.stdout.fileno())
+		sys.exit(0)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,244 @@
+'''Finding exact and near-duplicate media in a TagSpace.
+
+Every file gets two fingerprints: a content hash (the same BLAKE2b digest the importer records as `_hash`) and a 64-bit perceptual hash (a difference
+hash, "dHash", of a 9×8 grayscale thumbnail). Both are kept in the TagSpace's sidecar cache together with the size and modification time they were computed
+for, so only new or changed files are fingerprinted again.
+
+Files with equal content hashes are exact duplicates. Files whose perceptual hashes differ in at most `max_distance` bits are near-duplicates. Near-
+duplicates are found with multi-index hashing: the 64 bits are split into `max_distance + 1` bands, and by the pigeonhole principle any two hashes within
+`max_distance` bits of each other agree exactly on at least one band. With NumPy, candidates are pulled out of each band with a sort, and the Hamming
+distances of all candidates are computed in one vectorized pass. Without NumPy a BK-tree is used instead, which gives the same result but is much slower on
+large TagSpaces. Small thresholds are much cheaper than large ones, since each extra band makes the bands narrower and the candidate buckets bigger.'''
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+from os import path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from importer import hash_file
+from jobs import Job
+from tagspace import load_sidecar, stamp_matches, update_sidecar
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+try:
+	import gi
+	gi.require_version('GdkPixbuf', '2.0')
+	from gi.repository import GdkPixbuf, GLib
+except (ImportError, ValueError):
+	GdkPixbuf = None
+
+DEFAULT_MAX_DISTANCE = 4
+
+
+def perceptual_hash(filepath: str) -> Optional[int]:
+	'''Compute the 64-bit difference hash of an image, or return `None` if it can't be decoded (or GdkPixbuf isn't available).
+
+	The image is decoded straight to 9×8 pixels, which lets loaders like the JPEG one skip most of the work of a full decode. Each bit says whether a pixel is
+	brighter than its left neighbour.'''
+	if GdkPixbuf is None: return None
+	try:
+		pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filepath, 9, 8, False)
+	except GLib.Error:
+		return None
+	pixels = pixbuf.get_pixels()
+	rowstride = pixbuf.get_rowstride()
+	channels = pixbuf.get_n_channels()
+	bits = 0
+	for y in range(8):
+		row = y * rowstride
+		previous = None
+		for x in range(9):
+			i = row + x * channels
+			luma = pixels[i] * 299 + pixels[i + 1] * 587 + pixels[i + 2] * 114
+			if previous is not None: bits = (bits << 1) | (luma > previous)
+			previous = luma
+	return bits
+
+
+def _fingerprint(filepath: str) -> Tuple[str, Optional[int]]:
+	return hash_file(filepath), perceptual_hash(filepath)
+
+
+def update_fingerprints(job: Job, dirname: str, files: List[dict], workers: Optional[int]=None) -> Dict[str, dict]:
+	'''Bring the fingerprints in the sidecar cache of the TagSpace in `dirname` up to date for `files`, and return them keyed by `_path`.
+
+	A content hash recorded in a file entry by the importer is reused as long as the file's size and modification time still match.'''
+	cached = load_sidecar(dirname)['files']
+	fingerprints, stale = {}, []
+	for entry in files:
+		relpath = entry['_path']
+		try:
+			stat = os.stat(path.join(dirname, relpath))
+		except OSError:
+			continue  # missing files are left to the reconciler
+		known = cached.get(relpath, {})
+		if stamp_matches({'_size': known.get('size'), '_mtime_ns': known.get('mtime_ns'), '_mtime': known.get('mtime')}, stat) and 'hash' in known:
+			fingerprints[relpath] = known
+		else:
+			stale.append((relpath, stat, entry.get('_hash') if stamp_matches(entry, stat) else None))
+
+	total = len(stale)
+	computed = {}
+	with ThreadPoolExecutor(max_workers=workers or min(8, (os.cpu_count() or 1) + 2), thread_name_prefix='fingerprint') as pool:
+		def compute(item):
+			relpath, stat, content_hash = item
+			job.check()
+			filepath = path.join(dirname, relpath)
+			if content_hash is None: content_hash, phash = _fingerprint(filepath)
+			else: phash = perceptual_hash(filepath)
+			return relpath, {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': content_hash, 'phash': phash}
+		try:
+			for done, (relpath, fingerprint) in enumerate(pool.map(compute, stale), start=1):
+				fingerprints[relpath] = computed[relpath] = fingerprint
+				job.progress(done, total, relpath)
+		finally:
+			pool.shutdown(wait=True, cancel_futures=True)
+			if computed: update_sidecar(dirname, lambda sidecar: sidecar['files'].update(computed))  # keep whatever was computed, even if cancelled
+	return fingerprints
+
+
+class _DisjointSet:
+	__slots__ = ['parent']
+
+	def __init__(self, size: int):
+		self.parent = list(range(size))
+
+	def find(self, i: int) -> int:
+		parent = self.parent
+		while parent[i] != i:
+			parent[i] = parent[parent[i]]
+			i = parent[i]
+		return i
+
+	def union(self, a: int, b: int):
+		a, b = self.find(a), self.find(b)
+		if a != b: self.parent[max(a, b)] = min(a, b)
+
+
+class BKTree:
+	'''A BK-tree over 64-bit integers with the Hamming distance as its metric. Used for near-duplicate matching when NumPy is not available.'''
+	__slots__ = ['root']
+
+	def __init__(self, values: Iterable[int]=()):
+		self.root = None
+		for value in values: self.add(value)
+
+	def add(self, value: int):
+		if self.root is None:
+			self.root = (value, {})
+			return
+		node = self.root
+		while True:
+			distance = bin(node[0] ^ value).count('1')
+			if distance == 0: return
+			child = node[1].get(distance)
+			if child is None:
+				node[1][distance] = (value, {})
+				return
+			node = child
+
+	def search(self, value: int, max_distance: int) -> List[int]:
+		'''Return every value in the tree within `max_distance` bits of `value`.'''
+		found = []
+		stack = [self.root] if self.root is not None else []
+		while stack:
+			node_value, children = stack.pop()
+			distance = bin(node_value ^ value).count('1')
+			if distance <= max_distance: found.append(node_value)
+			for child_distance, child in children.items():
+				if distance - max_distance <= child_distance <= distance + max_distance: stack.append(child)
+		return found
+
+
+def _popcount(values):
+	if hasattr(np, 'bitwise_count'): return np.bitwise_count(values)
+	table = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+	return table[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _near_pairs_numpy(values: List[int], max_distance: int) -> List[Tuple[int, int]]:
+	hashes = np.array(values, dtype=np.uint64)
+	count = len(hashes)
+	bands = max_distance + 1
+	width = 64 // bands
+	pair_keys = []
+	for band in range(bands):
+		shift = band * width
+		bits = width if band < bands - 1 else 64 - shift
+		keys = (hashes >> np.uint64(shift)) & np.uint64((1 << bits) - 1)
+		order = np.argsort(keys, kind='stable')
+		sorted_keys = keys[order]
+		group = np.cumsum(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+		# compare every position with the ones `offset` places after it in the same bucket; the candidates shrink to the large buckets as `offset` grows
+		active = np.flatnonzero(np.concatenate((sorted_keys[1:] == sorted_keys[:-1], [False])))
+		offset = 1
+		while active.size:
+			a, b = order[active], order[active + offset]
+			close = _popcount(hashes[a] ^ hashes[b]) <= max_distance
+			low, high = np.minimum(a[close], b[close]), np.maximum(a[close], b[close])
+			pair_keys.append(low.astype(np.int64) * count + high)
+			offset += 1
+			active = active[active + offset < count]
+			active = active[group[active + offset] == group[active]]
+	if not pair_keys: return []
+	unique = np.unique(np.concatenate(pair_keys))
+	return list(zip((unique // count).tolist(), (unique % count).tolist()))
+
+
+def _near_pairs_bktree(values: List[int], max_distance: int) -> List[Tuple[int, int]]:
+	position = {value: i for i, value in enumerate(values)}
+	tree = BKTree(values)
+	pairs = []
+	for i, value in enumerate(values):
+		for other in tree.search(value, max_distance):
+			j = position[other]
+			if i < j: pairs.append((i, j))
+	return pairs
+
+
+def near_duplicate_pairs(values: List[int], max_distance: int=DEFAULT_MAX_DISTANCE) -> List[Tuple[int, int]]:
+	'''Return the index pairs `(i, j)`, `i < j`, of the distinct 64-bit hashes in `values` that are at most `max_distance` bits apart.'''
+	if len(values) < 2: return []
+	if np is not None: return _near_pairs_numpy(values, max_distance)
+	return _near_pairs_bktree(values, max_distance)
+
+
+def group_duplicates(fingerprints: Dict[str, dict], max_distance: int=DEFAULT_MAX_DISTANCE) -> List[List[str]]:
+	'''Group files that are exact or near-duplicates of each other.\n
+	Arguments: `fingerprints` (as returned by ``update_fingerprints``) | Keyword Arguments: `max_distance` (int, the largest number of differing perceptual
+	hash bits for two files to count as near-duplicates; a negative number matches exact duplicates only)
+
+	Returns the groups with more than one member, each sorted, largest group first.'''
+	paths = list(fingerprints)
+	groups = _DisjointSet(len(paths))
+	first_with_hash = {}
+	first_with_phash = {}
+	for i, relpath in enumerate(paths):
+		fingerprint = fingerprints[relpath]
+		groups.union(i, first_with_hash.setdefault(fingerprint['hash'], i))
+		if max_distance >= 0 and fingerprint.get('phash') is not None:  # the same perceptual hash is distance 0
+			groups.union(i, first_with_phash.setdefault(fingerprint['phash'], i))
+	if max_distance > 0:
+		distinct = list(first_with_phash)
+		for a, b in near_duplicate_pairs(distinct, max_distance):
+			groups.union(first_with_phash[distinct[a]], first_with_phash[distinct[b]])
+	members = {}
+	for i, relpath in enumerate(paths):
+		members.setdefault(groups.find(i), []).append(relpath)
+	return sorted((sorted(group) for group in members.values() if len(group) > 1), key=lambda group: (-len(group), group[0]))
+
+
+def find_duplicates(job: Job, dirname: str, files: List[dict], max_distance: int=DEFAULT_MAX_DISTANCE) -> List[List[str]]:
+	'''Fingerprint `files` and group the duplicates among them. Meant to be the target of a `Job`.'''
+	fingerprints = update_fingerprints(job, dirname, files)
+	job.check()
+	return group_duplicates(fingerprints, max_distance)
+
+
+def duplicates_filter(groups: List[List[str]]) -> dict:
+	'''Make an entry for the `filters` state that shows only the files in `groups`.'''
+	return {'type': 'paths', 'label': 'Duplicates', 'paths': [relpath for group in groups for relpath in group]}
@@ -0,0 +1,105 @@
+'''Filtering the files of a TagSpace.
+
+The `filters` state is a list of filter entries, all of which a file has to match to be shown. Each entry is a dict with a `type` and an optional `negate`:
+
+- `{'type': 'tag', 'tag': name}`: the file has the tag.
+- `{'type': 'prop', 'prop': name, 'op': op, 'value': value}`: the file's prop compares to `value` with `op`, one of `=`, `!=`, `<`, `<=`, `>`, `>=` or `~`
+	(contains, for text).
+- `{'type': 'path', 'pattern': glob}`: the file's path matches the glob.
+- `{'type': 'paths', 'paths': [...]}`: the file's path is one of `paths`, for filters computed elsewhere, like duplicates.
+- `{'type': 'expr', 'expr': text}`: the file matches a filter expression, which combines the terms above with `and`, `or` and `not` (see `query`).
+
+Entries may also carry a `label` to show in the UI.
+
+``filter_files`` checks each file in turn, which suits one-off queries like the command line's. The model evaluates `filters` with a `query.QueryEngine`,
+which plans them against indexes and keeps the results.'''
+
+import operator
+import re
+from fnmatch import fnmatchcase
+from typing import Callable, Iterable, Iterator, List
+
+from model import tag_index
+
+OPERATORS = {
+	'=': operator.eq,
+	'!=': operator.ne,
+	'<': operator.lt,
+	'<=': operator.le,
+	'>': operator.gt,
+	'>=': operator.ge,
+	'~': lambda a, b: str(b).lower() in str(a).lower(),
+}
+
+_prop_term = re.compile(r'(?P<prop>.+?)(?P<op>!=|<=|>=|=|<|>|~)(?P<value>.*)')
+
+
+def coerce_value(text: str):
+	'''Turn the text of a value in a filter term into the type it most likely represents.'''
+	if text.lower() in ('true', 'false'): return text.lower() == 'true'
+	try:
+		return int(text)
+	except ValueError:
+		pass
+	try:
+		return float(text)
+	except ValueError:
+		return text
+
+
+def parse_term(text: str) -> dict:
+	'''Parse a filter term as written on the command line: `tag:NAME`, `prop:NAME<op>VALUE` or `path:GLOB`, negated with a leading `!` or `-`.'''
+	negate = text[:1] in ('!', '-')
+	if negate: text = text[1:]
+	kind, sep, rest = text.partition(':')
+	if not sep: raise ValueError(f'Filter term “{text}” has no type; use tag:, prop: or path:')
+	if kind == 'tag': filt = {'type': 'tag', 'tag': rest}
+	elif kind == 'path': filt = {'type': 'path', 'pattern': rest}
+	elif kind == 'prop':
+		match = _prop_term.fullmatch(rest)
+		if match is None: raise ValueError(f'Prop filter “{rest}” has no comparison')
+		filt = {'type': 'prop', 'prop': match['prop'], 'op': match['op'], 'value': coerce_value(match['value'])}
+	else: raise ValueError(f'Unknown filter type “{kind}”')
+	if negate: filt['negate'] = True
+	return filt
+
+
+def compare(op: Callable, a, b) -> bool:
+	try:
+		return a is not None and op(a, b)
+	except TypeError:  # e.g. comparing text with a number
+		return False
+
+
+def compile_filter(filt: dict, meta: dict) -> Callable[[dict], bool]:
+	'''Turn a filter entry into a predicate on file entries, resolving everything that doesn't depend on the file (like tag names) once up front.'''
+	kind = filt['type']
+	if kind == 'tag':
+		index = tag_index(meta, filt['tag'])
+		predicate = (lambda entry: index in entry.get('tags', ())) if index is not None else (lambda entry: False)
+	elif kind == 'prop':
+		prop, op, value = filt['prop'], OPERATORS[filt['op']], filt['value']
+		predicate = lambda entry: compare(op, entry.get('props', {}).get(prop), value)  # noqa: E731
+	elif kind == 'path':
+		pattern = filt['pattern']
+		predicate = lambda entry: fnmatchcase(entry['_path'], pattern)  # noqa: E731
+	elif kind == 'paths':
+		paths = frozenset(filt['paths'])
+		predicate = lambda entry: entry['_path'] in paths  # noqa: E731
+	elif kind == 'expr':
+		from query import compile_predicate, normalize, parse
+		predicate = compile_predicate(normalize(parse(filt['expr'])), meta)
+	else: raise ValueError(f'Unknown filter type “{kind}”')
+	if filt.get('negate'): return lambda entry: not predicate(entry)
+	return predicate
+
+
+def compile_filters(filters: List[dict], meta: dict) -> Callable[[dict], bool]:
+	predicates = [compile_filter(filt, meta) for filt in filters]
+	return lambda entry: all(predicate(entry) for predicate in predicates)
+
+
+def filter_files(files: Iterable[dict], filters: List[dict], meta: dict) -> Iterator[dict]:
+	'''Yield the entries of `files` that match every entry in `filters`, lazily, so results can be streamed.'''
+	if not filters: return iter(files)
+	return filter(compile_filters(filters, meta), files)
@@ -0,0 +1,95 @@
+'''Undo and redo for edits to a TagSpace.
+
+Snapshotting `tagviewer_meta` for every edit would cost memory proportional to the whole TagSpace per step. Instead, an edit is recorded as a short list of
+operations, each of which knows its own inverse and holds only what it changed: the dict it changed (shared with the live metadata, not copied), the key, and
+the old and new values. Undoing or redoing applies the (inverted) operations in place, in time proportional to the edit, and then announces the change to
+the model once (see ``model.files_changed``), so the filtered view is updated for just the edited files.
+
+Since operations hold the file entries themselves rather than their positions, an edit recorded before the files were sorted, or before the directory watcher
+added or removed other files, still undoes cleanly.'''
+
+from collections import deque
+from typing import Any, Iterable, NamedTuple, Optional, Tuple
+
+from model import files_changed
+from stateman import StateMan
+
+MISSING = object()  # the old or new value of a key that isn't there
+
+
+class SetValue(NamedTuple):
+	'''Change `target[key]` (in the file entry `entry` or its props) from `old` to `new`. Either may be `MISSING`, for a key being added or removed.'''
+	entry: dict
+	target: dict
+	key: Any
+	old: Any
+	new: Any
+
+	def apply(self):
+		if self.new is MISSING: self.target.pop(self.key, None)
+		else: self.target[self.key] = self.new
+
+	def inverse(self) -> 'SetValue':
+		return SetValue(self.entry, self.target, self.key, self.new, self.old)
+
+
+class Edit(NamedTuple):
+	label: str
+	operations: Tuple[SetValue, ...]
+
+
+def set_value(entry: dict, key: str, value) -> SetValue:
+	return SetValue(entry, entry, key, entry.get(key, MISSING), value)
+
+
+def set_tags(entry: dict, tags: Iterable[int]) -> SetValue:
+	return set_value(entry, 'tags', sorted(set(tags)))
+
+
+def set_prop(entry: dict, name: str, value) -> SetValue:
+	'''Set a prop of a file entry, or remove it if `value` is `MISSING`.'''
+	props = entry.setdefault('props', {})
+	return SetValue(entry, props, name, props.get(name, MISSING), value)
+
+
+class History:
+	'''The undo and redo stacks for the TagSpace open in `model`.\n
+	Arguments: `model` (StateMan) | Keyword Arguments: `limit` (int, how many edits can be undone, default 1000)'''
+	__slots__ = ['model', 'undo_stack', 'redo_stack']
+
+	def __init__(self, model: StateMan, limit: int=1000):
+		self.model = model
+		self.undo_stack = deque(maxlen=limit)
+		self.redo_stack = []
+
+	def edit(self, label: str, operations: Iterable[SetValue]):
+		'''Apply `operations` to the open TagSpace as one undoable edit called `label`.'''
+		operations = tuple(operations)
+		if not operations: return
+		for operation in operations: operation.apply()
+		self.undo_stack.append(Edit(label, operations))
+		self.redo_stack.clear()
+		files_changed(self.model, (operation.entry for operation in operations))
+
+	def undo(self) -> Optional[str]:
+		'''Undo the last edit and return its label, or return `None` if there's nothing to undo.'''
+		if not self.undo_stack: return None
+		edit = self.undo_stack.pop()
+		for operation in reversed(edit.operations): operation.inverse().apply()
+		self.redo_stack.append(edit)
+		files_changed(self.model, (operation.entry for operation in edit.operations))
+		return edit.label
+
+	def redo(self) -> Optional[str]:
+		'''Redo the last undone edit and return its label, or return `None` if there's nothing to redo.'''
+		if not self.redo_stack: return None
+		edit = self.redo_stack.pop()
+		for operation in edit.operations: operation.apply()
+		self.undo_stack.append(edit)
+		files_changed(self.model, (operation.entry for operation in edit.operations))
+		return edit.label
+
+	def clear(self):
+		'''Forget every edit, e.g. when another TagSpace is opened.'''
+		self.undo_stack.clear()
+		self.redo_stack.clear()
@@ -0,0 +1,202 @@
+'''Bulk import of media into a TagSpace.
+
+Files are copied into the TagSpace directory by a pool of worker threads. Each copy is hashed as it streams through, using zero-copy
+`os.copy_file_range`/`os.sendfile` where the platform has them, and the file's metadata is read in the same worker. Finished entries are handed back in
+batches so the TagSpace's `files` list changes a few times per import instead of once per file.
+
+Each file is copied to a temporary name and only renamed into place once it is complete, so cancelling an import (or crashing in the middle of one) never
+leaves a truncated file in the TagSpace. Every file that was renamed into place is also reported in a batch, so the files on disk and the entries in
+`files` stay in agreement.'''
+
+import hashlib
+import mmap
+import os
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from os import path
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+from jobs import Job
+from tagspace import new_file_entry
+
+try:
+	import gi
+	gi.require_version('GdkPixbuf', '2.0')
+	from gi.repository import GdkPixbuf
+except (ImportError, ValueError):
+	GdkPixbuf = None
+
+CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 256
+PART_SUFFIX = '.tvpart'
+
+
+class ImportResult(NamedTuple):
+	imported: List[dict]
+	failed: List[tuple]  # (source path, exception)
+	cancelled: bool
+
+
+def _zero_copy_fn():
+	if hasattr(os, 'copy_file_range'):
+		return lambda src_fd, dst_fd, offset, count: os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+	if sys.platform.startswith('linux'):  # sendfile to a regular file only works on Linux
+		return lambda src_fd, dst_fd, offset, count: os.sendfile(dst_fd, src_fd, offset, count)
+	return None
+
+
+_zero_copy = _zero_copy_fn()
+
+
+def _buffered_copy(fsrc, fdst, digest, job: Job):
+	buf = bytearray(CHUNK_SIZE)
+	view = memoryview(buf)
+	while n := fsrc.readinto(buf):
+		job.check()
+		digest.update(view[:n])
+		fdst.write(view[:n])
+
+
+def copy_and_hash(src: str, dst: str, job: Job) -> str:
+	'''Copy `src` to `dst` and return the BLAKE2b digest (hex) of the content.\n
+	Arguments: `src` (str), `dst` (str), `job` (the `Job` to check for cancellation)
+
+	With zero-copy available, the kernel copies each chunk and the digest is updated from a read-only mapping of the same range of the source, which is still
+	in the page cache at that point, so the data is never copied through a Python buffer. Otherwise, or if the filesystem refuses the zero-copy call, a single
+	reused buffer is read, hashed and written.'''
+	digest = hashlib.blake2b(digest_size=16)
+	with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+		size = os.fstat(fsrc.fileno()).st_size
+		if _zero_copy is None or size == 0:
+			_buffered_copy(fsrc, fdst, digest, job)
+			return digest.hexdigest()
+		with mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+			view = memoryview(mapping)
+			try:
+				offset = 0
+				while offset < size:
+					job.check()
+					try:
+						n = _zero_copy(fsrc.fileno(), fdst.fileno(), offset, min(CHUNK_SIZE, size - offset))
+					except OSError:  # e.g. EXDEV or ENOSYS on older kernels; finish the copy the slow way
+						n = 0
+					if n == 0: break
+					digest.update(view[offset:offset + n])
+					offset += n
+			finally:
+				view.release()
+		if offset < size:
+			fsrc.seek(offset)
+			fdst.seek(offset)
+			_buffered_copy(fsrc, fdst, digest, job)
+	return digest.hexdigest()
+
+
+def hash_file(filepath: str) -> str:
+	'''Return the same content digest as ``copy_and_hash`` for a file that is already in place.'''
+	digest = hashlib.blake2b(digest_size=16)
+	buf = bytearray(CHUNK_SIZE)
+	view = memoryview(buf)
+	with open(filepath, 'rb') as f:
+		while n := f.readinto(buf): digest.update(view[:n])
+	return digest.hexdigest()
+
+
+def read_metadata(filepath: str) -> dict:
+	'''Read the metadata TagViewer keeps for a file: size, modification time and, for images GdkPixbuf understands, the resolution.'''
+	stat = os.stat(filepath)
+	meta = {'_size': stat.st_size, '_mtime_ns': stat.st_mtime_ns}
+	if GdkPixbuf is not None:
+		info = GdkPixbuf.Pixbuf.get_file_info(filepath)
+		if info is not None and info[0] is not None: meta['_resolution'] = [info[1], info[2]]
+	return meta
+
+
+def _choose_destinations(dirname: str, sources: List[str]) -> List[str]:
+	'''Pick a unique name in the TagSpace for every source, appending " (n)" on collisions with existing files or other sources.'''
+	taken = set(os.listdir(dirname))
+	destinations = []
+	for src in sources:
+		stem, ext = path.splitext(path.basename(src))
+		name, n = stem + ext, 1
+		while name in taken or name + PART_SUFFIX in taken:
+			name = f'{stem} ({n}){ext}'
+			n += 1
+		taken.add(name)
+		destinations.append(name)
+	return destinations
+
+
+def _import_one(src: str, dirname: str, name: str, job: Job) -> dict:
+	dst = path.join(dirname, name)
+	part = dst + PART_SUFFIX
+	try:
+		content_hash = copy_and_hash(src, part, job)
+		os.replace(part, dst)
+	except BaseException:
+		try:
+			os.remove(part)
+		except OSError:
+			pass
+		raise
+	return new_file_entry(name, _hash=content_hash, **read_metadata(dst))
+
+
+def import_media(job: Job, dirname: str, sources: Iterable[str], on_batch: Callable[[List[dict]], None], workers: Optional[int]=None) -> ImportResult:
+	'''Copy `sources` into the TagSpace in `dirname`. Meant to be the target of a `Job`.\n
+	Arguments: `job` (Job), `dirname` (str), `sources` (paths of the files to import), `on_batch` (function taking a list of new `files` entries) | Keyword
+	Arguments: `workers` (int, default depends on the CPU count)
+
+	`on_batch` is called through the job's dispatcher with up to `BATCH_SIZE` entries at a time, in the order the sources were given; a file that fails to
+	copy is skipped and reported in the result. Only a bounded window of files is in flight at once, so memory use doesn't grow with the size of the import.'''
+	sources = list(sources)
+	destinations = _choose_destinations(dirname, sources)
+	workers = workers or min(8, (os.cpu_count() or 1) + 2)
+	window = workers * 4
+	total = len(sources)
+	results = [None] * total
+	imported, failed, batch = [], [], []
+	next_to_emit = 0
+	cancelled = False
+
+	def flush():
+		nonlocal batch
+		if batch:
+			job.dispatch(on_batch, batch)
+			batch = []
+
+	with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='import') as pool:
+		pending = {}
+		queued = 0
+		while queued < total or pending:
+			while queued < total and len(pending) < window and not job.cancelled:
+				pending[pool.submit(_import_one, sources[queued], dirname, destinations[queued], job)] = queued
+				queued += 1
+			if not pending: break  # cancelled before anything else was queued
+			done, _ = wait(pending, return_when=FIRST_COMPLETED)
+			for future in done:
+				index = pending.pop(future)
+				error = future.exception()
+				results[index] = error if error is not None else future.result()
+			# emit in source order so the TagSpace ends up in the order the user selected
+			while next_to_emit < total and results[next_to_emit] is not None:
+				result = results[next_to_emit]
+				results[next_to_emit] = True
+				if isinstance(result, dict):
+					imported.append(result)
+					batch.append(result)
+					if len(batch) >= BATCH_SIZE: flush()
+				elif not job.cancelled:
+					failed.append((sources[next_to_emit], result))
+				next_to_emit += 1
+			job.progress(next_to_emit, total, destinations[next_to_emit - 1] if next_to_emit else '')
+			if job.cancelled:
+				cancelled = True
+				queued = total  # stop queueing; the loop exits once the in-flight copies have finished or been cleaned up
+	if cancelled:  # files that finished after an earlier one was cancelled are still real files in the TagSpace, so they get entries too
+		for result in results[next_to_emit:]:
+			if isinstance(result, dict):
+				imported.append(result)
+				batch.append(result)
+	flush()
+	return ImportResult(imported, failed, cancelled)
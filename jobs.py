@@ -0,0 +1,96 @@
+'''Background jobs: long-running work on a worker thread, with progress reporting and cancellation.
+
+Callbacks given to a `Job` are never called on the worker thread. They go through `dispatch`, which the GTK frontend sets to a `GLib.idle_add` wrapper so
+they run on the main loop; headless users can leave the default, which calls them directly.'''
+
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from tracing import tracer
+
+_active_lock = threading.Lock()
+_active = set()
+
+
+class JobCancelled(Exception):
+	pass
+
+
+def _call_directly(fn, *args):
+	fn(*args)
+
+
+def active_jobs() -> int:
+	'''The number of jobs that have been started and have not finished yet.'''
+	with _active_lock:
+		return len(_active)
+
+
+class Job:
+	'''A unit of background work.\n
+	Arguments: `name` (str), `target` (function taking the job and returning the result) | Keyword Arguments: `dispatch`, `on_progress` (function taking the
+	job, the amount done, the total and a message), `on_done` (function taking the job and the result), `on_error` (function taking the job and the exception)
+
+	`target` should call ``check`` regularly so that a cancellation is noticed. A cancelled target may either raise `JobCancelled` (through ``check``), in
+	which case `on_done` gets `None`, or return a partial result itself if it needs to report what was finished before the cancellation.'''
+	__slots__ = ['name', 'target', 'dispatch', 'on_progress', 'on_done', 'on_error', 'thread', '_cancel', '_last_progress']
+
+	progress_interval = 0.05  # seconds; progress reports more frequent than this are dropped so that the main loop isn't flooded
+
+	def __init__(self, name: str, target: Callable[['Job'], Any], dispatch: Callable=_call_directly, on_progress: Optional[Callable]=None,
+	             on_done: Optional[Callable]=None, on_error: Optional[Callable]=None):
+		self.name = name
+		self.target = target
+		self.dispatch = dispatch
+		self.on_progress = on_progress
+		self.on_done = on_done
+		self.on_error = on_error
+		self.thread = None
+		self._cancel = threading.Event()
+		self._last_progress = 0.0
+
+	def start(self) -> 'Job':
+		with _active_lock:
+			_active.add(self)
+		self.thread = threading.Thread(target=self._run, name=f'job: {self.name}', daemon=True)
+		self.thread.start()
+		return self
+
+	def cancel(self):
+		self._cancel.set()
+
+	@property
+	def cancelled(self) -> bool:
+		return self._cancel.is_set()
+
+	def check(self):
+		'''Raise `JobCancelled` if the job has been cancelled. Call this from the target between units of work.'''
+		if self._cancel.is_set(): raise JobCancelled(self.name)
+
+	def progress(self, done: int, total: int, message: str='', force: bool=False):
+		'''Report progress. Reports are throttled to `progress_interval` unless `force` is given, and the final one (`done == total`) always goes through.'''
+		if self.on_progress is None: return
+		now = time.monotonic()
+		if force or done >= total or now - self._last_progress >= self.progress_interval:
+			self._last_progress = now
+			self.dispatch(self.on_progress, self, done, total, message)
+
+	def wait(self, timeout: Optional[float]=None):
+		if self.thread is not None: self.thread.join(timeout)
+
+	def _run(self):
+		try:
+			with tracer.span(f'Job: {self.name}'):
+				result = self.target(self)
+		except JobCancelled:
+			result = None
+		except Exception as e:
+			with _active_lock:
+				_active.discard(self)
+			if self.on_error is not None: self.dispatch(self.on_error, self, e)
+			else: raise
+			return
+		with _active_lock:
+			_active.discard(self)
+		if self.on_done is not None: self.dispatch(self.on_done, self, result)
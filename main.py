@@ -2,14 +2,12 @@ import json
 import os
 import subprocess
 import traceback
-from enum import Enum
-from enum import auto as enumauto
 from operator import itemgetter
 from os import path
 import platform
-from send2trash import send2trash
 from shutil import copyfile
 import sys
+import time
 from pathlib import Path
 from threading import Timer
 from typing import Callable, Optional
@@ -18,36 +16,38 @@ import appdirs
 import gi
 import toml
 
-from stateman import StateMan
+import dupes
+import importer
+import reconcile
+import snapshot
+import trash
+import vacuum
+from filters import coerce_value
+from history import MISSING, History, set_prop, set_tags, set_value
+from jobs import Job, active_jobs
+from membudget import MiB, MemoryBudget, StateManCacheAdapter
+from model import BuiltinSortProps, SortMethods, create_model, files_changed, replace_files  # noqa: F401
+from query import QueryEngine
+from search_index import SearchIndex
+from tagspace import assign_ids, is_tagspace, load_sidecar, load_tagspace, meta_path, save_tagspace, update_sidecar
+from tracing import default_output, tracer
 
 gi.require_version("Gtk", "3.0")
 gi.require_version("Gdk", "3.0")
 
-from gi.repository import Gdk, Gtk, GdkPixbuf, GLib  # noqa: E402
+from gi.repository import Gdk, Gio, Gtk, GdkPixbuf, GLib  # noqa: E402
+
+from media import MediaLoader  # noqa: E402
 
 VERSION = '2.0.0a'
+SAVE_DELAY_MS = 1000  # changes made within this long of each other are written to tagviewer.json together
+READOUT_INTERVAL_MS = 500  # how often the performance readout is refreshed
 
 
 class ConfigError(Exception):
 	pass
 
 
-class BuiltinSortProps(Enum):
-	INTRINSIC = enumauto()
-	TITLE = enumauto()
-	SIZE = enumauto()
-	RESOLUTION = enumauto()
-
-
-class SortMethods(Enum):
-	SORT_AZ = enumauto()
-	SORT_ZA = enumauto()
-	SORT_19 = enumauto()
-	SORT_91 = enumauto()
-	SORT_TF = enumauto()
-	SORT_FT = enumauto()
-
-
 def convert_list_store_to_list(list_store):
 	return list(map(list, list_store))
 
@@ -65,9 +65,21 @@ def open_file(filename: str):
 		raise OSError(f"No suitable file opening utility was found for your operating system. Please open the file manually; the path is “{filename}”.")
 
 
-def trash_dir_contents(dirname: str):
-	for entname in Path(dirname).glob('*'):
-		send2trash(str(entname.resolve()))
+def current_rss() -> Optional[int]:
+	'''Return the resident set size of the process in bytes, or `None` where it can't be read cheaply (it's read from `/proc`).'''
+	try:
+		with open('/proc/self/statm') as statm:
+			return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+def idle_dispatch(fn, *args):
+	'''Job dispatcher that runs the callback on the GTK main loop.'''
+	def call():
+		fn(*args)
+		return False
+	GLib.idle_add(call)
 
 
 def debounce(wait):
@@ -112,6 +124,7 @@ class SettingsWindow(Gtk.Dialog):
 		self.model.append(tagspace_defaults_parent, ['Tags'])
 		self.model.append(tagspace_defaults_parent, ['Props'])
 		self.model.append(behavior_parent, ['Slideshow'])
+		self.model.append(None, ['Performance'])
 
 		self.tree = Gtk.TreeView(model=self.model)
 		self.tree.append_column(Gtk.TreeViewColumn('Name', Gtk.CellRendererText(), text=0))
@@ -268,6 +281,27 @@ class SettingsWindow(Gtk.Dialog):
 			 'Should the slideshow be stopped when the last item is reached? If false, keep going, wrapping back around to the first item.'),
 		)
 
+		def set_memory_budget(val):
+			self.conf.setdefault('performance', {})['memory_budget'] = int(val)
+			parent.memory_budget.limit = int(val) * MiB
+			parent.memory_budget.enforce()
+		def set_trace(val):
+			self.conf.setdefault('performance', {})['trace'] = val
+			if val and not tracer.enabled: tracer.enable(tracer.output or default_output())
+			elif not val and tracer.enabled: tracer.disable()
+		def set_readout(val):
+			self.conf.setdefault('performance', {})['readout'] = val
+			parent.set_performance_readout(val)
+		performance_box = generate_settings_panel('Performance Settings',
+			('Memory Budget (MiB)', 'int', (16, None, 1), self.conf.get('performance', {}).get('memory_budget', 512), set_memory_budget,
+			 'How much memory the in-memory caches (decoded media, indexes, ...) may use together. Beyond this the least valuable entries are dropped.'),
+			('Record Trace', 'switch', None, tracer.enabled, set_trace,
+			 'Record a timeline of where time goes (loading, updates, decoding, layout) and write it to the cache directory as a Chrome trace when tracing '
+			 'is turned off or TagViewer exits. Open it in Perfetto (ui.perfetto.dev) or chrome://tracing.'),
+			('Performance Readout', 'switch', None, self.conf.get('performance', {}).get('readout', False), set_readout,
+			 'Show navigation latency, decode time, prefetch hit rate, filter time, background jobs and memory use in the status bar.'),
+		)
+
 		self.stack_pages = {
 			'UI': ui_box,
 			'Center Toolbar Items': center_toolbar_items_box,
@@ -275,7 +309,8 @@ class SettingsWindow(Gtk.Dialog):
 			'History': history_box,
 			'Tags': default_tags_box,
 			'Props': default_props_box,
-			'Slideshow': slideshow_box
+			'Slideshow': slideshow_box,
+			'Performance': performance_box
 		}
 
 		self.content_stack = Gtk.Stack()
@@ -381,11 +416,20 @@ class MainWindow(Gtk.Window):
 	def __init__(self):
 		Gtk.Window.__init__(self, title=f"TagViewer {VERSION}")
 		self.set_default_size(1000, 600)
+		self.watcher = None
+		self.save_timer = None
+		self.unsaved_directory = None  # the TagSpace with changes that haven't been written yet
+		self.meta_written = None  # `snapshot.source_stat` of the open TagSpace's tagviewer.json when it was last loaded or written
+		self.search_sync = None  # the running search index sync Job
+		self.search_sync_queued = False
 
 		if not path.exists(appdirs.user_config_dir('tagviewer')): os.mkdir(appdirs.user_config_dir('tagviewer'))
 		if not path.exists(appdirs.user_cache_dir('tagviewer')): os.mkdir(appdirs.user_cache_dir('tagviewer'))
 		self.load_config()
 		self.load_cache()
+		if self.config.get('performance', {}).get('trace', False): tracer.enable()
+		if tracer.enabled and tracer.output is None: tracer.output = default_output()
+		self.connect('realize', lambda *_: self.trace_frames(self.get_frame_clock()))
 
 		css_provider = Gtk.CssProvider()
 		css_provider.load_from_path('main.css')
@@ -408,34 +452,27 @@ class MainWindow(Gtk.Window):
 				raise  # other `GLib.Error`s should be treated normally
 		context.add_provider_for_screen(Gdk.Screen.get_default(), css_provider_2, Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION + 1)
 
-		self.state = StateMan({
-			'tagviewer_meta': {},
-			'files': (lambda model: model['tagviewer_meta']['files'] if 'files' in model['tagviewer_meta'] else [], ('tagviewer_meta',)),
-			'open_directory': None,
-			'media_number': 1,
-			'filters': [],
-			'sort_options': None,
+		self.memory_budget = MemoryBudget(self.config.get('performance', {}).get('memory_budget', 512) * MiB)
+		self.state = create_model({
 			'is_fullscreen': False,
 			'dark_mode': self.config['ui']['dark'],
 			'injections': self.config['ui']['injections'],
 			'slideshow_active': False,
-			'filters_active': (lambda model: len(model['filters']) > 0, ('filters',)),
-			'num_of_files': (lambda model: len(model['files']), ('files',)),
-			'file_paths': (lambda model: [x['_path'] for x in model['files']], ('files',)),
-			'tagspace_is_open': (lambda model: model['open_directory'] is not None, ('open_directory',)),
-			'media_is_open': (lambda model: model['tagspace_is_open'] and ('_path' in model['current_item']
-			                  or model['filters_active'] or len(model['files']) == 0),
-			                  ('tagspace_is_open', 'current_item', 'filters_active', 'files')),
-			'can_go_previous': (lambda model: model['media_number'] > 1, ('media_number',)),
-			'can_go_next': (lambda model: len(model['files']) > 0 and len(model['files']) > model['media_number'], ('files', 'media_number')),
-			# ↓ deps doesn't include `files` intentionally!
-			'current_item': (lambda model: model['files'][model['media_number'] - 1] if model['num_of_files'] >= model['media_number'] else {}, ('media_number',)),
-			'current_path': (lambda model: model['current_item']['_path'] if model['media_is_open'] else None, ('current_item', 'media_is_open')),
-			'current_tags': (lambda model: [model['tagviewer_meta']['tagList'][x] for x in model['current_item']['tags']] if 'tagList' in model['tagviewer_meta'] else [],
-			                 ('current_item', 'tagviewer_meta'))
-		}, refs={'win': self, 'conf': self.config, 'cache': self.cache, 'settings': Gtk.Settings.get_default(), 'injections_provider': css_provider_2})
+		}, refs={'win': self, 'conf': self.config, 'cache': self.cache, 'settings': Gtk.Settings.get_default(), 'injections_provider': css_provider_2,
+		         'query_engine': QueryEngine(self.memory_budget)}, tracer=tracer)
 		# self.state.bind_all(lambda event, model, propname: print(f'{propname} [{event}]: {model[propname]}'))
 
+		StateManCacheAdapter(self.state, self.memory_budget, aliases=('current_item', 'visible_positions'),  # an entry of `files`; a memoized filter result
+		                     dispatch=idle_dispatch)
+		self.media_loader = MediaLoader(self.memory_budget, idle_dispatch)
+		if hasattr(Gio, 'MemoryMonitor'):  # GLib 2.64+
+			self.memory_monitor = Gio.MemoryMonitor.dup_default()
+			def handle_low_memory(monitor, level):
+				if level >= Gio.MemoryMonitorWarningLevel.CRITICAL: self.memory_budget.shrink(0)
+				elif level >= Gio.MemoryMonitorWarningLevel.MEDIUM: self.memory_budget.shrink(0.25)
+				else: self.memory_budget.shrink(0.5)
+			self.memory_monitor.connect('low-memory-warning', handle_low_memory)
+
 		def handle_fullscreen_change(model, _):
 			if model['is_fullscreen']:
 				model.refs['win'].top_bar_items['fullscreen_toggle_button'].get_icon_widget()\
@@ -516,6 +553,14 @@ class MainWindow(Gtk.Window):
 			self.top_bar.insert(item, self.top_bar.get_n_items())
 			return item
 
+		def add_toolbar_search():
+			entry = Gtk.SearchEntry()
+			entry.set_placeholder_text('Search all TagSpaces')
+			item = Gtk.ToolItem()
+			item.add(entry)
+			self.top_bar.insert(item, self.top_bar.get_n_items())
+			return item
+
 		def add_toolbar_separator():
 			separator = Gtk.SeparatorToolItem()
 			separator.set_draw(True)
@@ -556,6 +601,7 @@ class MainWindow(Gtk.Window):
 			'settings_button': add_toolbar_button('Settings', 'settings'),
 			'about_button': add_toolbar_button('About TagViewer', 'info'),
 			'help_button': add_toolbar_button('TagViewer Help', 'help'),
+			'search_entry': add_toolbar_search(),
 			'separator6': add_toolbar_separator(),
 			'fullscreen_toggle_button': add_toolbar_button('Toggle Fullscreen', 'fullscreen'),
 			'dark_mode_toggle_button': add_toolbar_button('Light/Dark Mode', 'invert_colors'),
@@ -587,6 +633,32 @@ class MainWindow(Gtk.Window):
 
 		self.top_bar_items['new_tagspace_button'].connect('clicked', lambda widget: self.new_tagspace())
 
+		self.top_bar_items['add_media_button'].connect('clicked', lambda widget: self.add_media())
+
+		self.search_index = SearchIndex()
+		self.search_results = Gtk.ListBox()
+		self.search_results.set_selection_mode(Gtk.SelectionMode.NONE)
+		self.search_popover = Gtk.Popover(relative_to=self.top_bar_items['search_entry'])
+		self.search_popover.set_modal(False)
+		search_scroller = Gtk.ScrolledWindow(propagate_natural_height=True, max_content_height=400, hscrollbar_policy=Gtk.PolicyType.NEVER)
+		search_scroller.add(self.search_results)
+		self.search_popover.add(search_scroller)
+		self.top_bar_items['search_entry'].get_child().connect('search-changed', lambda entry: self.show_search_results(entry.get_text()))
+		self.search_results.connect('row-activated', lambda listbox, row: self.go_to_item(row.hit.tagspace, row.hit.path))
+		self.sync_search_index()
+
+		self.top_bar_items['delete_media_button'].connect('clicked', lambda widget: self.delete_media([self.state['current_item']]))
+
+		def handle_current_path_change(model, _):
+			model.refs['win'].top_bar_items['delete_media_button'].set_sensitive(model['current_path'] is not None)
+		self.state.bind('current_path', handle_current_path_change)
+		self.state.bind('current_path', lambda model, _: model.refs['win'].show_media())
+
+		def handle_tagspace_open_change(model, _):
+			model.refs['win'].top_bar_items['add_media_button'].set_sensitive(model['tagspace_is_open'])
+			model.refs['win'].find_duplicates_button.set_sensitive(model['tagspace_is_open'])
+		self.state.bind('tagspace_is_open', handle_tagspace_open_change)
+
 		self.about_dialog = Gtk.AboutDialog()
 		self.about_dialog.set_program_name('TagViewer 2')
 		self.about_dialog.set_version(VERSION)
@@ -630,14 +702,39 @@ class MainWindow(Gtk.Window):
 		self.content.set_halign(Gtk.Align.CENTER)
 		self.content.set_valign(Gtk.Align.CENTER)
 
-		self.content.add(Gtk.Label(label="content"))
+		self.media_view = Gtk.Image()
+		self.content.add(self.media_view)
 
 		self.aside = Gtk.Notebook()
 
 		self.aside.set_show_border(False)
 
-		self.aside.append_page(Gtk.Label(label='(properties)'), Gtk.Label(label='properties'))
-		self.aside.append_page(Gtk.Label(label='(filters)'), Gtk.Label(label='filters'))
+		self.properties_page = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=6)
+		self.properties_queued = False
+		properties_scroller = Gtk.ScrolledWindow(hscrollbar_policy=Gtk.PolicyType.NEVER)
+		properties_scroller.add(self.properties_page)
+		self.aside.append_page(properties_scroller, Gtk.Label(label='properties'))
+		def queue_show_properties(model, _):
+			win = model.refs['win']
+			if not win.properties_queued:  # rebuilt once the handler of the edit that caused it has returned
+				win.properties_queued = True
+				GLib.idle_add(win.show_properties)
+		self.state.bind('current_tags', queue_show_properties)
+		self.filters_page = Gtk.Box(orientation=Gtk.Orientation.VERTICAL)
+		self.filters_page.pack_start(Gtk.Label(label='(filters)'), True, True, 0)
+		self.find_duplicates_button = Gtk.Button(label='Find Duplicates')
+		self.find_duplicates_button.set_tooltip_text('Show only media that has an exact or near duplicate in this TagSpace')
+		self.find_duplicates_button.set_sensitive(False)
+		self.find_duplicates_button.connect('clicked', lambda widget: self.find_duplicates())
+		self.filters_page.pack_end(self.find_duplicates_button, False, False, 0)
+		self.vacuum_button = Gtk.Button(label='Compact Tags')
+		self.vacuum_button.set_tooltip_text('Remove deleted tags from this TagSpace for good')
+		self.vacuum_button.set_sensitive(False)
+		self.vacuum_button.connect('clicked', lambda widget: self.vacuum_tags())
+		self.filters_page.pack_end(self.vacuum_button, False, False, 0)
+		self.state.bind(['tagspace_is_open', 'tagviewer_meta'],
+		                lambda model, _: model.refs['win'].vacuum_button.set_sensitive(model['tagspace_is_open'] and bool(model['tagviewer_meta'].get('deletedTags'))))
+		self.aside.append_page(self.filters_page, Gtk.Label(label='filters'))
 
 		self.middle_pane.pack1(self.file_list, resize=False, shrink=True)
 		self.middle_pane_child.pack1(self.content, resize=True, shrink=False)
@@ -667,11 +764,39 @@ class MainWindow(Gtk.Window):
 
 		self.base.pack_start(self.middle_pane, True, True, 0)
 
+		self.history = History(self.state)
+		accelerators = Gtk.AccelGroup()
+		accelerators.connect(Gdk.KEY_z, Gdk.ModifierType.CONTROL_MASK, 0, lambda *_: self.undo() or True)
+		accelerators.connect(Gdk.KEY_z, Gdk.ModifierType.CONTROL_MASK | Gdk.ModifierType.SHIFT_MASK, 0, lambda *_: self.redo() or True)
+		accelerators.connect(Gdk.KEY_y, Gdk.ModifierType.CONTROL_MASK, 0, lambda *_: self.redo() or True)
+		self.add_accel_group(accelerators)
+
 		self.status_bar = Gtk.Box()
-		self.status_bar.add(Gtk.Label(label="test"))
+		self.performance_label = Gtk.Label()
+		self.performance_label.set_no_show_all(True)
+		self.performance_label.set_tooltip_text('Navigation: from moving to an item to its media being shown\nDecode: decoding the current media\n'
+		                                        'Prefetch: media already decoded when it was shown\nFilter: the last filter evaluation not answered from the cache\n'
+		                                        'Jobs: background jobs running or queued\nRSS: memory used by TagViewer')
+		self.status_bar.pack_start(self.performance_label, False, False, 6)
+		self.performance_timer = None
+		self.navigation_start = None
+		self.last_navigation_time = None  # from changing the current item to its media being shown, in seconds
+
+		def navigation_started(model, prop):
+			if model['current_id'] is not None: self.navigation_start = time.perf_counter()  # not when a TagSpace is opened or closed
+		self.state.bind('current_id', navigation_started)
+		self.set_performance_readout(self.config.get('performance', {}).get('readout', False))
+		self.status_jobs = Gtk.Box(spacing=6)
+		self.status_bar.pack_end(self.status_jobs, False, False, 0)
+		self.memory_label = Gtk.Label()
+		self.status_bar.pack_end(self.memory_label, False, False, 6)
+		self.update_memory_label()
+		GLib.timeout_add_seconds(2, self.update_memory_label)
 		self.base.pack_start(self.status_bar, False, False, 0)
 
 		self.add(self.base)
+		if self.config['behavior']['history']['auto_resume'] and self.cache.get('open_directory') is not None:
+			GLib.idle_add(self.resume_tagspace)
 
 	def load_config(self):
 		if path.exists(path.join(appdirs.user_config_dir('tagviewer'), 'config.toml')):
@@ -725,7 +850,8 @@ class MainWindow(Gtk.Window):
 					elif response == 2:  # retry
 						continue
 					elif response == 3:  # use anyway
-						trash_dir_contents(dirname)
+						cancelled = True
+						self.clear_directory_for_tagspace(dirname)
 						break
 				else:
 					nonempty_warn_dialog = Gtk.MessageDialog(message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.NONE, text="The directory you selected has contents.")
@@ -741,24 +867,30 @@ class MainWindow(Gtk.Window):
 					elif response == 1:  # retry
 						continue
 					elif response == 2:  # use anyway
-						trash_dir_contents(dirname)
+						cancelled = True
+						self.clear_directory_for_tagspace(dirname)
 						break
 			else: break
 
 		if not cancelled:
 			NewTagSpaceWindow(self, self.config, self.state, dirname)
 
+	def clear_directory_for_tagspace(self, dirname):
+		'''Move the contents of `dirname` to the trash, then set up a new TagSpace there. If it's the open TagSpace, that's closed first, or saving it would
+		write its tagviewer.json back.'''
+		if self.state['open_directory'] == str(Path(dirname).resolve()): self.close_tagspace()
+		self.trash_paths(trash.dir_contents(dirname), lambda: NewTagSpaceWindow(self, self.config, self.state, dirname))
+
 	def _create_tagspace(self, dirname, title, desc, tags, props):
-		with open(path.join(dirname, 'tagviewer.json'), 'w') as jsonfile:
-			json.dump({
-				'title': title,
-				'description': desc,
-				'tagList': tags,
-				'deletedTags': [],
-				'propList': props,
-				'files': [],
-				'currentIndex': 0
-			}, jsonfile)
+		save_tagspace(dirname, {
+			'title': title,
+			'description': desc,
+			'tagList': tags,
+			'deletedTags': [],
+			'propList': props,
+			'files': [],
+			'currentIndex': 0
+		})
 
 	def open_tagspace(self):
 		cancelled = False
@@ -772,7 +904,7 @@ class MainWindow(Gtk.Window):
 				cancelled = True
 				break
 			elif response == 0:  # open
-				if (Path(dirname) / 'tagviewer.json').exists():  # continue
+				if Path(meta_path(dirname)).exists():  # continue
 					break
 				else:
 					not_a_tagspace_dialog = Gtk.MessageDialog(message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.NONE, text="The directory you selected is not a TagSpace.")
@@ -793,17 +925,445 @@ class MainWindow(Gtk.Window):
 		if not cancelled:
 			self._open_tagspace(dirname)
 
-	def _open_tagspace(self, dirname):
+	def resume_tagspace(self):
+		'''Reopen the TagSpace that was open when TagViewer last exited, from its snapshot if it's still up to date.'''
+		dirname = self.cache['open_directory']
+		if is_tagspace(dirname): self._open_tagspace(dirname, resume=True)
+		return False
+
+	def _open_tagspace(self, dirname, resume: bool=False):
+		'''Open the TagSpace in `dirname`. With `resume`, it's loaded from the snapshot written on exit (see `snapshot`) if that matches `tagviewer.json`.'''
+		self.flush_save()
 		dirpath = Path(dirname).resolve()
-		with open(str(dirpath / 'tagviewer.json'), 'r') as meta_file:
-			self.state['tagviewer_meta'] = json.load(meta_file)
-		self.state['open_directory'] = str(dirpath)
+		if self.watcher is not None:
+			self.watcher.stop()
+			self.watcher = None
+		self.history.clear()
+		self.state['current_id'] = None
+		with tracer.span('Open TagSpace', path=dirpath):
+			meta = None
+			numbered = False
+			self.meta_written = snapshot.source_stat(str(dirpath))  # before reading, so a change made meanwhile shows as one
+			if resume:
+				with tracer.span('Load snapshot'):
+					meta = snapshot.resume(self.snapshot_path(), str(dirpath), self.state)
+			if meta is None:
+				with tracer.span('Load tagviewer.json'):
+					meta = load_tagspace(str(dirpath), number=False)
+					numbered = assign_ids(meta)
+			self.state['tagviewer_meta'] = meta
+			self.state['open_directory'] = str(dirpath)
+			if numbered: self.save_tagspace()  # the new IDs have to be on disk before a snapshot can be taken
+			self._reconcile_tagspace(str(dirpath))
+			self.sync_search_index()
+
+	def close_tagspace(self):
+		'''Close the open TagSpace without saving it, e.g. before its directory is cleared.'''
+		if self.save_timer is not None:
+			GLib.source_remove(self.save_timer)
+			self.save_timer = None
+		self.unsaved_directory = None
+		self.meta_written = None
+		if self.watcher is not None:
+			self.watcher.stop()
+			self.watcher = None
+		self.history.clear()
+		self.state['current_id'] = None
+		self.state['open_directory'] = None
+		self.state['tagviewer_meta'] = {}
+
+	def _reconcile_tagspace(self, dirname):
+		'''Bring `files` up to date with the directory in the background, then keep it up to date by watching the directory.'''
+		files = list(self.state['files'])
+
+		def scan(job):
+			previous = load_sidecar(dirname).get('snapshot')
+			snapshot = reconcile.scan(dirname, previous)
+			job.check()
+			return snapshot, reconcile.diff(files, previous, snapshot, dirname)
+		def apply(changes, snapshot=None):
+			if changes.removed: replace_files(self.state, reconcile.apply_changes(self.state['files'], changes, snapshot))
+			else: files_changed(self.state, *reconcile.edit_entries(self.state['files'], changes, snapshot))  # keeps the indexes and filter results
+			self.save_tagspace()
+		def scanned(job, result):
+			if result is None or self.state['open_directory'] != dirname: return
+			snapshot, changes = result
+			if changes: apply(changes, snapshot)
+			def store_snapshot(sidecar):
+				sidecar['snapshot'] = snapshot
+			update_sidecar(dirname, store_snapshot)
+			if self.watcher is not None: self.watcher.stop()  # the same TagSpace was opened again while it was being scanned
+			self.watcher = reconcile.TagSpaceWatcher(dirname, changes_seen)
+		def changes_seen(touched, moves):
+			if self.state['open_directory'] != dirname: return
+			changes = reconcile.changes_for_paths(self.state['files'], touched, moves, dirname)
+			if changes: apply(changes)
+		self.run_job('Checking for changes', scan, scanned)
+
+	def vacuum_tags(self):
+		'''Remove the deleted tags from the open TagSpace for good in the background (see `vacuum`), after asking, since it can't be undone.'''
+		dirname = self.state['open_directory']
+		meta = self.state['tagviewer_meta']
+		msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.QUESTION, buttons=Gtk.ButtonsType.OK_CANCEL,
+		                        text=f'Remove {len(set(meta.get("deletedTags", ())))} deleted tags for good?')
+		msg.format_secondary_text('The tag list is compacted and tagviewer.json rewritten. Edits made so far can no longer be undone.')
+		response = msg.run()
+		msg.destroy()
+		if response != Gtk.ResponseType.OK: return
+
+		def vacuumed(job, result):
+			if result is None or self.state['open_directory'] != dirname or self.state['tagviewer_meta'] is not meta: return
+			if not vacuum.apply(meta, result):
+				msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.OK,
+				                        text='The tags changed while they were being compacted.')
+				msg.format_secondary_text('Nothing was changed. Compact the tags again to try once more.')
+				msg.run()
+				msg.destroy()
+				return
+			self.history.clear()  # the recorded tags are indices into the old tag list
+			self.state._handle_change('tagviewer_meta')
+			self.save_tagspace()
+		self.run_job('Compacting tags', lambda job: vacuum.compute(job, meta), vacuumed)
+
+	def trace_frames(self, frame_clock: Gdk.FrameClock):
+		'''Record GTK's layout and paint phases of each frame as spans. The handlers run after GTK's own, so layout is timed from the end of the update
+		phase to the end of the layout phase, and paint from there to the end of the paint phase.'''
+		phase_start = [0]
+		def mark(*_):
+			if tracer.enabled: phase_start[0] = time.perf_counter_ns()
+		def end_phase(_, name):
+			if tracer.enabled and phase_start[0]:
+				now = time.perf_counter_ns()
+				tracer.complete(name, phase_start[0], now)
+				phase_start[0] = now
+		frame_clock.connect_after('update', mark)
+		frame_clock.connect_after('layout', end_phase, 'GTK layout')
+		frame_clock.connect_after('paint', end_phase, 'GTK paint')
+		frame_clock.connect_after('after-paint', lambda *_: phase_start.__setitem__(0, 0))
+
+	def update_memory_label(self):
+		usage = self.memory_budget.usage()
+		self.memory_label.set_text(f'{sum(usage.values()) / MiB:.0f} of {self.memory_budget.limit / MiB:.0f} MiB')
+		self.memory_label.set_tooltip_text('Memory used by caches:\n' + '\n'.join(f'{name}: {size / MiB:.1f} MiB' for (name, size) in usage.items()))
+		return True
+
+	def set_performance_readout(self, visible: bool):
+		'''Show or hide the performance readout in the status bar. It's only refreshed while it's shown.'''
+		self.performance_label.set_visible(visible)
+		if visible and self.performance_timer is None:
+			self.update_performance_label()
+			self.performance_timer = GLib.timeout_add(READOUT_INTERVAL_MS, self.update_performance_label)
+		elif not visible and self.performance_timer is not None:
+			GLib.source_remove(self.performance_timer)
+			self.performance_timer = None
+
+	def update_performance_label(self):
+		if not self.performance_label.get_mapped(): return True  # e.g. the window is hidden
+
+		def ms(seconds: Optional[float]) -> str:
+			return '–' if seconds is None else f'{seconds * 1000:.0f} ms'
+		cache = self.media_loader.cache
+		lookups = cache.hits + cache.misses
+		rss = current_rss()
+		self.performance_label.set_text('  '.join((
+			f'Nav {ms(self.last_navigation_time)}',
+			f'Decode {ms(self.media_loader.last_decode_time)}',
+			f'Prefetch {cache.hits / lookups:.0%}' if lookups else 'Prefetch –',
+			f'Filter {ms(self.state.refs["query_engine"].last_evaluation_time)}',
+			f'Jobs {active_jobs()}',
+			f'RSS {"–" if rss is None else f"{rss / MiB:.0f} MiB"}',
+		)))
+		return True
+
+	def show_media(self):
+		current_path = self.state['current_path']
+		if current_path is None:
+			self.media_view.clear()
+			return
+		width, height = max(self.middle_pane_child.get_position(), 100), max(self.middle_pane_child.get_allocated_height(), 100)
+		dirname = self.state['open_directory']
+
+		def show(pixbuf):
+			if self.state['current_path'] != current_path: return  # the user moved on while it was decoding
+			if pixbuf is None: self.media_view.set_from_icon_name('image-missing', Gtk.IconSize.DIALOG)
+			else: self.media_view.set_from_pixbuf(pixbuf)
+			self.media_view.set_tooltip_text(current_path)
+			if self.navigation_start is not None:
+				self.last_navigation_time = time.perf_counter() - self.navigation_start
+				self.navigation_start = None
+		self.media_loader.load(path.join(dirname, current_path), width, height, show)
+		files, visible, number = self.state['files'], self.state['visible_positions'], self.state['media_number']
+		self.media_loader.prefetch([path.join(dirname, files[visible[i]]['_path']) for i in (number, number - 2) if 0 <= i < len(visible)], width, height)
+
+	def show_properties(self):
+		'''Fill the properties page with editors for the title, tags and props of the current item. Every change is an undoable edit.'''
+		self.properties_queued = False
+		for child in self.properties_page.get_children(): child.destroy()
+		if self.state['current_path'] is None:
+			self.properties_page.pack_start(Gtk.Label(label='(properties)'), True, True, 0)
+			self.properties_page.show_all()
+			return False
+		entry = self.state['current_item']
+		meta = self.state['tagviewer_meta']
+
+		def text_row(label: str, text: str, changed: Callable[[Gtk.Entry], None]):
+			row = Gtk.Box(spacing=6)
+			row.pack_start(Gtk.Label(label=label), False, False, 0)
+			editor = Gtk.Entry(text=text)
+			editor.connect('activate', changed)
+			def focus_out(widget, _):
+				changed(widget)
+				return False
+			editor.connect('focus-out-event', focus_out)
+			row.pack_start(editor, True, True, 0)
+			self.properties_page.pack_start(row, False, False, 0)
+
+		def title_changed(editor):
+			if editor.get_text() != entry.get('title'): self.edit('Edit title', [set_value(entry, 'title', editor.get_text())])
+		text_row('Title', entry.get('title', ''), title_changed)
+
+		deleted = set(meta.get('deletedTags', []))
+		for index, (name, color) in enumerate(meta.get('tagList', [])):
+			if index in deleted: continue
+			check = Gtk.CheckButton(label=name, active=index in entry['tags'])
+			def toggle_tag(button, index=index, name=name):
+				if button.get_active() == (index in entry['tags']): return
+				self.edit(f'{"Tag" if button.get_active() else "Untag"} {name}', [set_tags(entry, set(entry['tags']) ^ {index})])
+			check.connect('toggled', toggle_tag)
+			self.properties_page.pack_start(check, False, False, 0)
+
+		props = entry.get('props', {})
+		for name, kind in meta.get('propList', []):
+			if kind == 'True/False':
+				check = Gtk.CheckButton(label=name, active=bool(props.get(name, False)))
+				check.connect('toggled', lambda button, name=name: self.edit(f'Edit {name}', [set_prop(entry, name, button.get_active())]))
+				self.properties_page.pack_start(check, False, False, 0)
+				continue
+			def prop_changed(editor, name=name, kind=kind):
+				text = editor.get_text()
+				value = MISSING if text == '' else coerce_value(text) if kind == 'Number' else text
+				if kind == 'Number' and value is not MISSING and (isinstance(value, bool) or not isinstance(value, (int, float))):
+					editor.set_text(str(entry.get('props', {}).get(name, '')))  # not a number
+				elif value != entry.get('props', {}).get(name, MISSING):
+					self.edit(f'Edit {name}', [set_prop(entry, name, value)])
+			text_row(name, str(props.get(name, '')), prop_changed)
+		self.properties_page.show_all()
+		return False
+
+	def edit(self, label: str, operations):
+		self.history.edit(label, operations)
+		self.save_tagspace()
+
+	def undo(self):
+		if self.history.undo() is not None: self.save_tagspace()
+
+	def redo(self):
+		if self.history.redo() is not None: self.save_tagspace()
+
+	def save_tagspace(self):
+		'''Save the open TagSpace soon. Saves asked for in quick succession, like a run of edits or undos, are written to `tagviewer.json` once.'''
+		if not self.state['tagspace_is_open']: return
+		self.unsaved_directory = self.state['open_directory']
+		if self.save_timer is None: self.save_timer = GLib.timeout_add(SAVE_DELAY_MS, self._save_timeout)
+
+	def _save_timeout(self):
+		self.save_timer = None
+		self.flush_save()
+		return False
+
+	def flush_save(self):
+		'''Write the open TagSpace now if it has unsaved changes, e.g. before another one is opened or TagViewer exits.'''
+		if self.save_timer is not None:
+			GLib.source_remove(self.save_timer)
+			self.save_timer = None
+		if self.unsaved_directory is None: return
+		dirname, self.unsaved_directory = self.unsaved_directory, None
+		if self.state['open_directory'] != dirname: return
+		with tracer.span('Save tagviewer.json'):
+			save_tagspace(dirname, self.state['tagviewer_meta'])
+			self.meta_written = snapshot.source_stat(dirname)
+		self.sync_search_index()
+
+	def sync_search_index(self):
+		'''Bring the search index up to date with the open history in the background. Only TagSpaces that changed since they were indexed are read, and only
+		their changed items rewritten. While a sync is running, at most one more is queued to follow it.'''
+		if self.search_sync is not None:
+			self.search_sync_queued = True
+			return
+		history = list(self.cache['open_history'])
+
+		def synced(*_):
+			self.search_sync = None
+			if self.search_sync_queued:
+				self.search_sync_queued = False
+				self.sync_search_index()
+		def failed(job, error):
+			synced()
+			traceback.print_exception(type(error), error, error.__traceback__)
+			msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.OK, text='The search index could not be updated.')
+			msg.format_secondary_text(f'Search results may be out of date.\n\n{type(error).__name__}: {error}')
+			msg.run()
+			msg.destroy()
+		self.search_sync = Job('Indexing TagSpaces', lambda job: self.search_index.sync(history, job), dispatch=idle_dispatch, on_done=synced,
+		                       on_error=failed).start()
+
+	def show_search_results(self, text):
+		for row in self.search_results.get_children(): row.destroy()
+		if not text.strip():
+			self.search_popover.popdown()
+			return
+		hits = self.search_index.search(text, limit=50)
+		for hit in hits:
+			row = Gtk.ListBoxRow()
+			row.hit = hit
+			label = Gtk.Label(label=f'{hit.title or hit.path} — {hit.tagspace_title or path.basename(hit.tagspace)}', xalign=0)
+			label.set_tooltip_text(path.join(hit.tagspace, hit.path))
+			row.add(label)
+			self.search_results.add(row)
+		if not hits: self.search_results.add(Gtk.Label(label='No results'))
+		self.search_results.show_all()
+		self.search_popover.popup()
+
+	def go_to_item(self, dirname, relpath):
+		'''Show the item at `relpath` in the TagSpace in `dirname`, opening the TagSpace first if it isn't the open one.'''
+		self.search_popover.popdown()
+		if self.state['open_directory'] != dirname: self._open_tagspace(dirname)
+		position = self.state['file_index'].by_path.get(relpath)
+		if position is None: return  # the item went away since the index was last synced
+		entry = self.state['files'][position]
+		self.state['current_id'] = entry['_id']
+		if self.state['current_item'] is not entry: self.state['filters'] = []  # it's filtered out
+
+	def run_job(self, name: str, target: Callable[[Job], object], on_done: Optional[Callable[[Job, object], None]]=None) -> Job:
+		'''Run `target` as a background `Job`, showing its progress and a cancel button in the status bar until it finishes.'''
+		box = Gtk.Box(spacing=4)
+		progress_bar = Gtk.ProgressBar(show_text=True)
+		progress_bar.set_text(name)
+		cancel_button = Gtk.Button.new_from_icon_name('process-stop', Gtk.IconSize.MENU)
+		cancel_button.set_tooltip_text(f'Cancel {name}')
+		box.pack_start(progress_bar, False, False, 0)
+		box.pack_start(cancel_button, False, False, 0)
+		self.status_jobs.pack_start(box, False, False, 0)
+		box.show_all()
+
+		def handle_progress(job, done, total, message):
+			progress_bar.set_fraction(done / total if total else 1)
+			progress_bar.set_text(f'{name}: {done}/{total}')
+			progress_bar.set_tooltip_text(message)
+		def handle_done(job, result):
+			box.destroy()
+			if on_done is not None: on_done(job, result)
+		def handle_error(job, error):
+			box.destroy()
+			raise error  # goes to the graphical except hook
+		job = Job(name, target, dispatch=idle_dispatch, on_progress=handle_progress, on_done=handle_done, on_error=handle_error)
+		def cancel(*_):
+			cancel_button.set_sensitive(False)
+			progress_bar.set_text(f'{name}: cancelling…')
+			job.cancel()
+		cancel_button.connect('clicked', cancel)
+		return job.start()
+
+	def add_media(self):
+		choose_dialog = Gtk.FileChooserDialog(title="Choose media to add", parent=self, action=Gtk.FileChooserAction.OPEN, select_multiple=True)
+		choose_dialog.add_buttons(Gtk.STOCK_CANCEL, -4, 'Add', 0)
+		response = choose_dialog.run()
+		sources = choose_dialog.get_filenames()
+		choose_dialog.destroy()
+		if response != 0 or not sources: return
+		dirname = self.state['open_directory']
+
+		def add_batch(entries):
+			if self.state['open_directory'] != dirname: return  # the TagSpace was closed while importing; its files are reconciled when it's next opened
+			files, by_path = self.state['files'], self.state['file_index'].by_path  # kept up to date as batches are appended
+			added, edited = [], []
+			for entry in entries:
+				position = by_path.get(entry['_path'])
+				if position is None: added.append(entry)
+				else:  # already in the TagSpace
+					files[position].update(entry)
+					edited.append(files[position])
+			files_changed(self.state, edited, added)
+		def import_done(job, result):
+			if self.state['open_directory'] == dirname: self.save_tagspace()
+			if result is not None and result.failed:
+				msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.OK,
+				                        text=f'{len(result.failed)} of the selected files could not be added.')
+				msg.format_secondary_text('\n'.join(f'{path.basename(src)}: {error}' for (src, error) in result.failed[:20]))
+				msg.run()
+				msg.destroy()
+		self.run_job('Adding media', lambda job: importer.import_media(job, dirname, sources, add_batch), import_done)
+
+	def trash_paths(self, paths, on_success: Optional[Callable[[], None]]=None):
+		'''Move `paths` to the trash in the background. Entries for any of them in the open TagSpace are removed in one change at the end, and `on_success` is
+		called if everything was trashed.'''
+		dirname = self.state['open_directory']
+		watcher = self.watcher
+		relpaths = [path.relpath(filepath, dirname).replace(os.sep, '/') for filepath in paths] if watcher is not None else []
+		if watcher is not None: watcher.suppress(relpaths)  # or the watcher would remove the entries one by one, each change saved
+
+		def trashed(job, report):
+			if watcher is not None: watcher.release(relpaths)
+			if dirname is not None and self.state['open_directory'] == dirname:
+				gone = {path.relpath(filepath, dirname).replace(os.sep, '/') for filepath in report.trashed}
+				if any(entry['_path'] in gone for entry in self.state['files']):
+					replace_files(self.state, [entry for entry in self.state['files'] if entry['_path'] not in gone])
+					self.save_tagspace()
+			if report.failed or report.cancelled:
+				msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.WARNING, buttons=Gtk.ButtonsType.OK,
+				                        text='Not everything could be moved to the trash.' if report.failed else 'Moving to the trash was cancelled.')
+				msg.format_secondary_text(report.summary())
+				msg.run()
+				msg.destroy()
+			elif on_success is not None:
+				on_success()
+		self.run_job('Moving to trash', lambda job: trash.trash_paths(job, paths), trashed)
+
+	def delete_media(self, entries):
+		if self.cache['show_delete_warning']:
+			msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.QUESTION, buttons=Gtk.ButtonsType.OK_CANCEL,
+			                        text=f'Move {len(entries)} item{"s" if len(entries) != 1 else ""} to the trash?')
+			msg.format_secondary_text('The files will be moved to the trash and removed from the TagSpace.')
+			dont_ask = Gtk.CheckButton(label='Don\'t ask again')
+			msg.get_message_area().add(dont_ask)
+			dont_ask.show()
+			response = msg.run()
+			msg.destroy()
+			if response != Gtk.ResponseType.OK: return
+			if dont_ask.get_active(): self.cache['show_delete_warning'] = False
+		self.trash_paths([path.join(self.state['open_directory'], entry['_path']) for entry in entries])
+
+	def find_duplicates(self):
+		dirname = self.state['open_directory']
+		files = list(self.state['files'])
+
+		def duplicates_found(job, groups):
+			if groups is None or self.state['open_directory'] != dirname: return
+			if not groups:
+				msg = Gtk.MessageDialog(parent=self, message_type=Gtk.MessageType.INFO, buttons=Gtk.ButtonsType.OK, text='No duplicates were found.')
+				msg.run()
+				msg.destroy()
+				return
+			self.state['filters'] = [f for f in self.state['filters'] if f.get('label') != 'Duplicates'] + [dupes.duplicates_filter(groups)]
+		self.run_job('Finding duplicates', lambda job: dupes.find_duplicates(job, dirname, files), duplicates_found)
+
+	def snapshot_path(self) -> str:
+		return path.join(appdirs.user_cache_dir('tagviewer'), snapshot.SNAPSHOT_FILENAME)
 
 	def exit_handler(self, *_):
+		if self.watcher is not None: self.watcher.stop()
+		self.flush_save()
+		if self.config['behavior']['history']['auto_resume'] and self.state['tagspace_is_open']:
+			try:
+				with tracer.span('Save snapshot'):
+					snapshot.save(self.snapshot_path(), self.state, self.meta_written)
+			except (OSError, ValueError):
+				traceback.print_exc()  # it's only a cache; the TagSpace is loaded normally next time
 		with open(path.join(appdirs.user_config_dir('tagviewer'), 'config.toml'), 'w') as config_file:
 			toml.dump(self.config, config_file)
 		with open(path.join(appdirs.user_cache_dir('tagviewer'), 'cache.json'), 'w') as cache_file:
 			json.dump(self.cache, cache_file)
+		if tracer.enabled: tracer.disable()  # writes the trace
 
 		Gtk.main_quit()
 
@@ -820,9 +1380,11 @@ def graphical_except_hook(exctype, value, tb):
 	except NameError:
 		pass
 	exit(1)
-sys.excepthook = graphical_except_hook  # noqa: E305
 
-win = MainWindow()
-win.connect("destroy", win.exit_handler)
-win.show_all()
-Gtk.main()
+
+if __name__ == '__main__':
+	sys.excepthook = graphical_except_hook
+	win = MainWindow()
+	win.connect("destroy", win.exit_handler)
+	win.show_all()
+	Gtk.main()
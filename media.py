@@ -0,0 +1,76 @@
+'''Decoding media for display.
+
+Images are decoded on a worker thread straight to the size they're shown at, and the decoded pixbufs are kept in a `BudgetedCache` so stepping back and
+forth doesn't decode the same image twice. The neighbours of the current item are decoded ahead of time, so stepping to them is usually a cache hit.'''
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, Tuple
+
+import gi
+gi.require_version('GdkPixbuf', '2.0')
+from gi.repository import GdkPixbuf, GLib  # noqa: E402
+
+from membudget import BudgetedCache, MemoryBudget  # noqa: E402
+from tracing import tracer  # noqa: E402
+
+
+def pixbuf_size(pixbuf: Optional[GdkPixbuf.Pixbuf]) -> int:
+	if pixbuf is None: return 64
+	return pixbuf.get_rowstride() * pixbuf.get_height()
+
+
+class MediaLoader:
+	'''Decode and cache media.\n
+	Arguments: `budget` (MemoryBudget), `dispatch` (a job dispatcher, see `jobs`)
+
+	`last_decode_time` is how long decoding the media last asked for with ``load`` took, in seconds, whether it was decoded for that or earlier (say, when
+	it was prefetched). The hits and misses of `cache` count how often ``load`` found the media already decoded.'''
+	__slots__ = ['cache', 'dispatch', 'pool', 'pending', 'last_decode_time']
+
+	def __init__(self, budget: MemoryBudget, dispatch: Callable):
+		self.cache = BudgetedCache('Decoded media', budget, sizeof=pixbuf_size)
+		self.dispatch = dispatch
+		self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='decode')
+		self.pending = {}
+		self.last_decode_time = None
+
+	def _decode(self, key: Tuple[str, int, int]):
+		filepath, width, height = key
+		start = time.perf_counter()
+		try:
+			with tracer.span('Decode media', path=filepath, size=f'{width}×{height}'):
+				pixbuf = GdkPixbuf.Pixbuf.new_from_file_at_scale(filepath, width, height, True)
+		except GLib.Error:
+			pixbuf = None  # not an image GdkPixbuf can read, e.g. a video
+		return pixbuf, time.perf_counter() - start
+
+	def _decoded(self, key, future):
+		pixbuf, elapsed = future.result()
+		callbacks = self.pending.pop(key, [])
+		self.cache.put(key, pixbuf, cost=elapsed, size=pixbuf_size(pixbuf))
+		if callbacks: self.last_decode_time = elapsed
+		for callback in callbacks: callback(pixbuf)
+
+	def _submit(self, key, callback: Optional[Callable]):
+		if key in self.pending:
+			if callback is not None: self.pending[key].append(callback)
+			return
+		self.pending[key] = [callback] if callback is not None else []
+		future = self.pool.submit(self._decode, key)
+		future.add_done_callback(lambda future: self.dispatch(self._decoded, key, future))
+
+	def load(self, filepath: str, width: int, height: int, callback: Callable[[Optional[GdkPixbuf.Pixbuf]], None]):
+		'''Call `callback` with `filepath` decoded to fit in `width`×`height` (or `None` if it can't be decoded), immediately if it's cached.'''
+		key = (filepath, width, height)
+		if key in self.cache:
+			self.last_decode_time = self.cache.cost(key, self.last_decode_time)
+			callback(self.cache.get(key))
+			return
+		self.cache.misses += 1
+		self._submit(key, callback)
+
+	def prefetch(self, filepaths: Iterable[str], width: int, height: int):
+		for filepath in filepaths:
+			key = (filepath, width, height)
+			if key not in self.cache: self._submit(key, None)
@@ -0,0 +1,273 @@
+'''One memory budget shared by all of TagViewer's in-process caches.
+
+Every cache registers with the `MemoryBudget` and reports the approximate size of what it holds. When the total goes over the limit, entries are evicted
+across all caches in GreedyDual-Size order. That is LRU order weighted by how expensive an entry was to produce per byte it takes up: a large thumbnail
+that decoded in a millisecond goes before a small index that took a second to build, even if the thumbnail was used more recently.
+
+Each entry has a priority of `clock + cost / size`, refreshed whenever it's used. Evicting the entry with the lowest priority advances `clock` to that
+priority, which ages every entry that hasn't been used since.
+
+Caches that TagViewer doesn't own, like the StateMan cache of dynamic properties, take part through an adapter with the same interface:
+``size``, ``peek_victim`` and ``evict``.'''
+
+import heapq
+import itertools
+import sys
+import threading
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+MiB = 1 << 20
+
+
+def approx_size(obj, _depth: int=0) -> int:
+	'''Estimate the memory taken by `obj` and what it contains. Large containers are estimated from a sample of their items, so this is cheap enough to call
+	on a list of a million entries.'''
+	size = sys.getsizeof(obj)
+	if _depth > 6: return size
+	if isinstance(obj, dict):
+		count = len(obj)
+		if count == 0: return size
+		sample = itertools.islice(obj.items(), 32)
+		total = sum(approx_size(key, _depth + 1) + approx_size(value, _depth + 1) for (key, value) in sample)
+		return size + total * count // min(count, 32)
+	if isinstance(obj, (list, tuple, set, frozenset)):
+		count = len(obj)
+		if count == 0: return size
+		sample = list(itertools.islice(obj, 0, None, max(1, count // 32)))[:32]
+		return size + sum(approx_size(item, _depth + 1) for item in sample) * count // len(sample)
+	return size
+
+
+class MemoryBudget:
+	'''The global budget.\n
+	Arguments: `limit` (int, bytes)'''
+	__slots__ = ['limit', 'clock', 'caches', 'lock']
+
+	def __init__(self, limit: int):
+		self.limit = limit
+		self.clock = 0.0
+		self.caches = []
+		self.lock = threading.RLock()
+
+	def register(self, cache):
+		with self.lock:
+			self.caches.append(cache)
+
+	def unregister(self, cache):
+		with self.lock:
+			if cache in self.caches: self.caches.remove(cache)
+
+	def usage(self) -> Dict[str, int]:
+		'''The approximate size of every registered cache, by name.'''
+		with self.lock:
+			return {cache.name: cache.size() for cache in self.caches}
+
+	def total(self) -> int:
+		with self.lock:
+			return sum(cache.size() for cache in self.caches)
+
+	def enforce(self, target: Optional[int]=None) -> int:
+		'''Evict entries, lowest priority first across all caches, until the total is at most `target` (by default the limit). Returns the bytes freed.'''
+		target = self.limit if target is None else target
+		freed = 0
+		with self.lock:
+			total = self.total()
+			while total > target:
+				victims = [(victim, cache) for cache in self.caches if (victim := cache.peek_victim()) is not None]
+				if not victims: break
+				(priority, key), cache = min(victims, key=lambda victim: victim[0][0])
+				self.clock = max(self.clock, priority)
+				released = cache.evict(key)
+				freed += released
+				total -= released
+		return freed
+
+	def shrink(self, fraction: float) -> int:
+		'''Evict down to `fraction` of the limit, for when the system is short of memory.'''
+		return self.enforce(int(self.limit * fraction))
+
+
+class BudgetedCache:
+	'''A dict-like cache whose entries count against a `MemoryBudget`.\n
+	Arguments: `name` (str, shown in the usage readout), `budget` (MemoryBudget) | Keyword Arguments: `sizeof` (function estimating the size of a value,
+	default ``approx_size``)
+
+	``put`` takes the cost of producing the value, in seconds, as used for eviction. Reads with ``get`` count as uses. Hits and misses are counted for the
+	status bar.'''
+	__slots__ = ['name', 'budget', 'sizeof', 'entries', 'heap', 'bytes', 'hits', 'misses', '_counter']
+
+	def __init__(self, name: str, budget: MemoryBudget, sizeof: Callable[[Any], int]=approx_size):
+		self.name = name
+		self.budget = budget
+		self.sizeof = sizeof
+		self.entries = {}  # key: [value, size, cost, priority]
+		self.heap = []  # (priority, sequence, key); stale items are skipped lazily
+		self.bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self._counter = itertools.count()
+		budget.register(self)
+
+	def _touch(self, key: Hashable, entry: list):
+		entry[3] = self.budget.clock + entry[2] / max(entry[1], 1)
+		heapq.heappush(self.heap, (entry[3], next(self._counter), key))
+		if len(self.heap) > 4 * len(self.entries) + 64:  # drop the stale heap items now and then so the heap doesn't grow without bound
+			self.heap = [(entry[3], next(self._counter), key) for (key, entry) in self.entries.items()]
+			heapq.heapify(self.heap)
+
+	def get(self, key: Hashable, default=None):
+		with self.budget.lock:
+			entry = self.entries.get(key)
+			if entry is None:
+				self.misses += 1
+				return default
+			self.hits += 1
+			self._touch(key, entry)
+			return entry[0]
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self.entries
+
+	def __len__(self) -> int:
+		return len(self.entries)
+
+	def cost(self, key: Hashable, default=None):
+		'''Return the cost `key` was put with, without counting as a use.'''
+		entry = self.entries.get(key)
+		return default if entry is None else entry[2]
+
+	def put(self, key: Hashable, value, cost: float=0.001, size: Optional[int]=None):
+		with self.budget.lock:
+			if key in self.entries: self.evict(key)
+			entry = [value, self.sizeof(value) if size is None else size, cost, 0.0]
+			self.entries[key] = entry
+			self.bytes += entry[1]
+			self._touch(key, entry)
+			self.budget.enforce()
+
+	def pop(self, key: Hashable, default=None):
+		with self.budget.lock:
+			if key not in self.entries: return default
+			value = self.entries[key][0]
+			self.evict(key)
+			return value
+
+	def clear(self):
+		with self.budget.lock:
+			self.entries.clear()
+			self.heap.clear()
+			self.bytes = 0
+
+	def size(self) -> int:
+		return self.bytes
+
+	def peek_victim(self) -> Optional[Tuple[float, Hashable]]:
+		while self.heap:
+			priority, _, key = self.heap[0]
+			entry = self.entries.get(key)
+			if entry is not None and entry[3] == priority: return priority, key
+			heapq.heappop(self.heap)
+		return None
+
+	def evict(self, key: Hashable) -> int:
+		entry = self.entries.pop(key, None)
+		if entry is None: return 0
+		self.bytes -= entry[1]
+		return entry[1]
+
+	def items(self) -> Iterator[Tuple[Hashable, Any]]:
+		return ((key, entry[0]) for (key, entry) in list(self.entries.items()))
+
+
+class _UseRecordingCache(dict):
+	'''Stands in for the dict StateMan caches dynamic property values in, noting which ones are read.'''
+	__slots__ = ['used']
+
+	def __init__(self, *args):
+		super().__init__(*args)
+		self.used = set()
+
+	def __getitem__(self, prop):
+		self.used.add(prop)
+		return super().__getitem__(prop)
+
+
+class StateManCacheAdapter:
+	'''Lets the budget evict cached values of StateMan dynamic properties, which are recomputed from their getters the next time they're read.\n
+	Arguments: `state` (StateMan), `budget` (MemoryBudget) | Keyword Arguments: `name` (str), `aliases` (properties never to count or evict), `dispatch`
+	(function running a function on the thread that owns `state`, default calling it right away)
+
+	StateMan's cache is replaced with a dict that notes reads, so an entry's priority is refreshed when it's used. StateMan isn't thread-safe, so entries are
+	only evicted on the thread that created the adapter: when the budget is enforced from another thread (like a worker caching an image), they're left
+	alone and an enforcement is handed to `dispatch` instead.
+
+	Values that are the same object as a static property or a ref, or as one of the values directly inside a static property (like `files`, which is the list
+	inside `tagviewer_meta`), are not counted and never evicted, since dropping them frees nothing. Neither are the properties in `aliases`, whose values are
+	known to be part of other state further in (like the current item, an entry of `files`). The objects to skip are found again only after a static property
+	changes.'''
+	__slots__ = ['name', 'state', 'budget', 'aliases', 'dispatch', 'thread', 'enforce_pending', '_shared_ids', '_sizes', '_priorities']
+
+	def __init__(self, state, budget: MemoryBudget, name: str='StateMan', aliases: Iterable[Hashable]=(),
+	             dispatch: Callable[[Callable[[], Any]], None]=lambda fn: fn()):
+		self.name = name
+		self.state = state
+		self.budget = budget
+		self.aliases = frozenset(aliases)
+		self.dispatch = dispatch
+		self.thread = threading.get_ident()
+		self.enforce_pending = False
+		self._shared_ids = None
+		self._sizes = {}
+		self._priorities = {}
+		state.cache = _UseRecordingCache(state.cache)
+		state.bind_all(self._note_change)
+		budget.register(self)
+
+	def _note_change(self, event: str, state, prop: Hashable):
+		if prop in state.static_props: self._shared_ids = None
+
+	def _shared(self) -> set:
+		if self._shared_ids is None:
+			shared = set(map(id, self.state.refs.values()))
+			for value in self.state.static_props.values():
+				shared.add(id(value))
+				if isinstance(value, dict): shared.update(map(id, value.values()))
+			self._shared_ids = shared
+		return self._shared_ids
+
+	def _own_entries(self) -> List[Tuple[Hashable, Any]]:
+		shared = self._shared()
+		return [(prop, value) for (prop, value) in list(self.state.cache.items()) if prop not in self.aliases and id(value) not in shared]
+
+	def size(self) -> int:
+		sizes = {}
+		used, self.state.cache.used = self.state.cache.used, set()
+		for prop, value in self._own_entries():
+			known = self._sizes.get(prop)
+			sizes[prop] = known[1] if known is not None and known[0] is value else approx_size(value)
+			if known is None or known[0] is not value: self._sizes[prop] = (value, sizes[prop])
+			if known is None or known[0] is not value or prop in used: self._priorities[prop] = self.budget.clock + 0.01 / max(sizes[prop], 1)
+		for prop in set(self._sizes) - set(sizes):
+			del self._sizes[prop]
+			self._priorities.pop(prop, None)
+		return sum(sizes.values())
+
+	def _enforce(self):
+		self.enforce_pending = False
+		self.budget.enforce()
+
+	def peek_victim(self) -> Optional[Tuple[float, Hashable]]:
+		if not self._priorities: return None
+		if threading.get_ident() != self.thread:
+			if not self.enforce_pending:
+				self.enforce_pending = True
+				self.dispatch(self._enforce)
+			return None
+		prop = min(self._priorities, key=self._priorities.__getitem__)
+		return self._priorities[prop], prop
+
+	def evict(self, prop: Hashable) -> int:
+		self.state.cache.pop(prop, None)
+		self._priorities.pop(prop, None)
+		known = self._sizes.pop(prop, None)
+		return known[1] if known is not None else 0
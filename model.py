@@ -0,0 +1,192 @@
+'''The TagViewer model: the StateMan graph describing an open TagSpace, and sorting of its files.
+
+Nothing in here depends on GTK, so scripts and the command line interface can use the same model as the GUI, which adds its own UI properties through the
+`extra` argument of ``create_model``.'''
+
+from bisect import bisect_left
+from enum import Enum
+from enum import auto as enumauto
+from itertools import chain
+from typing import Iterable, List, Optional, Tuple, Union
+
+from stateman import StateMan
+from tagspace import assign_ids
+
+
+class BuiltinSortProps(Enum):
+	INTRINSIC = enumauto()
+	TITLE = enumauto()
+	SIZE = enumauto()
+	RESOLUTION = enumauto()
+
+
+class SortMethods(Enum):
+	SORT_AZ = enumauto()
+	SORT_ZA = enumauto()
+	SORT_19 = enumauto()
+	SORT_91 = enumauto()
+	SORT_TF = enumauto()
+	SORT_FT = enumauto()
+
+
+_DESCENDING = (SortMethods.SORT_ZA, SortMethods.SORT_91, SortMethods.SORT_TF)  # True sorts above False, so True-first is descending
+
+
+def create_model(extra: Optional[dict]=None, refs: Optional[dict]=None, tracer=None) -> StateMan:
+	'''Create the StateMan instance for a TagSpace, with the properties in `extra` added to the core ones.
+
+	`refs` may include a `query_engine` (a `query.QueryEngine`, e.g. one sharing the application's memory budget) to filter with; otherwise one is made.'''
+	props = {
+		'tagviewer_meta': {},
+		'files': (lambda model: model['tagviewer_meta']['files'] if 'files' in model['tagviewer_meta'] else [], ('tagviewer_meta',)),
+		'open_directory': None,
+		'file_index': (lambda model: model.refs['file_index'].sync(model['files']), ('files',)),
+		'current_id': None,  # the `_id` of the current item; `None` for the first one
+		# ↓ the current item's number in the filtered view. Setting it moves to the item at that number.
+		'media_number': (lambda model: _current_index(model) + 1, ('current_id', 'visible_positions', 'file_index'), _set_media_number),
+		'filters': [],
+		'sort_options': None,
+		'filters_active': (lambda model: len(model['filters']) > 0, ('filters',)),
+		# the positions in `files` of the files that pass the filters, which is what's navigated
+		'visible_positions': (lambda model: model.refs['query_engine'].run(model['files'], model['tagviewer_meta'], model['filters']), ('files', 'filters')),
+		'num_of_files': (lambda model: len(model['visible_positions']), ('visible_positions',)),
+		'file_paths': (lambda model: [model['files'][i]['_path'] for i in model['visible_positions']], ('visible_positions',)),
+		'tagspace_is_open': (lambda model: model['open_directory'] is not None, ('open_directory',)),
+		'media_is_open': (lambda model: model['tagspace_is_open'] and ('_path' in model['current_item']
+		                  or model['filters_active'] or len(model['files']) == 0),
+		                  ('tagspace_is_open', 'current_item', 'filters_active', 'files')),
+		'can_go_previous': (lambda model: model['media_number'] > 1, ('media_number',)),
+		'can_go_next': (lambda model: model['num_of_files'] > model['media_number'], ('num_of_files', 'media_number')),
+		'current_item': (lambda model: model['files'][model['visible_positions'][model['media_number'] - 1]] if model['num_of_files'] > 0 else {},
+		                 ('media_number',)),
+		'current_path': (lambda model: model['current_item'].get('_path') if model['media_is_open'] else None, ('current_item', 'media_is_open')),
+		'current_tags': (lambda model: [model['tagviewer_meta']['tagList'][x] for x in model['current_item']['tags']] if 'tagList' in model['tagviewer_meta'] else [],
+		                 ('current_item', 'tagviewer_meta'))
+	}
+	if extra is not None: props.update(extra)
+	refs = {} if refs is None else refs
+	refs.setdefault('file_index', FileIndex())
+	if 'query_engine' not in refs:
+		from query import QueryEngine
+		refs['query_engine'] = QueryEngine()
+	return StateMan(props, refs=refs, tracer=tracer)
+
+
+class FileIndex:
+	'''Maps from file ID and from path to position in `files`. They're extended when files are appended and rebuilt when `files` is replaced, so looking a
+	file up by either costs O(1) no matter how the files were edited.
+
+	Every file entry has an `_id`, an integer that stays the same when the file is renamed, moved in the list or filtered out. It's given when the entry is
+	loaded or added (see ``tagspace.assign_ids``), so indexing never changes the files.'''
+	__slots__ = ['files', 'count', 'by_id', 'by_path']
+
+	def __init__(self):
+		self.files = None
+		self.count = 0
+		self.by_id = {}
+		self.by_path = {}
+
+	def sync(self, files: List[dict]) -> 'FileIndex':
+		if files is not self.files or len(files) < self.count:
+			self.files = files
+			self.count = 0
+			self.by_id = {}
+			self.by_path = {}
+		start = self.count
+		if len(files) == start: return self
+		for position in range(start, len(files)):
+			entry = files[position]
+			if '_id' in entry: self.by_id[entry['_id']] = position
+			self.by_path[entry['_path']] = position
+		self.count = len(files)
+		return self
+
+	def note_changed(self, entries: Iterable[dict]):
+		'''Note that `entries` were edited in place. If any was renamed, the maps are rebuilt when they're next used.'''
+		if any(self.by_path.get(entry['_path']) != self.by_id.get(entry.get('_id')) for entry in entries): self.files = None
+
+	def export(self) -> dict:
+		'''The maps as plain data, for ``snapshot``.'''
+		return {'by_id': self.by_id, 'by_path': self.by_path}
+
+	def restore(self, files: List[dict], data: dict):
+		'''Adopt maps saved by ``export`` for `files` instead of building them.'''
+		self.files = files
+		self.count = len(files)
+		self.by_id = data['by_id']
+		self.by_path = data['by_path']
+
+
+def _current_index(model: StateMan) -> int:
+	'''The index in `visible_positions` of the current item: the file with `current_id` if it's visible, or else the nearest visible file after it.'''
+	visible = model['visible_positions']
+	position = model['file_index'].by_id.get(model['current_id'])
+	if position is None or not visible: return 0
+	return min(bisect_left(visible, position), len(visible) - 1)
+
+
+def _set_media_number(model: StateMan, number: int):
+	visible = model['visible_positions']
+	if not visible: return
+	model['current_id'] = model['files'][visible[min(max(number, 1), len(visible)) - 1]]['_id']
+
+
+def replace_files(model: StateMan, files: List[dict]):
+	'''Swap the `files` list of the open TagSpace in `model` for `files` as a single state change, giving any new entries an `_id`.
+
+	If the current item isn't among `files` (it was deleted, say), the item after it in the view becomes current, or the one before it if it was the
+	last, rather than the first item.'''
+	meta = model['tagviewer_meta']
+	ids = {entry.get('_id') for entry in files}
+	if model['current_id'] is not None and model['current_id'] not in ids and model['num_of_files'] > 0:
+		old_files, visible, index = model['files'], model['visible_positions'], model['media_number'] - 1
+		later = (old_files[visible[i]].get('_id') for i in range(index, len(visible)))
+		earlier = (old_files[visible[i]].get('_id') for i in range(index - 1, -1, -1))
+		model.static_props['current_id'] = next((file_id for file_id in chain(later, earlier) if file_id in ids), None)  # announced below with the files
+	meta['files'] = files
+	assign_ids(meta)
+	model._handle_change('tagviewer_meta')
+
+
+def files_changed(model: StateMan, entries: Iterable[dict], added: Optional[List[dict]]=None):
+	'''Announce, as one change, that `entries` of the open TagSpace were edited in place and `added` (new entries, given an `_id` here) appended to its
+	files, so the filtered view is updated for just those files.'''
+	entries = list(entries)
+	meta = model['tagviewer_meta']
+	model.refs['query_engine'].note_changed(entries)
+	model.refs['file_index'].note_changed(entries)
+	if added:
+		assign_ids(meta, added)
+		meta.setdefault('files', []).extend(added)
+	model._handle_change('tagviewer_meta')
+
+
+def tag_index(meta: dict, name: str) -> Optional[int]:
+	'''Find the index in `tagList` of the live (not deleted) tag called `name`.'''
+	deleted = set(meta.get('deletedTags', ()))
+	for i, tag in enumerate(meta.get('tagList', ())):
+		if tag[0] == name and i not in deleted: return i
+	return None
+
+
+def _sort_key(sort_prop: Union[BuiltinSortProps, str]):
+	if sort_prop == BuiltinSortProps.TITLE: return lambda entry: entry.get('title')
+	if sort_prop == BuiltinSortProps.SIZE: return lambda entry: entry.get('_size')
+	if sort_prop == BuiltinSortProps.RESOLUTION:
+		return lambda entry: entry['_resolution'][0] * entry['_resolution'][1] if '_resolution' in entry else None
+	return lambda entry: entry.get('props', {}).get(sort_prop)
+
+
+def sort_order(files: List[dict], sort_options: Optional[Tuple[Union[BuiltinSortProps, str], SortMethods]]) -> List[int]:
+	'''Return the positions of `files` in sorted order.\n
+	Arguments: `files` (list), `sort_options` (`None` or a tuple of the prop to sort by, either a `BuiltinSortProps` or the name of a TagSpace prop, and a
+	`SortMethods`)
+
+	Files without a value for the prop come last whichever way the sort goes. The sort is stable, so files with equal values keep their intrinsic order.'''
+	if sort_options is None or sort_options[0] == BuiltinSortProps.INTRINSIC: return list(range(len(files)))
+	sort_prop, method = sort_options
+	key = _sort_key(sort_prop)
+	keys = [key(entry) for entry in files]
+	present = [i for i in range(len(files)) if keys[i] is not None]
+	present.sort(key=keys.__getitem__, reverse=method in _DESCENDING)
+	return present + [i for i in range(len(files)) if keys[i] is None]
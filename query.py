@@ -0,0 +1,466 @@
+'''Filter expressions, planned against indexes of the open TagSpace.
+
+A filter expression combines filter terms (`tag:NAME`, `prop:NAME<op>VALUE` and `path:GLOB`, see ``filters.parse_term``) with `and`, `or`, `not` and
+parentheses. Terms next to each other are and-ed, and values with spaces can be quoted:
+
+	tag:beach and (prop:rating>=4 or not path:2019/*)
+	tag:beach -tag:sunset prop:title~"big wave"
+
+Expressions are parsed into trees of tuples and normalized (nested `and`s and `or`s flattened, operands deduplicated and sorted, double negations dropped),
+so the same filter written two ways is one cache entry. The entries of the `filters` state are converted into the same trees.
+
+``QueryEngine`` plans each expression against indexes of the files and picks the cheapest way in: the tag index (tag → positions), a prop index (built for
+a prop the first time it's filtered on: value → positions, plus the numeric values in sorted order for range comparisons), or the paths in sorted order for
+globs with a literal prefix. Terms that can't use an index are only checked against the candidates left by the ones that can, and a full scan is the last
+resort. Results are memoized by normalized expression in a `BudgetedCache`. When files are appended, or edited in place and announced with
+``QueryEngine.note_changed``, the indexes and every memoized result are updated for just those files.'''
+
+import re
+import time
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+from typing import Callable, Iterable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from filters import OPERATORS, compare, parse_term
+from membudget import MiB, BudgetedCache, MemoryBudget
+from model import tag_index
+
+ALL = ('and',)  # the empty conjunction, which every file matches
+_token = re.compile(r'\s*(?:(\()|(\))|((?:[^\s()"]|"[^"]*")+))')
+_RANGE_OPS = ('<', '<=', '>', '>=')
+_GLOB_CHARS = re.compile(r'[*?\[]')
+
+
+def parse(text: str) -> tuple:
+	'''Parse a filter expression into a (not yet normalized) tree.'''
+	tokens = []
+	position = 0
+	text = text.strip()
+	while position < len(text):
+		match = _token.match(text, position)
+		if match is None: raise ValueError(f'Unbalanced quotes in “{text}”')
+		tokens.append(match.group(match.lastindex))
+		position = match.end()
+	tokens.append(None)
+	position = 0
+
+	def peek():
+		return tokens[position]
+
+	def take():
+		nonlocal position
+		position += 1
+		return tokens[position - 1]
+
+	def parse_or():
+		operands = [parse_and()]
+		while peek() == 'or':
+			take()
+			operands.append(parse_and())
+		return operands[0] if len(operands) == 1 else ('or', *operands)
+
+	def parse_and():
+		operands = [parse_not()]
+		while peek() not in (None, ')', 'or'):
+			if peek() == 'and': take()
+			operands.append(parse_not())
+		return operands[0] if len(operands) == 1 else ('and', *operands)
+
+	def parse_not():
+		token = take()
+		if token is None or token in ('and', 'or', ')'): raise ValueError(f'Expected a filter term in “{text}”' + (f' before “{token}”' if token else ''))
+		if token == 'not': return ('not', parse_not())
+		if token == '(':
+			node = parse_or()
+			if take() != ')': raise ValueError(f'Unbalanced parentheses in “{text}”')
+			return node
+		return from_filter(parse_term(token.replace('"', '')))
+
+	if peek() is None: return ALL
+	node = parse_or()
+	if peek() is not None: raise ValueError(f'Unexpected “{peek()}” in “{text}”')
+	return node
+
+
+def from_filter(filt: dict) -> tuple:
+	'''Convert an entry of the `filters` state into an expression tree.'''
+	kind = filt['type']
+	if kind == 'tag': node = ('tag', filt['tag'])
+	elif kind == 'prop':
+		if filt['op'] not in OPERATORS: raise ValueError(f'Unknown comparison “{filt["op"]}”')
+		node = ('prop', filt['prop'], filt['op'], filt['value'])
+	elif kind == 'path': node = ('path', filt['pattern'])
+	elif kind == 'paths': node = ('paths', tuple(sorted(set(filt['paths']))))
+	elif kind == 'expr': node = parse(filt['expr'])
+	else: raise ValueError(f'Unknown filter type “{kind}”')
+	return ('not', node) if filt.get('negate') else node
+
+
+def from_filters(filters: Iterable[dict]) -> tuple:
+	return normalize(('and', *(from_filter(filt) for filt in filters)))
+
+
+def normalize(node: tuple) -> tuple:
+	kind = node[0]
+	if kind == 'not':
+		operand = normalize(node[1])
+		return operand[1] if operand[0] == 'not' else ('not', operand)
+	if kind in ('and', 'or'):
+		operands = set()
+		for operand in map(normalize, node[1:]):
+			if operand[0] == kind: operands.update(operand[1:])
+			else: operands.add(operand)
+		if len(operands) == 1: return operands.pop()
+		return (kind, *sorted(operands, key=repr))
+	return node
+
+
+def compile_predicate(node: tuple, meta: dict) -> Callable[[dict], bool]:
+	'''Turn an expression tree into a predicate on file entries, resolving what doesn't depend on the file (like tag names) once up front.'''
+	kind = node[0]
+	if kind == 'tag':
+		index = tag_index(meta, node[1])
+		if index is None: return lambda entry: False
+		return lambda entry: index in entry.get('tags', ())
+	if kind == 'prop':
+		_, prop, op, value = node
+		op = OPERATORS[op]
+		return lambda entry: compare(op, entry.get('props', {}).get(prop), value)
+	if kind == 'path':
+		pattern = node[1]
+		return lambda entry: fnmatchcase(entry['_path'], pattern)
+	if kind == 'paths':
+		paths = frozenset(node[1])
+		return lambda entry: entry['_path'] in paths
+	if kind == 'not':
+		predicate = compile_predicate(node[1], meta)
+		return lambda entry: not predicate(entry)
+	predicates = [compile_predicate(operand, meta) for operand in node[1:]]
+	if kind == 'and': return lambda entry: all(predicate(entry) for predicate in predicates)
+	return lambda entry: any(predicate(entry) for predicate in predicates)
+
+
+class Plan(NamedTuple):
+	'''How to evaluate (part of) an expression. `lookup` produces the matching positions from an index, and is `None` if the only way is checking
+	`predicate` against every candidate; `estimate` is about how many positions `lookup` produces.'''
+	description: str
+	estimate: int
+	lookup: Optional[Callable[[], Set[int]]]
+	predicate: Callable[[dict], bool]
+	operands: tuple = ()
+
+	def explain(self, depth: int=0) -> str:
+		access = f'~{self.estimate} via index' if self.lookup is not None else 'scan'
+		return '\n'.join([f'{"  " * depth}{self.description} ({access})'] + [operand.explain(depth + 1) for operand in self.operands])
+
+
+class PropIndex:
+	'''The positions of the files by their value of one prop, and the numeric values in sorted order.'''
+	__slots__ = ['values', 'by_position', 'numbers', 'number_positions']
+
+	def __init__(self, name: str, files: List[dict]):
+		self.values = {}
+		self.by_position = {}
+		numbers = []
+		for position, entry in enumerate(files):
+			value = entry.get('props', {}).get(name)
+			if value is None: continue
+			self.values.setdefault(value, set()).add(position)
+			self.by_position[position] = value
+			if isinstance(value, (int, float)): numbers.append((value, position))
+		numbers.sort()
+		self.numbers = [value for (value, _) in numbers]
+		self.number_positions = [position for (_, position) in numbers]
+
+	def export(self) -> tuple:
+		return self.values, self.by_position, self.numbers, self.number_positions
+
+	@classmethod
+	def restore(cls, data: tuple) -> 'PropIndex':
+		'''Rebuild an index from the result of ``export``.'''
+		index = cls.__new__(cls)
+		index.values, index.by_position, index.numbers, index.number_positions = data
+		return index
+
+	def update(self, position: int, value):
+		old = self.by_position.pop(position, None)
+		if old is not None:
+			self.values[old].discard(position)
+			if not self.values[old]: del self.values[old]
+			if isinstance(old, (int, float)):
+				i = bisect_left(self.numbers, old)
+				while self.number_positions[i] != position: i += 1
+				del self.numbers[i], self.number_positions[i]
+		if value is not None:
+			self.values.setdefault(value, set()).add(position)
+			self.by_position[position] = value
+			if isinstance(value, (int, float)):
+				i = bisect_right(self.numbers, value)
+				self.numbers.insert(i, value)
+				self.number_positions.insert(i, position)
+
+	def bounds(self, op: str, value) -> Tuple[int, int]:
+		'''The slice of `number_positions` whose values compare to `value` with `op`, one of `<`, `<=`, `>` and `>=`.'''
+		if op == '<': return 0, bisect_left(self.numbers, value)
+		if op == '<=': return 0, bisect_right(self.numbers, value)
+		if op == '>': return bisect_right(self.numbers, value), len(self.numbers)
+		return bisect_left(self.numbers, value), len(self.numbers)
+
+
+class _Result:
+	__slots__ = ['positions', 'predicate']
+
+	def __init__(self, positions: List[int], predicate: Callable[[dict], bool]):
+		self.positions = positions
+		self.predicate = predicate
+
+
+def _result_size(result: _Result) -> int:
+	return 64 + 36 * len(result.positions)
+
+
+def _tag_key(meta: dict) -> tuple:
+	return tuple(tag[0] for tag in meta.get('tagList', ())), tuple(meta.get('deletedTags', ()))
+
+
+class QueryEngine:
+	'''Evaluate the `filters` state against the files of the open TagSpace, with indexes and memoized results.\n
+	Keyword Arguments: `budget` (MemoryBudget the memoized results count against, default a private one of 64 MiB)
+
+	`last_evaluation_time` is how long the last evaluation that wasn't answered from the cache took, in seconds.'''
+	__slots__ = ['results', 'files', 'tag_key', 'tags', 'entry_tags', 'entry_paths', 'sorted_paths', 'paths', 'props', 'identities', 'changed',
+	             'saved', 'last_filters', 'last_expression', 'last_evaluation_time']
+
+	def __init__(self, budget: Optional[MemoryBudget]=None):
+		self.results = BudgetedCache('Filter results', budget if budget is not None else MemoryBudget(64 * MiB), sizeof=_result_size)
+		self.files = None
+		self.tag_key = None
+		self.changed = {}
+		self.last_filters = None
+		self.last_expression = ALL
+		self.last_evaluation_time = None
+		self._reset([], None)
+
+	def _reset(self, files: List[dict], tag_key):
+		self.files = files
+		self.tag_key = tag_key
+		self.tags = None  # the indexes are built the first time they're needed
+		self.entry_tags = None
+		self.entry_paths = None
+		self.sorted_paths = None
+		self.paths = None
+		self.props = {}
+		self.identities = None
+		self.saved = None  # loads indexes saved by ``export_indexes``, if they were restored and haven't been needed yet
+		self.results.clear()
+
+	def note_changed(self, entries: Iterable[dict]):
+		'''Note that `entries` were edited in place. The indexes and results are brought up to date for them on the next evaluation.'''
+		for entry in entries: self.changed[id(entry)] = entry
+
+	def invalidate(self):
+		'''Drop every index and result, for when the files were changed in place without ``note_changed``.'''
+		self._reset(self.files, self.tag_key)
+
+	def run(self, files: List[dict], meta: dict, filters: List[dict]) -> Sequence[int]:
+		'''Return the positions in `files` of the files matching every entry of `filters`, in order.'''
+		if not filters:
+			self._sync(files, meta)  # keeps the indexes and results up to date for when filters are next applied
+			return range(len(files))
+		if filters is not self.last_filters:
+			self.last_expression = from_filters(filters)
+			self.last_filters = filters
+		return self.evaluate(files, meta, self.last_expression)
+
+	def evaluate(self, files: List[dict], meta: dict, expression: tuple) -> Sequence[int]:
+		'''Return the positions in `files` of the files matching the normalized `expression`, in order.'''
+		self._sync(files, meta)
+		if expression == ALL: return range(len(files))
+		result = self.results.get(expression)
+		if result is None:
+			start = time.perf_counter()
+			plan = self.plan(expression, meta)
+			if plan.lookup is not None: positions = sorted(plan.lookup())
+			else: positions = [position for (position, entry) in enumerate(files) if plan.predicate(entry)]
+			self.last_evaluation_time = time.perf_counter() - start
+			result = _Result(positions, plan.predicate)
+			self.results.put(expression, result, cost=self.last_evaluation_time)
+		return result.positions
+
+	def explain(self, files: List[dict], meta: dict, expression: tuple) -> str:
+		'''Describe the plan for `expression`, for debugging.'''
+		self._sync(files, meta)
+		return self.plan(expression, meta).explain()
+
+	def export_indexes(self, files: List[dict], meta: dict) -> Optional[dict]:
+		'''The indexes for `files` as plain data (for ``snapshot``), or `None` if they haven't been built.'''
+		self._sync(files, meta)
+		if self.tags is None: return None
+		props = {name: index.export() for (name, index) in self.props.items() if index is not None}
+		return {'tags': self.tags, 'entry_tags': self.entry_tags, 'entry_paths': self.entry_paths, 'paths': self.paths, 'props': props}
+
+	def restore_indexes(self, files: List[dict], meta: dict, load: Callable[[], Optional[dict]]):
+		'''Use indexes saved by ``export_indexes`` for `files` rather than building them. `load` returns them (or `None` if they can't be read) and is only
+		called when they're first needed; if `files` has been edited by then, they're built afresh instead.'''
+		self._reset(files, _tag_key(meta))
+		self.changed.clear()
+		self.saved = load
+
+	def _sync(self, files: List[dict], meta: dict):
+		tag_key = _tag_key(meta)
+		if files is not self.files or len(files) < len(self.entry_paths or ()) or tag_key != self.tag_key:
+			self._reset(files, tag_key)  # a new list (files were removed, renamed or reordered) or tags were renamed: start over
+			self.changed.clear()
+			return
+		if self.entry_paths is None:
+			if self.changed: self.saved = None  # the saved indexes would be out of date
+			self.changed.clear()
+			return
+		indexed = len(self.entry_paths)
+		positions = list(range(indexed, len(files)))  # appended
+		if self.changed:
+			if self.identities is None: self.identities = {id(entry): position for (position, entry) in enumerate(files)}
+			for key, entry in self.changed.items():
+				position = self.identities.get(key)
+				if position is not None and position < indexed and files[position] is entry: positions.append(position)  # appended ones are already in
+			self.changed.clear()
+		if positions: self._update(positions)
+
+	def _ensure_indexes(self):
+		if self.tags is not None: return
+		if self.saved is not None:
+			load, self.saved = self.saved, None
+			data = load()
+			if data is not None and len(data['entry_paths']) == len(self.files):
+				self.tags, self.entry_tags, self.entry_paths, self.paths = data['tags'], data['entry_tags'], data['entry_paths'], data['paths']
+				self.props = {name: PropIndex.restore(index) for (name, index) in data['props'].items()}
+				return
+		self.tags = {}
+		self.entry_tags = []
+		self.entry_paths = []
+		self.paths = {}
+		for position, entry in enumerate(self.files):
+			tags = tuple(entry.get('tags', ()))
+			for tag in tags: self.tags.setdefault(tag, set()).add(position)
+			self.entry_tags.append(tags)
+			self.entry_paths.append(entry['_path'])
+			self.paths[entry['_path']] = position
+
+	def _update(self, positions: List[int]):
+		files = self.files
+		appended = len(self.entry_paths)
+		for position in positions:
+			entry = files[position]
+			tags = tuple(entry.get('tags', ()))
+			old_tags = self.entry_tags[position] if position < appended else ()
+			for tag in set(old_tags).difference(tags): self.tags[tag].discard(position)
+			for tag in set(tags).difference(old_tags): self.tags.setdefault(tag, set()).add(position)
+			if position < appended:
+				self.entry_tags[position] = tags
+				if self.entry_paths[position] != entry['_path']:
+					self.paths.pop(self.entry_paths[position], None)
+					self.entry_paths[position] = entry['_path']
+					self.sorted_paths = None
+			else:
+				self.entry_tags.append(tags)
+				self.entry_paths.append(entry['_path'])
+				if self.identities is not None: self.identities[id(entry)] = position
+				self.sorted_paths = None
+			self.paths[entry['_path']] = position
+		if len(positions) > len(files) // 8: self.props.clear()  # quicker to rebuild them when they're next used
+		else:
+			for name, index in list(self.props.items()):
+				if index is None: continue
+				try:
+					for position in positions: index.update(position, files[position].get('props', {}).get(name))
+				except TypeError:  # now has an unhashable value
+					self.props[name] = None
+		for expression, result in self.results.items():
+			if expression not in self.results: continue  # evicted to make room for an updated one
+			matched = result.positions
+			for position in positions:
+				i = bisect_left(matched, position)
+				present = i < len(matched) and matched[i] == position
+				if result.predicate(files[position]) != present:
+					if present: del matched[i]
+					else: matched.insert(i, position)
+			self.results.put(expression, result, cost=self.results.cost(expression))  # re-counts its size, keeping what it took to evaluate
+
+	def _prop_index(self, name: str) -> Optional[PropIndex]:
+		if name not in self.props:
+			try:
+				self.props[name] = PropIndex(name, self.files)
+			except TypeError:  # an unhashable value, like a list
+				self.props[name] = None
+		return self.props[name]
+
+	def plan(self, node: tuple, meta: dict) -> Plan:
+		'''Plan the evaluation of the normalized expression `node`.'''
+		self._ensure_indexes()
+		kind = node[0]
+		predicate = compile_predicate(node, meta)
+		count = len(self.files)
+		if kind == 'tag':
+			positions = self.tags.get(tag_index(meta, node[1]), set())
+			return Plan(f'tag:{node[1]}', len(positions), lambda: positions, predicate)
+		if kind == 'prop':
+			_, name, op, value = node
+			index = self._prop_index(name)
+			if index is None: return Plan(f'prop:{name}{op}{value}', count, None, predicate)
+			if op == '=':
+				try:
+					positions = index.values.get(value, set())
+				except TypeError:
+					positions = set()
+				return Plan(f'prop:{name}{op}{value}', len(positions), lambda: positions, predicate)
+			if op in _RANGE_OPS and isinstance(value, (int, float)):  # other values never compare true with a number
+				start, end = index.bounds(op, value)
+				return Plan(f'prop:{name}{op}{value}', end - start, lambda: set(index.number_positions[start:end]), predicate)
+			op_function = OPERATORS[op]  # check each distinct value once rather than each file
+			def lookup():
+				return set().union(*(positions for (candidate, positions) in index.values.items() if compare(op_function, candidate, value)))
+			return Plan(f'prop:{name}{op}{value}', len(index.by_position), lookup, predicate)
+		if kind == 'path':
+			pattern = node[1]
+			match = _GLOB_CHARS.search(pattern)
+			if match is None:
+				positions = {self.paths[pattern]} if pattern in self.paths else set()
+				return Plan(f'path:{pattern}', len(positions), lambda: positions, predicate)
+			prefix = pattern[:match.start()]
+			if not prefix: return Plan(f'path:{pattern}', count, None, predicate)
+			if self.sorted_paths is None: self.sorted_paths = sorted((path, position) for (position, path) in enumerate(self.entry_paths))
+			sorted_paths = self.sorted_paths
+			start = bisect_left(sorted_paths, (prefix,))
+			end = bisect_left(sorted_paths, (prefix[:-1] + chr(ord(prefix[-1]) + 1),))
+			def lookup():
+				return {position for (path, position) in sorted_paths[start:end] if fnmatchcase(path, pattern)}
+			return Plan(f'path:{pattern}', end - start, lookup, predicate)
+		if kind == 'paths':
+			positions = {self.paths[path] for path in node[1] if path in self.paths}
+			return Plan(f'paths ({len(node[1])})', len(positions), lambda: positions, predicate)
+		if kind == 'not':
+			operand = self.plan(node[1], meta)
+			if operand.lookup is None: return Plan('not', count, None, predicate, (operand,))
+			return Plan('not', count - operand.estimate, lambda: set(range(count)).difference(operand.lookup()), predicate, (operand,))
+		operands = sorted((self.plan(operand, meta) for operand in node[1:]), key=lambda plan: plan.estimate)
+		if kind == 'or':
+			if all(operand.lookup is not None for operand in operands):
+				return Plan('or', min(count, sum(operand.estimate for operand in operands)),
+				            lambda: set().union(*(operand.lookup() for operand in operands)), predicate, tuple(operands))
+			return Plan('or', count, None, predicate, tuple(operands))
+		indexed = [operand for operand in operands if operand.lookup is not None]
+		if not indexed: return Plan('and', count, None, predicate, tuple(operands))
+		files = self.files
+
+		def lookup():
+			candidates = indexed[0].lookup()
+			checks = []
+			for operand in operands:
+				if operand is indexed[0]: continue
+				# intersecting with a set much bigger than what's left costs more than checking what's left
+				if operand.lookup is not None and operand.estimate <= 8 * len(candidates): candidates = candidates.intersection(operand.lookup())
+				else: checks.append(operand.predicate)
+				if not candidates: return candidates
+			if not checks: return candidates
+			return {position for position in candidates if all(check(files[position]) for check in checks)}
+		return Plan('and', indexed[0].estimate, lookup, predicate, tuple(operands))
@@ -0,0 +1,328 @@
+'''Keeping the `files` list of a TagSpace in agreement with the files actually in its directory.
+
+When a TagSpace is opened, the directory is compared against a snapshot saved in the sidecar cache the last time it was reconciled. The snapshot records
+the modification time of every directory and the `(mtime, size, inode)` of every file. A directory whose modification time hasn't changed can't have had
+entries added, removed or renamed, so it isn't listed again: its files are known from the snapshot and only `stat`-ed, since editing a file doesn't change
+the modification time of its directory. Files that disappeared are matched to new files by inode (or failing that, by content hash) so a rename keeps its
+tags. Modification times are compared in nanoseconds, as integers.
+
+While a TagSpace is open, a `TagSpaceWatcher` monitors the directory and reports the touched paths in coalesced batches, which ``changes_for_paths`` turns
+into the same kind of `Changes` as a full reconciliation.'''
+
+import os
+from os import path
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+from importer import PART_SUFFIX, hash_file
+from tagspace import META_FILENAME, new_file_entry, stamp_matches
+
+
+class Changes(NamedTuple):
+	added: List[str]
+	removed: List[str]
+	renamed: Dict[str, str]  # old path: new path
+	modified: Dict[str, list]  # path: [mtime_ns, size]
+
+	def __bool__(self):
+		return bool(self.added or self.removed or self.renamed or self.modified)
+
+
+def is_ignored(name: str) -> bool:
+	'''Whether a directory entry is TagViewer's own bookkeeping (or hidden) rather than media.'''
+	return name.startswith('.') or name == META_FILENAME or name.endswith(PART_SUFFIX) or name.endswith('.tmp')
+
+
+def _join(reldir: str, name: str) -> str:
+	return f'{reldir}/{name}' if reldir else name
+
+
+def empty_snapshot() -> dict:
+	return {'dirs': {}, 'files': {}}
+
+
+def scan(dirname: str, previous: Optional[dict]=None) -> dict:
+	'''Take a snapshot of the TagSpace in `dirname`, reusing the parts of `previous` that belong to directories which haven't changed since.'''
+	previous = previous or empty_snapshot()
+	previous_by_dir = {}
+	for relpath in previous['files']:
+		previous_by_dir.setdefault(relpath.rpartition('/')[0], []).append(relpath)
+	snapshot = empty_snapshot()
+	stack = ['']
+	while stack:
+		reldir = stack.pop()
+		try:
+			dir_mtime = os.stat(path.join(dirname, reldir)).st_mtime_ns
+		except OSError:
+			continue
+		known = previous['dirs'].get(reldir)
+		# TagViewer's own saves (tagviewer.json and the sidecar) change the mtime of the root, so the shortcut would never apply there; it's always scanned
+		if reldir and known is not None and known[0] == dir_mtime:
+			snapshot['dirs'][reldir] = known
+			for relpath in previous_by_dir.get(reldir, ()):
+				try:
+					stat = os.stat(path.join(dirname, relpath))
+				except OSError:  # removed since the directory was stat-ed; its mtime is different next time
+					continue
+				snapshot['files'][relpath] = [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+			stack.extend(_join(reldir, name) for name in known[1])
+			continue
+		subdirs = []
+		try:
+			with os.scandir(path.join(dirname, reldir)) as entries:
+				for entry in entries:
+					if is_ignored(entry.name): continue
+					if entry.is_dir(follow_symlinks=False): subdirs.append(entry.name)
+					elif entry.is_file():
+						stat = entry.stat()
+						snapshot['files'][_join(reldir, entry.name)] = [stat.st_mtime_ns, stat.st_size, entry.inode()]
+		except OSError:
+			continue
+		snapshot['dirs'][reldir] = [dir_mtime, subdirs]
+		stack.extend(_join(reldir, name) for name in subdirs)
+	return snapshot
+
+
+def _match_renames(missing: List[str], added: List[str], entries: Dict[str, dict], old_files: Dict[str, list], new_files: Dict[str, list],
+                   dirname: str) -> Dict[str, str]:
+	renamed = {}
+	by_inode = {}
+	for relpath in added: by_inode.setdefault((new_files[relpath][2], new_files[relpath][1]), []).append(relpath)
+	unmatched = []
+	for relpath in missing:
+		old = old_files.get(relpath)
+		candidates = by_inode.get((old[2], old[1])) if old is not None else None
+		if candidates: renamed[relpath] = candidates.pop()
+		else: unmatched.append(relpath)
+	# without a snapshot entry, fall back to the content hash the importer recorded; only new files of the same size are hashed
+	remaining = {relpath for candidates in by_inode.values() for relpath in candidates}
+	by_size = {}
+	for relpath in remaining: by_size.setdefault(new_files[relpath][1], []).append(relpath)
+	hashes = {}
+	for relpath in unmatched:
+		entry = entries[relpath]
+		if '_hash' not in entry: continue
+		for candidate in by_size.get(entry.get('_size'), ()):
+			if candidate not in hashes:
+				try:
+					hashes[candidate] = hash_file(path.join(dirname, candidate))
+				except OSError:
+					hashes[candidate] = None
+			if hashes[candidate] == entry['_hash']:
+				renamed[relpath] = candidate
+				by_size[entry['_size']].remove(candidate)
+				break
+	return renamed
+
+
+def diff(files: List[dict], previous: Optional[dict], snapshot: dict, dirname: str) -> Changes:
+	'''Work out how `files` has to change to match `snapshot`, a fresh snapshot of `dirname`. `previous` is the snapshot from the last reconciliation.'''
+	previous = previous or empty_snapshot()
+	entries = {entry['_path']: entry for entry in files}
+	current = snapshot['files']
+	added = [relpath for relpath in current if relpath not in entries]
+	missing = [relpath for relpath in entries if relpath not in current]
+	renamed = _match_renames(missing, added, entries, previous['files'], current, dirname) if missing and added else {}
+	renamed_to = set(renamed.values())
+	modified = {}
+	for relpath in entries:
+		old, new = previous['files'].get(relpath), current.get(relpath)
+		if new is not None and old is not None and old[:2] != new[:2]: modified[relpath] = new[:2]
+	return Changes(sorted(relpath for relpath in added if relpath not in renamed_to), [relpath for relpath in missing if relpath not in renamed], renamed,
+	               modified)
+
+
+def changes_for_paths(files: List[dict], touched: Iterable[str], moves: Dict[str, str], dirname: str) -> Changes:
+	'''Work out how `files` has to change after the paths in `touched` changed on disk, where `moves` maps the old paths of known moves to the new ones.
+
+	A move of a directory renames every known file under it. Files that are gone without a known move are removed.'''
+	entries = {entry['_path']: entry for entry in files}
+	added, removed, renamed, modified = [], [], {}, {}
+
+	def destination(relpath: str) -> str:
+		seen = {relpath}
+		while relpath in moves and moves[relpath] not in seen:  # moved again within the same batch
+			relpath = moves[relpath]
+			seen.add(relpath)
+		return relpath
+
+	def rename(old: str, new: str):
+		if new not in entries and path.isfile(path.join(dirname, new)): renamed[old] = new
+	for old, new in moves.items():
+		if old in entries: rename(old, destination(new))
+		else:  # a directory
+			prefix = old + '/'
+			for known in entries:
+				if known.startswith(prefix) and known not in renamed: rename(known, destination(new + known[len(old):]))
+	touched = set(touched)
+	renamed_to = set(renamed.values())
+	for relpath in sorted(touched | set(moves.values())):
+		if relpath in renamed_to or is_ignored(path.basename(relpath)): continue
+		try:
+			stat = os.stat(path.join(dirname, relpath))
+		except OSError:
+			if relpath in entries and relpath not in renamed: removed.append(relpath)
+			elif relpath not in entries:  # possibly a directory that was moved away as a whole
+				prefix = relpath + '/'
+				removed.extend(known for known in entries if known.startswith(prefix) and known not in renamed and known not in touched)
+			continue
+		if not path.isfile(path.join(dirname, relpath)): continue
+		if relpath not in entries: added.append(relpath)
+		elif not stamp_matches(entries[relpath], stat):
+			modified[relpath] = [stat.st_mtime_ns, stat.st_size]
+	return Changes(added, list(dict.fromkeys(removed)), renamed, modified)
+
+
+def edit_entries(files: List[dict], changes: Changes, snapshot: Optional[dict]=None) -> Tuple[List[dict], List[dict]]:
+	'''Rename and update the entries of `files` in place (except removed ones), and return the entries that were edited and the new entries, in path order.
+	`files` itself is left alone, so when nothing was removed it can be kept and the new entries appended to it.'''
+	removed = set(changes.removed)
+	edited = []
+	for entry in files:
+		relpath = entry['_path']
+		if relpath in removed or (relpath not in changes.renamed and relpath not in changes.modified): continue
+		if relpath in changes.renamed: entry['_path'] = relpath = changes.renamed[relpath]
+		if relpath in changes.modified:
+			entry['_mtime_ns'], entry['_size'] = changes.modified[relpath]
+			entry.pop('_mtime', None)  # from before `_mtime_ns`
+			entry.pop('_hash', None)
+		edited.append(entry)
+	added = []
+	for relpath in changes.added:
+		extra = {}
+		if snapshot is not None and relpath in snapshot['files']:
+			mtime_ns, size, _ = snapshot['files'][relpath]
+			extra = {'_mtime_ns': mtime_ns, '_size': size}
+		added.append(new_file_entry(relpath, **extra))
+	return edited, added
+
+
+def apply_changes(files: List[dict], changes: Changes, snapshot: Optional[dict]=None) -> List[dict]:
+	'''Return the new `files` list. Entries are updated in place; removed ones are left out, and new ones appended in path order.'''
+	removed = set(changes.removed)
+	kept = [entry for entry in files if entry['_path'] not in removed]
+	_, added = edit_entries(kept, changes, snapshot)
+	return kept + added
+
+
+class TagSpaceWatcher:
+	'''Watch a TagSpace directory (and its subdirectories) with `Gio.FileMonitor`, which is inotify on Linux.\n
+	Arguments: `dirname` (str), `on_changes` (function taking the set of touched paths and a dict of moves, both relative to `dirname`) | Keyword Arguments:
+	`delay` (int, milliseconds)
+
+	Events are collected until none has arrived for `delay` milliseconds, so that copying in a thousand files produces a handful of batches rather than a
+	thousand updates. `on_changes` is called on the main loop. Events for paths passed to ``suppress`` (and anything under them) are ignored until they're
+	passed to ``release``, for changes TagViewer makes itself and applies in one go, like moving files to the trash.'''
+	__slots__ = ['dirname', 'on_changes', 'delay', 'monitors', 'touched', 'moves', 'suppressed', 'timeout_id', 'Gio', 'GLib']
+
+	def __init__(self, dirname: str, on_changes: Callable[[Set[str], Dict[str, str]], None], delay: int=300):
+		from gi.repository import Gio, GLib
+		self.Gio, self.GLib = Gio, GLib
+		self.dirname = dirname
+		self.on_changes = on_changes
+		self.delay = delay
+		self.monitors = {}
+		self.touched = set()
+		self.moves = {}
+		self.suppressed = {}  # path: how many times it's suppressed
+		self.timeout_id = None
+		self._watch_tree('')
+
+	def suppress(self, relpaths: Iterable[str]):
+		for relpath in relpaths: self.suppressed[relpath] = self.suppressed.get(relpath, 0) + 1
+
+	def release(self, relpaths: Iterable[str]):
+		for relpath in relpaths:
+			if self.suppressed.get(relpath, 0) > 1: self.suppressed[relpath] -= 1
+			else: self.suppressed.pop(relpath, None)
+
+	def _is_suppressed(self, relpath: str) -> bool:
+		if not self.suppressed: return False
+		while relpath:
+			if relpath in self.suppressed: return True
+			relpath = relpath.rpartition('/')[0]
+		return False
+
+	def _watch_tree(self, reldir: str):
+		stack = [reldir]
+		while stack:
+			reldir = stack.pop()
+			if reldir in self.monitors: continue
+			absdir = path.join(self.dirname, reldir)
+			try:
+				monitor = self.Gio.File.new_for_path(absdir).monitor_directory(self.Gio.FileMonitorFlags.WATCH_MOVES, None)
+				with os.scandir(absdir) as entries:
+					stack.extend(_join(reldir, entry.name) for entry in entries if entry.is_dir(follow_symlinks=False) and not is_ignored(entry.name))
+			except (OSError, self.GLib.Error):
+				continue
+			monitor.connect('changed', self._handle_event)
+			self.monitors[reldir] = monitor
+
+	def _unwatch_tree(self, reldir: str):
+		'''Stop watching `reldir` and everything under it, so that a directory recreated at the same path gets a new monitor.'''
+		prefix = reldir + '/'
+		for watched in [watched for watched in self.monitors if watched == reldir or not reldir or watched.startswith(prefix)]:
+			self.monitors.pop(watched).cancel()
+
+	def _relative(self, gfile) -> Optional[str]:
+		'''The path of `gfile` relative to the TagSpace, or `None` if there's no file or it's outside the TagSpace.'''
+		if gfile is None: return None
+		relpath = path.relpath(gfile.get_path(), self.dirname).replace(os.sep, '/')
+		return None if relpath == '..' or relpath.startswith('../') else relpath
+
+	def _touch_tree(self, reldir: str):
+		'''Touch every file under `reldir`, since the files in a directory that was moved in produce no events of their own.'''
+		stack = [reldir]
+		while stack:
+			reldir = stack.pop()
+			try:
+				with os.scandir(path.join(self.dirname, reldir)) as entries:
+					for entry in entries:
+						if is_ignored(entry.name): continue
+						if entry.is_dir(follow_symlinks=False): stack.append(_join(reldir, entry.name))
+						elif entry.is_file(): self.touched.add(_join(reldir, entry.name))
+			except OSError:  # gone again already; its own events follow
+				continue
+
+	def _handle_event(self, monitor, gfile, other_gfile, event):
+		events = self.Gio.FileMonitorEvent
+		relpath = self._relative(gfile)
+		if relpath is None: return
+		if self._is_suppressed(relpath):
+			if event in (events.DELETED, events.MOVED_OUT, events.RENAMED): self._unwatch_tree(relpath)
+			return
+		if event in (events.RENAMED, events.MOVED_OUT):  # from here to `other_gfile`, which is outside the TagSpace for a move out of it
+			self._unwatch_tree(relpath)
+			self.touched.add(relpath)
+			other = self._relative(other_gfile)
+			if other is not None:
+				self.moves[relpath] = other
+				relpath = other
+		elif event == events.MOVED_IN:  # from `other_gfile`, which is outside the TagSpace for a move into it
+			other = self._relative(other_gfile)
+			if other is not None:
+				self._unwatch_tree(other)
+				self.touched.add(other)
+				self.moves[other] = relpath
+		elif event == events.DELETED:
+			self._unwatch_tree(relpath)
+		elif event not in (events.CREATED, events.CHANGES_DONE_HINT):
+			return
+		if path.isdir(path.join(self.dirname, relpath)):
+			self._watch_tree(relpath)
+			self._touch_tree(relpath)
+		else:
+			self.touched.add(relpath)
+		if self.timeout_id is not None: self.GLib.source_remove(self.timeout_id)
+		self.timeout_id = self.GLib.timeout_add(self.delay, self._flush)
+
+	def _flush(self):
+		self.timeout_id = None
+		touched, moves = self.touched, self.moves
+		self.touched, self.moves = set(), {}
+		self.on_changes(touched, moves)
+		return False
+
+	def stop(self):
+		if self.timeout_id is not None: self.GLib.source_remove(self.timeout_id)
+		for monitor in self.monitors.values(): monitor.cancel()
+		self.monitors.clear()
@@ -0,0 +1,194 @@
+'''A search index over every TagSpace in the open history, so items can be found without opening (or even loading) the TagSpace that holds them.
+
+The index is an SQLite database in the user cache directory. It holds the title, path, tag names and prop values of every item. Text searches use an FTS5
+table where SQLite has one and fall back to `LIKE` where it doesn't. Each TagSpace is stored with the modification time and size of its `tagviewer.json`,
+so ``SearchIndex.sync`` only re-reads the TagSpaces that changed since they were indexed, and each item with a signature of what was indexed, so only the
+items that changed are rewritten. TagViewer syncs the index in the background at startup and after opening or saving a TagSpace.
+
+SQLite connections can't be shared between threads, so every thread that uses a `SearchIndex` gets its own connection.'''
+
+import json
+import os
+import sqlite3
+import threading
+from os import path
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+from tagspace import load_tagspace, meta_path
+
+INDEX_FILENAME = 'search.sqlite'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tagspaces (id INTEGER PRIMARY KEY, dir TEXT UNIQUE NOT NULL, title TEXT, mtime_ns INTEGER, size INTEGER);
+CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, tagspace INTEGER NOT NULL, path TEXT NOT NULL, title TEXT, tags TEXT, props TEXT, signature TEXT);
+CREATE INDEX IF NOT EXISTS items_by_tagspace ON items (tagspace);
+CREATE TABLE IF NOT EXISTS item_tags (item INTEGER NOT NULL, tag TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS item_tags_by_tag ON item_tags (tag, item);
+CREATE INDEX IF NOT EXISTS item_tags_by_item ON item_tags (item);
+CREATE TABLE IF NOT EXISTS item_props (item INTEGER NOT NULL, prop TEXT NOT NULL, value);
+CREATE INDEX IF NOT EXISTS item_props_by_value ON item_props (prop, value, item);
+CREATE INDEX IF NOT EXISTS item_props_by_item ON item_props (item);
+'''
+
+
+class Hit(NamedTuple):
+	tagspace: str
+	tagspace_title: str
+	path: str
+	title: str
+
+
+def default_path() -> str:
+	import appdirs
+	os.makedirs(appdirs.user_cache_dir('tagviewer'), exist_ok=True)
+	return path.join(appdirs.user_cache_dir('tagviewer'), INDEX_FILENAME)
+
+
+def _fts_query(text: str) -> str:
+	'''Turn free text into an FTS5 query matching items that contain every word, each as a prefix.'''
+	return ' '.join('"' + word.replace('"', '""') + '"*' for word in text.split())
+
+
+def _like_pattern(text: str) -> str:
+	return '%' + text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+class SearchIndex:
+	__slots__ = ['filename', '_local', '_write_lock', 'has_fts']
+
+	def __init__(self, filename: Optional[str]=None):
+		self.filename = filename or default_path()
+		self._local = threading.local()
+		self._write_lock = threading.Lock()
+		self.has_fts = True
+		self._connection()
+
+	def _connection(self) -> sqlite3.Connection:
+		connection = getattr(self._local, 'connection', None)
+		if connection is None:
+			connection = sqlite3.connect(self.filename)
+			connection.execute('PRAGMA journal_mode=WAL')  # readers (the search box) don't wait for a reindex on another thread
+			connection.executescript(_SCHEMA)
+			if 'signature' not in (row[1] for row in connection.execute('PRAGMA table_info(items)')):  # an index from before signatures; everything is rewritten
+				connection.execute('ALTER TABLE items ADD COLUMN signature TEXT')
+			try:
+				connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5 (path, title, tags, props)')
+			except sqlite3.OperationalError:
+				self.has_fts = False
+			self._local.connection = connection
+		return connection
+
+	def _remove_items(self, connection: sqlite3.Connection, item_ids: List[int]):
+		for start in range(0, len(item_ids), 500):  # SQLite limits the number of parameters
+			chunk = item_ids[start:start + 500]
+			ids = f'({", ".join("?" * len(chunk))})'
+			if self.has_fts: connection.execute(f'DELETE FROM items_fts WHERE rowid IN {ids}', chunk)
+			connection.execute(f'DELETE FROM item_tags WHERE item IN {ids}', chunk)
+			connection.execute(f'DELETE FROM item_props WHERE item IN {ids}', chunk)
+			connection.execute(f'DELETE FROM items WHERE id IN {ids}', chunk)
+
+	def _remove(self, connection: sqlite3.Connection, tagspace_id: int):
+		items = '(SELECT id FROM items WHERE tagspace = ?)'
+		if self.has_fts: connection.execute(f'DELETE FROM items_fts WHERE rowid IN {items}', (tagspace_id,))
+		connection.execute(f'DELETE FROM item_tags WHERE item IN {items}', (tagspace_id,))
+		connection.execute(f'DELETE FROM item_props WHERE item IN {items}', (tagspace_id,))
+		connection.execute('DELETE FROM items WHERE tagspace = ?', (tagspace_id,))
+
+	def index_tagspace(self, dirname: str, meta: dict, stat: Optional[os.stat_result]=None):
+		'''(Re)index the TagSpace in `dirname` from `meta`. `stat` is the `os.stat` of its `tagviewer.json` as of `meta`, and defaults to the current one.
+
+		Only the items whose path, title, tags or props changed since they were indexed are rewritten. Deleted tags aren't indexed.'''
+		stat = stat or os.stat(meta_path(dirname))
+		tag_list = meta.get('tagList', [])
+		deleted = set(meta.get('deletedTags', ()))
+		connection = self._connection()
+		with self._write_lock, connection:
+			row = connection.execute('SELECT id FROM tagspaces WHERE dir = ?', (dirname,)).fetchone()
+			if row is None:
+				tagspace_id = connection.execute('INSERT INTO tagspaces (dir, title, mtime_ns, size) VALUES (?, ?, ?, ?)',
+				                                 (dirname, meta.get('title'), stat.st_mtime_ns, stat.st_size)).lastrowid
+				indexed = {}
+			else:
+				tagspace_id = row[0]
+				connection.execute('UPDATE tagspaces SET title = ?, mtime_ns = ?, size = ? WHERE id = ?',
+				                   (meta.get('title'), stat.st_mtime_ns, stat.st_size, tagspace_id))
+				indexed = {(path, signature): item_id for (item_id, path, signature) in
+				           connection.execute('SELECT id, path, signature FROM items WHERE tagspace = ?', (tagspace_id,))}
+			added = []
+			for entry in meta.get('files', []):
+				tags = [tag_list[i][0] for i in entry.get('tags', ()) if i < len(tag_list) and i not in deleted]
+				props = entry.get('props', {})
+				signature = json.dumps([entry.get('title'), tags, props], sort_keys=True)
+				if indexed.pop((entry['_path'], signature), None) is None: added.append((entry, tags, props, signature))
+			self._remove_items(connection, list(indexed.values()))  # gone, or changed and about to be added again
+			for entry, tags, props, signature in added:
+				props_text = ' '.join(str(value) for value in props.values())
+				item_id = connection.execute('INSERT INTO items (tagspace, path, title, tags, props, signature) VALUES (?, ?, ?, ?, ?, ?)',
+				                             (tagspace_id, entry['_path'], entry.get('title'), '\n'.join(tags), json.dumps(props), signature)).lastrowid
+				if self.has_fts:
+					connection.execute('INSERT INTO items_fts (rowid, path, title, tags, props) VALUES (?, ?, ?, ?, ?)',
+					                   (item_id, entry['_path'], entry.get('title'), ' '.join(tags), props_text))
+				connection.executemany('INSERT INTO item_tags (item, tag) VALUES (?, ?)', ((item_id, tag) for tag in tags))
+				connection.executemany('INSERT INTO item_props (item, prop, value) VALUES (?, ?, ?)',
+				                       ((item_id, prop, value) for (prop, value) in props.items() if isinstance(value, (str, int, float, bool))))
+
+	def remove_tagspace(self, dirname: str):
+		connection = self._connection()
+		with self._write_lock, connection:
+			row = connection.execute('SELECT id FROM tagspaces WHERE dir = ?', (dirname,)).fetchone()
+			if row is not None:
+				self._remove(connection, row[0])
+				connection.execute('DELETE FROM tagspaces WHERE id = ?', (row[0],))
+
+	def sync(self, dirs: Iterable[str], job=None) -> int:
+		'''Make the index cover exactly the TagSpaces in `dirs`, re-reading only those whose `tagviewer.json` changed since they were indexed. Returns the
+		number of TagSpaces that were (re)indexed. Can be the target of a `Job` by passing the job.'''
+		dirs = [dirname for dirname in dict.fromkeys(dirs) if dirname is not None]
+		connection = self._connection()
+		known = {row[0]: (row[1], row[2]) for row in connection.execute('SELECT dir, mtime_ns, size FROM tagspaces')}
+		for dirname in set(known) - set(dirs): self.remove_tagspace(dirname)
+		reindexed = 0
+		for done, dirname in enumerate(dirs, start=1):
+			if job is not None:
+				job.check()
+				job.progress(done, len(dirs), dirname)
+			try:
+				stat = os.stat(meta_path(dirname))
+			except OSError:
+				if dirname in known: self.remove_tagspace(dirname)
+				continue
+			if known.get(dirname) == (stat.st_mtime_ns, stat.st_size): continue
+			try:
+				meta = load_tagspace(dirname)
+			except (OSError, ValueError):
+				continue
+			self.index_tagspace(dirname, meta, stat)
+			reindexed += 1
+		return reindexed
+
+	def search(self, text: str='', tags: Sequence[str]=(), props: Sequence[Tuple[str, object]]=(), limit: Optional[int]=100) -> List[Hit]:
+		'''Find items across all indexed TagSpaces.\n
+		Keyword Arguments: `text` (str, words that must all appear, as prefixes, in the item's path, title, tags or prop values), `tags` (tag names the item
+		must all have), `props` (`(prop, value)` pairs the item must all have), `limit` (int or None)'''
+		conditions, params = [], []
+		if text.strip():
+			if self.has_fts:
+				conditions.append('i.id IN (SELECT rowid FROM items_fts WHERE items_fts MATCH ?)')
+				params.append(_fts_query(text))
+			else:
+				for word in text.split():
+					conditions.append("(i.path LIKE ? ESCAPE '\\' OR i.title LIKE ? ESCAPE '\\' OR i.tags LIKE ? ESCAPE '\\' OR i.props LIKE ? ESCAPE '\\')")
+					params.extend([_like_pattern(word)] * 4)
+		for tag in tags:
+			conditions.append('i.id IN (SELECT item FROM item_tags WHERE tag = ?)')
+			params.append(tag)
+		for prop, value in props:
+			conditions.append('i.id IN (SELECT item FROM item_props WHERE prop = ? AND value = ?)')
+			params.extend((prop, value))
+		sql = 'SELECT t.dir, t.title, i.path, i.title FROM items i JOIN tagspaces t ON t.id = i.tagspace'
+		if conditions: sql += ' WHERE ' + ' AND '.join(conditions)
+		sql += ' ORDER BY t.dir, i.id'
+		if limit is not None:
+			sql += ' LIMIT ?'
+			params.append(limit)
+		return [Hit(*row) for row in self._connection().execute(sql, params)]
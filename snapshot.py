@@ -0,0 +1,160 @@
+'''Binary snapshots of the open TagSpace, for reopening it at launch without parsing `tagviewer.json` or rebuilding its indexes.
+
+A snapshot is written to the cache directory when TagViewer exits, unless `tagviewer.json` was changed by something else while it was open. Its header
+records the modification time, size and BLAKE2 hash of the `tagviewer.json` it was taken from, followed by a table of sections in `marshal` format: the
+TagSpace directory, the metadata, the file index and, if they were built, the filter indexes. ``resume`` memory-maps the snapshot and uses it only if the
+header still matches the file on disk and each section it reads matches its checksum; otherwise, or if it was written by another version of Python, it
+returns `None` and the TagSpace is loaded as usual. Nothing in here depends on GTK.
+
+The sections are read straight out of the mapping, which is closed once the TagSpace is restored. The filter indexes are copied out of it and only unmarshalled
+when filters are first applied (see ``QueryEngine.restore_indexes``).'''
+
+import gc
+import hashlib
+import marshal
+import mmap
+import os
+import struct
+import sys
+import zlib
+from typing import Dict, Optional, Tuple
+
+from stateman import StateMan
+from tagspace import meta_path
+
+SNAPSHOT_FILENAME = 'resume.snapshot'
+MAGIC = b'TVSNAP01'
+_HEADER = struct.Struct('<8sHHqq32sI')  # magic, marshal version, Python version, source mtime (ns), source size, source hash, number of sections
+_SECTION = struct.Struct('<16sQQI')  # name, offset, length, CRC-32
+_PYTHON_VERSION = sys.version_info[0] * 100 + sys.version_info[1]  # the marshal format can change between versions
+
+
+def source_stat(dirname: str) -> Tuple[int, int]:
+	'''Return the modification time and size of the `tagviewer.json` of the TagSpace in `dirname`.'''
+	stat = os.stat(meta_path(dirname))
+	return stat.st_mtime_ns, stat.st_size
+
+
+def source_stamp(dirname: str) -> Tuple[int, int, bytes]:
+	'''Return the modification time, size and hash of the `tagviewer.json` of the TagSpace in `dirname`.'''
+	with open(meta_path(dirname), 'rb') as meta_file:
+		stat = os.fstat(meta_file.fileno())
+		if stat.st_size == 0: return stat.st_mtime_ns, 0, hashlib.blake2b(digest_size=32).digest()
+		with mmap.mmap(meta_file.fileno(), 0, access=mmap.ACCESS_READ) as mapping:
+			return stat.st_mtime_ns, stat.st_size, hashlib.blake2b(mapping, digest_size=32).digest()
+
+
+def _unmarshal(payload):
+	collecting = gc.isenabled()
+	gc.disable()  # unmarshalling allocates a container per file entry, which would set off the cyclic collector over and over
+	try:
+		return marshal.loads(payload)
+	except (EOFError, ValueError, TypeError):
+		return None
+	finally:
+		if collecting: gc.enable()
+
+
+def write(filename: str, dirname: str, sections: Dict[str, object]):
+	'''Write a snapshot of `sections` (plain data: dicts, lists, strings, numbers, ...) taken from the TagSpace in `dirname`.'''
+	payloads = [(b'directory', marshal.dumps(dirname))] + [(name.encode(), marshal.dumps(value)) for (name, value) in sections.items()]
+	offset = _HEADER.size + _SECTION.size * len(payloads)
+	table = []
+	for name, payload in payloads:
+		table.append(_SECTION.pack(name, offset, len(payload), zlib.crc32(payload)))
+		offset += len(payload)
+	mtime_ns, size, digest = source_stamp(dirname)
+	tmp_path = filename + '.tmp'
+	with open(tmp_path, 'wb') as snapshot_file:
+		snapshot_file.write(_HEADER.pack(MAGIC, marshal.version, _PYTHON_VERSION, mtime_ns, size, digest, len(payloads)))
+		snapshot_file.writelines(table)
+		snapshot_file.writelines(payload for (_, payload) in payloads)
+	os.replace(tmp_path, filename)
+
+
+class Snapshot:
+	'''A memory-mapped snapshot whose header has been checked against its TagSpace. Use ``open_snapshot`` to get one, in a `with` statement so the mapping is
+	closed afterwards.'''
+	__slots__ = ['mapping', 'sections']
+
+	def __init__(self, mapping: mmap.mmap, sections: Dict[str, Tuple[int, int, int]]):
+		self.mapping = mapping
+		self.sections = sections
+
+	def __enter__(self) -> 'Snapshot':
+		return self
+
+	def __exit__(self, *_):
+		self.close()
+
+	def close(self):
+		self.mapping.close()
+
+	def read(self, name: str) -> Optional[bytes]:
+		'''Return a copy of the marshalled contents of a section, or `None` if there's no such section or it's damaged.'''
+		if name not in self.sections: return None
+		offset, length, checksum = self.sections[name]
+		payload = self.mapping[offset:offset + length]
+		if len(payload) != length or zlib.crc32(payload) != checksum: return None
+		return payload
+
+	def load(self, name: str):
+		'''Return the contents of a section, or `None` if there's no such section or it's damaged.'''
+		if name not in self.sections: return None
+		offset, length, checksum = self.sections[name]
+		with memoryview(self.mapping)[offset:offset + length] as payload:
+			if len(payload) != length or zlib.crc32(payload) != checksum: return None
+			return _unmarshal(payload)
+
+
+def open_snapshot(filename: str, dirname: str) -> Optional[Snapshot]:
+	'''Map the snapshot in `filename`, returning `None` if it's missing, unreadable or wasn't taken from the current `tagviewer.json` of `dirname`.'''
+	try:
+		with open(filename, 'rb') as snapshot_file:
+			mapping = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):  # missing or empty
+		return None
+	try:
+		magic, marshal_version, python_version, mtime_ns, size, digest, count = _HEADER.unpack_from(mapping)
+		if magic == MAGIC and marshal_version == marshal.version and python_version == _PYTHON_VERSION:
+			sections = {}
+			for i in range(count):
+				name, offset, length, checksum = _SECTION.unpack_from(mapping, _HEADER.size + _SECTION.size * i)
+				sections[name.rstrip(b'\0').decode()] = (offset, length, checksum)
+			snapshot = Snapshot(mapping, sections)
+			if snapshot.load('directory') == dirname:
+				stat = os.stat(meta_path(dirname))
+				if (stat.st_mtime_ns, stat.st_size) == (mtime_ns, size) and source_stamp(dirname) == (mtime_ns, size, digest): return snapshot
+	except (OSError, ValueError, struct.error):  # truncated, or the TagSpace is gone
+		pass
+	mapping.close()
+	return None
+
+
+def save(filename: str, model: StateMan, written: Tuple[int, int]) -> bool:
+	'''Write a snapshot of the TagSpace open in `model`, with its file index and filter indexes. `written` is the ``source_stat`` of its `tagviewer.json`
+	when it was last loaded or saved, which must hold exactly the metadata in `model`; if the file was changed since (by the CLI, say), no snapshot is
+	written, since it would stamp the other metadata. Returns whether one was written.'''
+	meta = model['tagviewer_meta']
+	if source_stat(model['open_directory']) != written: return False
+	sections = {'meta': meta, 'file_index': model['file_index'].export()}
+	indexes = model.refs['query_engine'].export_indexes(model['files'], meta)
+	if indexes is not None: sections['query'] = indexes
+	write(filename, model['open_directory'], sections)
+	return True
+
+
+def resume(filename: str, dirname: str, model: StateMan) -> Optional[dict]:
+	'''Restore the indexes of `model` from the snapshot in `filename` and return the metadata to open, or return `None` if the snapshot can't be used for
+	the TagSpace in `dirname`.'''
+	snapshot = open_snapshot(filename, dirname)
+	if snapshot is None: return None
+	with snapshot:
+		meta = snapshot.load('meta')
+		file_index = snapshot.load('file_index')
+		indexes = snapshot.read('query')
+	if not isinstance(meta, dict) or file_index is None: return None
+	files = meta.setdefault('files', [])
+	model.refs['file_index'].restore(files, file_index)
+	model.refs['query_engine'].restore_indexes(files, meta, lambda: None if indexes is None else _unmarshal(indexes))
+	return meta
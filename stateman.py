@@ -1,4 +1,4 @@
-'''StateMan: A tiny explicit state manager. No dependencies and only 92 SLOCs (3157 bytes minified) according to Al Danial's `cloc` utility.
+'''StateMan: A tiny explicit state manager with no dependencies.
 
 Copyright (C) 2020  Matt Fellenz
 
@@ -36,18 +36,37 @@ Vocabulary:
 or as a dynamic property being updated due to one of its dependencies updating. Similar to a "watcher" in other state management frameworks.
 - Model: in the Model–View–Controller pattern, the model is "the application's dynamic data structure, independent of the user interface." (from Wikipedia)
 
-At the moment there is no way to "delete" a property, binding, or dependency, simply because the need has not come up for me and so it's not worth it to
-needlessly expand the code. However, I may decide to implement it later, or if you submit a PR implementing it I will most likely merge it.'''
+Bindings are removed with ``unbind`` and properties with ``untrack``. A binding made from something short-lived, like a dialog or a widget for one item,
+can instead be made with `weak=True`, so that StateMan doesn't keep the handler (or, for a method, its object) alive and drops the binding by itself once the
+handler is collected.'''
 
 from itertools import chain
+from types import MethodType
 from typing import Callable, List, Tuple, Union, Optional
-from functools import reduce
+from functools import partial, reduce
+from weakref import WeakMethod, ref
+
+
+class _WeakHandler:
+	'''Internal wrapper for a handler bound with `weak=True`, calling the handler for as long as it's alive.'''
+	__slots__ = ['ref']
+
+	def __init__(self, handler, on_collected):
+		self.ref = WeakMethod(handler, on_collected) if isinstance(handler, MethodType) else ref(handler, on_collected)
+
+	def __call__(self, model, prop):
+		handler = self.ref()
+		if handler is not None: handler(model, prop)
+
+	def __repr__(self):
+		handler = self.ref()
+		return getattr(handler, '__qualname__', repr(handler))
 
 
 class StateMan:
-	__slots__ = ['bindings', 'global_bindings', 'dependencies', 'dependents', 'static_props', 'dynamic_props', 'refs', 'cache', 'nocache']
+	__slots__ = ['bindings', 'global_bindings', 'dependencies', 'dependents', 'static_props', 'dynamic_props', 'refs', 'cache', 'nocache', 'tracer']
 
-	def __init__(self, props: dict, literal: bool=False, refs: Optional[dict]=None):
+	def __init__(self, props: dict, literal: bool=False, refs: Optional[dict]=None, tracer=None):
 		'''Create a new StateMan instance.\n
 		Arguments: `props` (dict) | Keyword Arguments: `literal` (bool, default False), `refs` (dict, default {})
 
@@ -67,15 +86,20 @@ class StateMan:
 		`refs` is included specifically for when certain objects need to be accessed by the handlers, like a window object for a GUI app.
 		These could theoretically be stored in static properties, but for large objects that don't need to be tracked, moving them to `refs` may lead to
 		slight performance improvements in some circumstances. However, the main reason you would do this is to prevent it from being bound, which would
-		impact the performance.'''
+		impact the performance.
+
+		`tracer` is an optional span tracer (an object with an `enabled` attribute and a `span(name, **args)` method returning a context manager). While it's
+		enabled, every propagation of a change and every handler it calls is recorded as a span. It can also be set later through the `tracer` attribute.'''
 		self.bindings = {}
 		self.global_bindings = []
 		self.dependents = {}
+		self.dependencies = {}
 		self.static_props = {}
 		self.dynamic_props = {}
 		self.cache = {}
 		self.nocache = []
 		self.refs = refs if refs is not None else {}
+		self.tracer = tracer
 
 		if literal:
 			self.static_props = props
@@ -86,9 +110,10 @@ class StateMan:
 				if StateMan._is_dynamic_prop_definition(value): self.track_dynamic(prop, *value)
 				else: self.track_static(prop, value)
 
-	def bind(self, prop_or_props: Union[any, List[any], Tuple[any]], handler: Callable[[dict, any], None]):
+	def bind(self, prop_or_props: Union[any, List[any], Tuple[any]], handler: Callable[[dict, any], None], weak: bool=False):
 		'''Create a binding to a property or properties.\n
-		Arguments: `prop_or_props` (property name or list/tuple of property names), `handler` (function taking the model and the name of the changed property)
+		Arguments: `prop_or_props` (property name or list/tuple of property names), `handler` (function taking the model and the name of the changed property) |
+		Keyword Arguments: `weak` (bool, default False)
 
 		If you are binding to a single property, give the name of that property (whether it be a string, number, or anything else that can be used as a
 		dictionary key) for the `prop_or_props` argument.
@@ -96,15 +121,44 @@ class StateMan:
 
 		The handler takes two arguments: the model, which is just the StateMan instance, and the name of the property that changed. While for bindings to a single
 		property it may seem redundant to provide the name of the changed property, it is important for bindings to multiple properties. Thus, for consistency's
-		sake, it is provided for all handlers.'''
+		sake, it is provided for all handlers.
+
+		With `weak`, only a weak reference to the handler is kept (for a bound method, to its object), and the binding is removed once the handler is
+		garbage collected. Keep a reference to a weakly bound lambda or closure yourself, or it will be collected right away.'''
 		if isinstance(prop_or_props, (list, tuple)):
-			for prop in prop_or_props: self.bind(prop, handler)
+			for prop in prop_or_props: self.bind(prop, handler, weak)
 		else:
 			if prop_or_props in self.static_props or prop_or_props in self.dynamic_props:
+				if weak: handler = _WeakHandler(handler, partial(self._drop_weak_binding, prop_or_props))
 				if prop_or_props not in self.bindings: self.bindings[prop_or_props] = [handler]
 				else: self.bindings[prop_or_props].append(handler)
 			else: self.__missing__(prop_or_props)
 
+	def unbind(self, prop_or_props: Union[any, List[any], Tuple[any]], handler: Callable[[dict, any], None]):
+		'''Remove a binding made with ``bind``, weak or not.\n
+		Arguments: `prop_or_props` (property name or list/tuple of property names), `handler` (the handler that was bound)
+
+		Raises a `ValueError` if the handler isn't bound to the property. A bound method can be given as `obj.method` again, since it compares equal to the one
+		that was bound.'''
+		if isinstance(prop_or_props, (list, tuple)):
+			for prop in prop_or_props: self.unbind(prop, handler)
+			return
+		if prop_or_props not in self: self.__missing__(prop_or_props)
+		handlers = self.bindings.get(prop_or_props, [])
+		for (i, bound) in enumerate(handlers):
+			if bound == handler or (isinstance(bound, _WeakHandler) and bound.ref() == handler):
+				del handlers[i]
+				if not handlers: del self.bindings[prop_or_props]
+				return
+		raise ValueError(f'Handler {handler!r} is not bound to property {prop_or_props}')
+
+	def _drop_weak_binding(self, prop, dead_ref):
+		'''Internal method called when the handler of a weak binding is collected, to remove the binding.'''
+		handlers = self.bindings.get(prop)
+		if handlers is None: return
+		handlers[:] = [handler for handler in handlers if not (isinstance(handler, _WeakHandler) and handler.ref is dead_ref)]
+		if not handlers: del self.bindings[prop]
+
 	def bind_all(self, handler: Callable[[str, dict, any], None]):
 		'''Bind to any change.
 		Arguments: `handler` (function taking the type of event ['new' or 'changed'], the model, and the name of the changed or newly created property)
@@ -139,12 +193,32 @@ class StateMan:
 		properties are cached.'''
 		if prop not in self.dependents: self.dependents[prop] = []
 		self.dynamic_props[prop] = (getter, setter)
+		self.dependencies[prop] = tuple(dependencies)
 		for dependency in dependencies:
 			if dependency not in self.dependents: self.dependents[dependency] = [prop]
 			else: self.dependents[dependency].append(prop)
 		if not cache: self.nocache.append(prop)
 		for handler in self.global_bindings: handler('new', self, prop)
 
+	def untrack(self, prop):
+		'''Stop tracking a property, removing its value, its bindings and its place in the dependency graph.\n
+		Arguments: `prop` (the name of the property)
+
+		Raises a `ValueError` if other dynamic properties depend on it; untrack those first.'''
+		if prop not in self: self.__missing__(prop)
+		dependents = [dependent for dependent in self.dependents.get(prop, ()) if dependent != prop]
+		if dependents: raise ValueError(f'Property {prop} cannot be untracked while it is a dependency of {", ".join(map(str, dependents))}')
+		self.static_props.pop(prop, None)
+		self.dynamic_props.pop(prop, None)
+		self.cache.pop(prop, None)
+		self.bindings.pop(prop, None)
+		if prop in self.nocache: self.nocache.remove(prop)
+		for dependency in set(self.dependencies.pop(prop, ())):
+			dependents = [dependent for dependent in self.dependents.get(dependency, ()) if dependent != prop]
+			if dependents or dependency in self: self.dependents[dependency] = dependents
+			else: self.dependents.pop(dependency, None)  # only ever mentioned as a dependency of `prop`
+		self.dependents.pop(prop, None)
+
 	def __len__(self):
 		return len(self.static_props) + len(self.dynamic_props)
 
@@ -188,10 +262,21 @@ class StateMan:
 		deps = list(dict.fromkeys(self._walk_deps(item)))
 		for prop in deps:
 			if prop in self.dynamic_props and prop not in self.nocache and prop in self.cache: self.cache.pop(prop)
+		tracer = self.tracer
+		if tracer is not None and tracer.enabled:
+			with tracer.span(f'StateMan: {item}', dependents=len(deps) - 1):
+				self._call_bindings(deps, tracer)
+		else: self._call_bindings(deps, None)
+
+	def _call_bindings(self, deps, tracer):
+		'''Internal method to call the handlers bound to each of the properties in `deps`, recording a span for each handler if `tracer` is given.'''
 		for prop in deps:
 			for handler in self.global_bindings: handler('changed', self, prop)
 			if prop in self.bindings:
-				for handler in self.bindings[prop]: handler(self, prop)
+				for handler in tuple(self.bindings[prop]):  # handlers may bind or unbind
+					if tracer is None: handler(self, prop)
+					else:
+						with tracer.span(getattr(handler, '__qualname__', repr(handler)), prop=prop): handler(self, prop)
 
 	def __setitem__(self, item, value):
 		if item in self.dynamic_props:
@@ -0,0 +1,104 @@
+'''Reading and writing TagSpaces on disk.
+
+A TagSpace is a directory containing a `tagviewer.json` metadata file alongside the media it describes. Nothing in here depends on GTK.'''
+
+import json
+import os
+import threading
+from os import path
+from typing import Callable, List, Optional
+
+META_FILENAME = 'tagviewer.json'
+SIDECAR_FILENAME = '.tagviewer-cache.json'
+_sidecar_lock = threading.Lock()
+
+
+def meta_path(dirname: str) -> str:
+	return path.join(dirname, META_FILENAME)
+
+
+def is_tagspace(dirname: str) -> bool:
+	return path.isfile(meta_path(dirname))
+
+
+def load_tagspace(dirname: str, number: bool=True) -> dict:
+	'''Load the metadata of the TagSpace in `dirname`, giving an `_id` to any file that has none (see ``assign_ids``) unless `number` is false.'''
+	with open(meta_path(dirname), 'r') as meta_file:
+		meta = json.load(meta_file)
+	if number: assign_ids(meta)
+	return meta
+
+
+def assign_ids(meta: dict, entries: Optional[List[dict]]=None) -> bool:
+	'''Give each file entry in `entries` (by default, every file of `meta`) that has no `_id` the next one from the metadata's `nextId` counter.
+
+	An `_id` is an integer that stays the same when the file is renamed, moved in the list or filtered out. When every file is numbered, an `_id` already
+	taken by an earlier entry (a copied entry) is replaced too, and the counter is moved past the highest `_id` in use. Returns whether `meta` was changed.'''
+	previous = meta.get('nextId')
+	next_id = meta.get('nextId', 0)
+	if entries is None:
+		entries = meta.get('files', [])
+		next_id = max([next_id] + [entry['_id'] + 1 for entry in entries if isinstance(entry.get('_id'), int)])
+	seen = set()
+	for entry in entries:
+		if not isinstance(entry.get('_id'), int) or entry['_id'] in seen:
+			entry['_id'] = next_id
+			next_id += 1
+		seen.add(entry['_id'])
+	meta['nextId'] = next_id
+	return next_id != previous
+
+
+def save_tagspace(dirname: str, meta: dict):
+	'''Write the metadata of the TagSpace in `dirname`.
+
+	The file is written next to the real one and then moved into place, so an interrupted save never leaves a truncated `tagviewer.json` behind.'''
+	tmp_path = meta_path(dirname) + '.tmp'
+	with open(tmp_path, 'w') as meta_file:
+		json.dump(meta, meta_file)
+	os.replace(tmp_path, meta_path(dirname))
+
+
+def new_file_entry(relpath: str, **extra) -> dict:
+	'''Create the entry for a file in the `files` list of a TagSpace.
+
+	`_path` is relative to the TagSpace directory. Keys starting with an underscore are maintained by TagViewer rather than edited by the user.'''
+	entry = {'_path': relpath, 'title': path.splitext(path.basename(relpath))[0], 'tags': [], 'props': {}}
+	entry.update(extra)
+	return entry
+
+
+def stamp_matches(entry: dict, stat: os.stat_result) -> bool:
+	'''Whether the size and modification time recorded in a file entry (`_size` and `_mtime_ns`) still match `stat`. Entries recorded before `_mtime_ns` are
+	compared by their `_mtime` in seconds.'''
+	if entry.get('_size') != stat.st_size: return False
+	return entry['_mtime_ns'] == stat.st_mtime_ns if entry.get('_mtime_ns') is not None else entry.get('_mtime') == stat.st_mtime
+
+
+def load_sidecar(dirname: str) -> dict:
+	'''Load the sidecar cache of the TagSpace in `dirname`: data that TagViewer derives from the files and can always recompute, like content hashes.
+
+	A missing or unreadable sidecar is not an error; an empty one is returned instead.'''
+	try:
+		with open(path.join(dirname, SIDECAR_FILENAME), 'r') as sidecar_file:
+			sidecar = json.load(sidecar_file)
+	except (OSError, ValueError):
+		sidecar = {}
+	sidecar.setdefault('files', {})
+	return sidecar
+
+
+def update_sidecar(dirname: str, change: Callable[[dict], None]):
+	'''Apply `change` to the sidecar cache of the TagSpace in `dirname` and write it. The sidecar is read again under a lock right before, so threads that
+	update different parts of it (the reconciler's snapshot, the duplicate finder's fingerprints) don't undo each other's work.'''
+	with _sidecar_lock:
+		sidecar = load_sidecar(dirname)
+		change(sidecar)
+		save_sidecar(dirname, sidecar)
+
+
+def save_sidecar(dirname: str, sidecar: dict):
+	tmp_path = path.join(dirname, SIDECAR_FILENAME + '.tmp')
+	with open(tmp_path, 'w') as sidecar_file:
+		json.dump(sidecar, sidecar_file)
+	os.replace(tmp_path, path.join(dirname, SIDECAR_FILENAME))
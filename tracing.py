@@ -0,0 +1,108 @@
+'''Span tracing of TagViewer's hot paths, written out in the Chrome trace event format (open it in Perfetto or chrome://tracing).
+
+Tracing is off by default and then costs one attribute check per span. It's turned on by the `TAGVIEWER_TRACE` environment variable, whose value is the
+file to write the trace to (or `1` for a file in the cache directory), or by the Record Trace setting. Spans go into a fixed-size ring buffer, so a long
+session keeps only the most recent ones, and the buffer is written out when TagViewer exits or tracing is turned off.
+
+Every span records the thread it ran on, so the main loop and the worker threads (imports, decoding, indexing, ...) show up as separate tracks.'''
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Optional
+
+ENV_VAR = 'TAGVIEWER_TRACE'
+DEFAULT_CAPACITY = 200_000
+
+
+class _NullSpan:
+	__slots__ = []
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *_):
+		return False
+
+
+_null_span = _NullSpan()
+
+
+class _Span:
+	__slots__ = ['tracer', 'name', 'args', 'start']
+
+	def __init__(self, tracer: 'Tracer', name: str, args: Optional[dict]):
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+		self.start = time.perf_counter_ns()
+		return self
+
+	def __exit__(self, *_):
+		self.tracer.complete(self.name, self.start, time.perf_counter_ns(), self.args)
+		return False
+
+
+class Tracer:
+	__slots__ = ['enabled', 'events', 'threads', 'lock', 'output', 'pid']
+
+	def __init__(self, capacity: int=DEFAULT_CAPACITY):
+		self.enabled = False
+		self.events = deque(maxlen=capacity)
+		self.threads = {}
+		self.lock = threading.Lock()  # for `threads`, which worker threads can add to while it's written out
+		self.output = None
+		self.pid = os.getpid()
+
+	def enable(self, output: Optional[str]=None):
+		self.output = output or self.output
+		self.enabled = True
+
+	def disable(self):
+		'''Stop tracing and write out what was recorded, if there's an output file.'''
+		self.enabled = False
+		if self.output is not None and self.events: self.write(self.output)
+
+	def span(self, name: str, **args):
+		'''A context manager recording the time spent in its body as a span called `name`, with `args` shown alongside it.'''
+		if not self.enabled: return _null_span
+		return _Span(self, name, args or None)
+
+	def complete(self, name: str, start_ns: int, end_ns: int, args: Optional[dict]=None):
+		'''Record a span that has already finished, for spans whose start and end are seen by different callbacks.'''
+		if not self.enabled: return
+		tid = threading.get_native_id()
+		if tid not in self.threads:
+			with self.lock: self.threads[tid] = threading.current_thread().name
+		self.events.append((name, start_ns, end_ns - start_ns, tid, args))
+
+	def to_json(self) -> dict:
+		with self.lock: threads = list(self.threads.items())
+		events = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}} for (tid, name) in threads]
+		for name, start_ns, duration_ns, tid, args in list(self.events):
+			event = {'name': name, 'ph': 'X', 'ts': start_ns / 1000, 'dur': duration_ns / 1000, 'pid': self.pid, 'tid': tid}
+			if args: event['args'] = {key: str(value) for (key, value) in args.items()}
+			events.append(event)
+		return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+	def write(self, filename: str):
+		tmp_path = filename + '.tmp'
+		with open(tmp_path, 'w') as trace_file:
+			json.dump(self.to_json(), trace_file)
+		os.replace(tmp_path, filename)
+
+
+tracer = Tracer()
+
+
+def default_output() -> str:
+	import appdirs
+	return os.path.join(appdirs.user_cache_dir('tagviewer'), time.strftime('trace-%Y%m%d-%H%M%S.json'))
+
+
+if os.environ.get(ENV_VAR):
+	tracer.enable(None if os.environ[ENV_VAR] in ('1', 'true', 'yes') else os.environ[ENV_VAR])
@@ -0,0 +1,83 @@
+'''Moving files to the trash in the background.
+
+Paths are grouped by the filesystem they live on, since each filesystem has its own trash directory, and sent in batches so that progress and cancellation
+are handled between batches rather than only at the end. Versions of Send2Trash that accept a list of paths get a whole batch per call. Older ones get one
+call per path. If a batch fails, its paths are retried one at a time so that the report says exactly which ones couldn't be trashed and why.'''
+
+import os
+from os import path
+from typing import Iterable, List, NamedTuple
+
+from send2trash import send2trash
+
+from jobs import Job
+
+BATCH_SIZE = 64
+
+_accepts_lists = True
+
+
+class TrashReport(NamedTuple):
+	trashed: List[str]
+	failed: List[tuple]  # (path, exception)
+	cancelled: bool
+
+	def summary(self) -> str:
+		lines = [f'{len(self.trashed)} moved to trash, {len(self.failed)} failed' + (' (cancelled)' if self.cancelled else '') + '.']
+		lines.extend(f'{path.basename(filepath)}: {error}' for (filepath, error) in self.failed[:20])
+		if len(self.failed) > 20: lines.append(f'…and {len(self.failed) - 20} more')
+		return '\n'.join(lines)
+
+
+def dir_contents(dirname: str) -> List[str]:
+	'''The paths of everything directly inside `dirname`.'''
+	with os.scandir(dirname) as entries:
+		return [entry.path for entry in entries]
+
+
+def _group_by_filesystem(paths: Iterable[str]) -> dict:
+	groups = {}
+	for filepath in paths:
+		try:
+			device = os.lstat(filepath).st_dev
+		except OSError:
+			device = None  # it will fail in send2trash and be reported there
+		groups.setdefault(device, []).append(filepath)
+	return groups
+
+
+def _trash_batch(batch: List[str], trashed: List[str], failed: List[tuple], as_list: bool):
+	global _accepts_lists
+	partial = False
+	if as_list and _accepts_lists and len(batch) > 1:
+		try:
+			send2trash(batch)
+			trashed.extend(batch)
+			return
+		except TypeError:
+			_accepts_lists = False
+		except OSError:
+			partial = True  # some of the batch may have made it; find out below
+	for filepath in batch:
+		if partial and not path.lexists(filepath):  # trashed by the failed batch call
+			trashed.append(filepath)
+			continue
+		try:
+			send2trash(filepath)
+			trashed.append(filepath)
+		except OSError as e:
+			failed.append((filepath, e))
+
+
+def trash_paths(job: Job, paths: Iterable[str]) -> TrashReport:
+	'''Move `paths` to the trash. Meant to be the target of a `Job`; a cancelled job stops after the current batch and reports what was done.'''
+	groups = _group_by_filesystem(paths)
+	total = sum(map(len, groups.values()))
+	trashed, failed = [], []
+	for device, group in groups.items():
+		for start in range(0, len(group), BATCH_SIZE):
+			if job.cancelled: return TrashReport(trashed, failed, True)
+			batch = group[start:start + BATCH_SIZE]
+			_trash_batch(batch, trashed, failed, as_list=device is not None)
+			job.progress(len(trashed) + len(failed), total, batch[-1])
+	return TrashReport(trashed, failed, False)
@@ -0,0 +1,87 @@
+'''Compacting the tag list of a TagSpace.
+
+The tags of a file are indices into `tagList`, so deleting a tag only tombstones it in `deletedTags`; removing it would shift the index of every tag after it.
+``compute`` removes the tombstoned tags for good. It builds a lookup array from old index to new index (-1 for deleted tags) and sends the tags of every file
+through it in one vectorized pass with NumPy when it's installed, in chunks so that progress can be reported and the job cancelled.
+
+The new tags are computed from a snapshot, without touching the live metadata, and swapped in by ``apply`` on the main thread in one go, so nothing ever sees
+a half-remapped TagSpace. A file whose tags were edited while the vacuum ran is remapped again from its current tags when the result is applied.'''
+
+from itertools import chain
+from typing import List, NamedTuple, Optional, Tuple
+
+from jobs import Job
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+CHUNK_SIZE = 1 << 16  # files per vectorized pass
+
+
+class VacuumResult(NamedTuple):
+	files: List[dict]  # the `files` list the result was computed for
+	sources: List[list]  # the `tags` list of each file when the snapshot was taken
+	tags: List[List[int]]  # the new `tags` of each file
+	tag_list: List[list]
+	lookup: List[int]
+	tag_state: Tuple[int, Tuple[int, ...]]  # the length of `tagList` and `deletedTags` they were computed from
+
+
+def tag_lookup(meta: dict) -> Tuple[List[list], List[int]]:
+	'''Return the compacted tag list and the lookup from each old tag index to its new index, or -1 for deleted tags.'''
+	deleted = set(meta.get('deletedTags', ()))
+	tag_list, lookup = [], []
+	for index, tag in enumerate(meta.get('tagList', ())):
+		if index in deleted: lookup.append(-1)
+		else:
+			lookup.append(len(tag_list))
+			tag_list.append(tag)
+	return tag_list, lookup
+
+
+def _remap_one(tags: List[int], lookup: List[int]) -> List[int]:
+	return [lookup[tag] for tag in tags if 0 <= tag < len(lookup) and lookup[tag] >= 0]
+
+
+def _remap_numpy(tag_lists: List[list], lookup) -> List[List[int]]:
+	lengths = np.fromiter(map(len, tag_lists), dtype=np.int64, count=len(tag_lists))
+	flat = np.fromiter(chain.from_iterable(tag_lists), dtype=np.int64, count=int(lengths.sum()))
+	valid = (flat >= 0) & (flat < len(lookup))
+	remapped = np.where(valid, lookup[np.clip(flat, 0, len(lookup) - 1)], -1)
+	kept = remapped >= 0
+	bounds = np.concatenate(([0], np.cumsum(kept)))[np.concatenate(([0], np.cumsum(lengths)))].tolist()  # where each file's tags start and end
+	values = remapped[kept].tolist()
+	return [values[start:end] for (start, end) in zip(bounds, bounds[1:])]
+
+
+def compute(job: Optional[Job], meta: dict) -> Optional[VacuumResult]:
+	'''Compute the compacted tag list and the remapped tags of every file of `meta`, or return `None` if there's nothing to vacuum.'''
+	if not meta.get('deletedTags'): return None
+	tag_list, lookup = tag_lookup(meta)
+	files = meta.get('files', [])
+	sources = [entry.get('tags', []) for entry in list(files)]
+	array = np.array(lookup, dtype=np.int64) if np is not None and lookup else None
+	tags = []
+	for start in range(0, len(sources), CHUNK_SIZE):
+		chunk = sources[start:start + CHUNK_SIZE]
+		if array is not None: tags.extend(_remap_numpy(chunk, array))
+		else: tags.extend(_remap_one(source, lookup) for source in chunk)
+		if job is not None:
+			job.check()
+			job.progress(start + len(chunk), len(sources), 'Remapping tags')
+	return VacuumResult(files, sources, tags, tag_list, lookup, (len(meta.get('tagList', ())), tuple(meta.get('deletedTags', ()))))
+
+
+def apply(meta: dict, result: VacuumResult) -> bool:
+	'''Swap the result of ``compute`` into `meta`. Returns `False`, leaving `meta` as it was, if the files were replaced or the tag list changed since; the
+	vacuum should then be run again.'''
+	files = meta.get('files', [])
+	if files is not result.files or len(files) != len(result.sources): return False
+	if (len(meta.get('tagList', ())), tuple(meta.get('deletedTags', ()))) != result.tag_state: return False
+	for entry, source, tags in zip(files, result.sources, result.tags):
+		entry['tags'] = tags if entry.get('tags', []) is source else _remap_one(entry.get('tags', []), result.lookup)
+	meta['tagList'] = result.tag_list
+	meta['deletedTags'] = []
+	return True